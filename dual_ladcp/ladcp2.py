@@ -7,9 +7,13 @@ from future import standard_library
 from os.path import expanduser
 from six.moves.tkinter import *
 from uhdas.serial.rditerm import terminal
+from uhdas.serial.download_scheduler import DownloadScheduler
 import os, sys
+import logging
 import Pmw
 
+L = logging.getLogger()
+
 home = expanduser("~")
 logDir = home + '/data/ladcp_terminal_logs'
 backupDir = home + '/backup'
@@ -109,6 +113,65 @@ R_master.cruiseName = R_slave.cruiseName
 
 
 
+# Run the same sequence on both instruments at once; each works in
+# its own thread on its own port, and shows progress in its pane.
+# Downloads are verified and backed up as soon as each one ends.
+both_frame = Frame(root, relief = RIDGE, borderwidth = 2)
+both_frame.pack(side = TOP, expand = NO, fill = X)
+timingSV = StringVar()
+scheduler = None
+
+def run_both(action):
+    global scheduler
+    scheduler = DownloadScheduler({'slave': R_slave, 'master': R_master},
+                                  action = action)
+    scheduler.start(lambda R, func: R.run_background(func))
+    for b in both_buttons:
+        b.configure(state = DISABLED)
+    if action == 'recover':
+        b_cancel_both.configure(state = NORMAL)
+    timingSV.set('%s in progress...' % action.capitalize())
+
+    def check():
+        if scheduler.running():
+            if action == 'recover':
+                timingSV.set(scheduler.summary())
+            root.after(500, check)
+            return
+        wall, saved = scheduler.timing()
+        el = scheduler.elapsed
+        msg = ('%s both: %.1f s (slave %.1f s, master %.1f s); '
+               'saved %.1f s over one at a time'
+               % (action.capitalize(), wall,
+                  el.get('slave', 0), el.get('master', 0), saved))
+        ports, total = scheduler.status()
+        not_done = ['%s %s' % (p['name'], p['state'])
+                    for p in ports if p['state'] != 'done']
+        if not_done:
+            msg += '; ' + ', '.join(not_done)
+        L.info(msg)
+        timingSV.set(msg)
+        for b in both_buttons:
+            b.configure(state = NORMAL)
+        b_cancel_both.configure(state = DISABLED)
+    root.after(500, check)
+
+def cancel_both():
+    if scheduler is not None:
+        scheduler.cancel()
+
+both_buttons = [Button(both_frame, text = 'Deploy both',
+                       command = lambda: run_both('deploy')),
+                Button(both_frame, text = 'Recover both',
+                       command = lambda: run_both('recover'))]
+for b in both_buttons:
+    b.pack(side = LEFT, padx = 5, pady = 3)
+b_cancel_both = Button(both_frame, text = 'Cancel downloads',
+                       state = DISABLED, command = cancel_both)
+b_cancel_both.pack(side = LEFT, padx = 5, pady = 3)
+Label(both_frame, textvariable = timingSV, anchor = W).pack(side = LEFT,
+                                              expand = YES, fill = X)
+
 
 def shutdown():
     R_slave.close_terminal()
@@ -12,6 +12,7 @@ import time, sys, os, os.path
 from six.moves.tkinter import *
 from six.moves import tkinter_messagebox
 import signal
+from uhdas.system.proc_table import get_table
 yearbase = 2004
 datadir = '/home/data/mv0407/'
 
@@ -24,7 +25,7 @@ to leave the old process running.
 process_name = os.path.split(sys.argv[0])[-1]
 
 this_pid = os.getpid()
-pidlist = os.popen('pgrep -x %s' % (process_name,)).readlines()
+pidlist = get_table().pids(name=process_name, exclude_self=False)
 if len(pidlist) > 1:
     print(pidlist)
     print(this_pid)
@@ -34,8 +35,7 @@ if len(pidlist) > 1:
              message = existing_DAS_msg)
     if kill:
         root.destroy()  # Get rid of it so it doesn't interfere with main app.
-        for p in pidlist:
-            pid = int(p.strip())
+        for pid in pidlist:
             if pid != this_pid:
                 try:
                     os.kill(pid, signal.SIGTERM)
@@ -118,6 +118,7 @@ L.addHandler(handler)
 from uhdas.uhdas.procsetup import procsetup
 import uhdas.system.system_summary as SS
 import uhdas.system.logging_summary as logging_summary
+from uhdas.serial import logger_metrics
 from uhdas.system.mail_report import report_mailer
 
 
@@ -178,7 +179,7 @@ try:
     zmq_processes       = SS.list_processes('zmq')
     DAS_processes          = SS.list_processes('DAS')
 
-    mem_python = SS.list_processes('py', '-eFL')
+    mem_python = SS.list_processes('py', user=None)
 
     processes = [DAS_processes, serbin_processes,
                  serasc_processes, zmq_processes, mem_python]
@@ -793,6 +794,15 @@ except:
     L.exception("Generating warning summary")
     warncount_str = "A warnstr was missing so there is no summary"
 
+metrics_str = ''
+try:
+    if uhdas_is_logging:
+        metrics = logger_metrics.read_metrics()
+        metrics_str = '\n'.join(['---- logger throughput ----'] +
+                                logger_metrics.summary_lines(metrics))
+except:
+    L.exception('logger_metrics')
+
 slist = []
 for disk in ['/home'] + ci.backup_paths:
     gyroglob = os.path.join(disk, 'data',
@@ -822,6 +832,8 @@ status_strlist = [timestring,
                   email_comment_str,
                   '\n',
                   zmq_summary,
+                  '\n',
+                  metrics_str,
                   '\n\n',
                   warning_summary_str,
                   '\nFigures and files:',
@@ -16,6 +16,8 @@ import subprocess
 from optparse import OptionParser
 
 from pycurrents.system import Bunch, safe_makedirs
+from uhdas.serial.port_inventory import get_inventory
+from uhdas.system.proc_table import get_table
 
 #-----------------
 
@@ -51,14 +53,10 @@ def get_process_list(cmd, dir):
     Each entry in the list contains two strings; the first
     is the PID, the second is the command line.
     """
-    ps = os.popen('ps -C %s -o pid,args --no-headers' % cmd)
-    procs = ps.readlines()
-    procs = [l.strip() for l in procs if cmd in l and dir in l]
-    pidcmds = [l.split(None,1) for l in procs]
-    # Exclude the present process, in case we want to use this
+    # The present process is excluded, in case we want to use this
     # to ensure only a single zmq_publisher.py is running.
-    pidcmds = [p for p in pidcmds if int(p[0]) != os.getpid()]
-    return pidcmds
+    procs = get_table().find(name=cmd, contains=[cmd, dir])
+    return [[str(p.pid), p.cmdline] for p in procs]
 
 
 def check_zmq(out_dir_base):
@@ -78,12 +76,16 @@ def check_serialports(publish_dict):
     '''
     check whether serial port exists
     '''
+    inventory = get_inventory()
     found_ports = []
     for subdir in publish_dict.keys():
         publisher = publish_dict[subdir]
         device = publisher['in_device']
         sp = '/dev/%s' % (device)
-        if os.path.exists(sp):
+        if inventory.exists(sp):
+            port = inventory.port(sp)
+            if port is not None:
+                LF.info('%s: %s', subdir, port.describe())
             found_ports.append(sp)
         else:
             msg = 'serial port %s does not exist' % (sp)
@@ -0,0 +1,372 @@
+'''
+asyncio transport and protocol for serial_port.
+
+The raw port fd is registered with loop.add_reader, so a single
+event loop can service any number of ports (and zmq or network
+sockets) with no thread per port; data are handed over as soon
+as the kernel has them.
+
+    async def main():
+        port = AsyncSerialPort('/dev/ttyUSB0', baud=9600)
+        await port.open()
+        await port.send_break()
+        banner = await port.read_until(b'>', timeout=5)
+        await port.write_drain(b'TS?\\r')
+        reply = await port.read_until(b'>')
+        await port.change_baud(115200)
+        port.close()
+
+Running this module echoes lines from one or more ports, each
+prefixed with its device name:
+
+    python -m uhdas.serial.aioserial [--baud 9600] /dev/ttyS0 /dev/ttyS1
+'''
+
+import os, sys, time, termios
+import asyncio
+
+import logging
+L = logging.getLogger()
+
+from uhdas.serial.serialport import serial_port
+from uhdas.serial.rxbuffer import RxBuffer
+from uhdas.serial.baud_settle import get_profile
+
+
+class SerialTransport(asyncio.Transport):
+    ''' Non-blocking transport over the fd of an open serial_port. '''
+    max_size = 65536   # largest single read
+
+    def __init__(self, loop, port, protocol):
+        asyncio.Transport.__init__(self, {'serial': port,
+                                          'device': port.get_device()})
+        self._loop = loop
+        self._port = port
+        self._fd = port.fd
+        self._protocol = protocol
+        self._buffer = bytearray()
+        self._closing = False
+        self._reading = True
+        self._eof = False
+        self._flush_waiters = []
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._read_ready)
+        self._loop.call_soon(self._protocol.connection_made, self)
+
+    def _read_ready(self):
+        try:
+            data = os.read(self._fd, self.max_size)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self._fatal_error(exc)
+            return
+        if not data:
+            # End of file: the tty has hung up (e.g. a USB adapter
+            # was unplugged), and would stay readable forever.
+            L.warning("%s: end of file; closing", self._port.get_device())
+            self._eof = True
+            self._force_close(None)
+            return
+        self._protocol.data_received(data)
+
+    def write(self, data):
+        if self._closing:
+            raise RuntimeError('write on closing SerialTransport')
+        if not data:
+            return
+        if not self._buffer:
+            try:
+                n = os.write(self._fd, data)
+            except (BlockingIOError, InterruptedError):
+                n = 0
+            except OSError as exc:
+                self._fatal_error(exc)
+                return
+            data = data[n:]
+            if not data:
+                return
+            self._loop.add_writer(self._fd, self._write_ready)
+        self._buffer.extend(data)
+
+    def _write_ready(self):
+        try:
+            n = os.write(self._fd, self._buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self._fatal_error(exc)
+            return
+        del self._buffer[:n]
+        if not self._buffer:
+            self._loop.remove_writer(self._fd)
+            self._wake_flush_waiters()
+            if self._closing:
+                self._call_connection_lost(None)
+
+    def _wake_flush_waiters(self, exc=None):
+        waiters, self._flush_waiters = self._flush_waiters, []
+        for fut in waiters:
+            if not fut.done():
+                if exc is None:
+                    fut.set_result(None)
+                else:
+                    fut.set_exception(exc)
+
+    async def flushed(self):
+        ''' Wait until everything written has been handed to the driver. '''
+        if not self._buffer:
+            return
+        fut = self._loop.create_future()
+        self._flush_waiters.append(fut)
+        await fut
+
+    def get_write_buffer_size(self):
+        return len(self._buffer)
+
+    def pause_reading(self):
+        if self._reading and not self._closing:
+            self._reading = False
+            self._loop.remove_reader(self._fd)
+
+    def resume_reading(self):
+        if not self._reading and not self._closing:
+            self._reading = True
+            self._loop.add_reader(self._fd, self._read_ready)
+
+    def is_reading(self):
+        return self._reading and not self._closing
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        ''' Stop reading; close the port after pending output is written. '''
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._fd)
+        if not self._buffer:
+            self._loop.call_soon(self._call_connection_lost, None)
+
+    def abort(self):
+        ''' Close at once, discarding pending output. '''
+        self._force_close(None)
+
+    def _fatal_error(self, exc):
+        L.error("%s: %s", self._port.get_device(), exc)
+        self._force_close(exc)
+
+    def _force_close(self, exc):
+        if self._fd is None:
+            return
+        self._buffer.clear()
+        self._loop.remove_writer(self._fd)
+        if not self._closing:
+            self._closing = True
+            self._loop.remove_reader(self._fd)
+        self._loop.call_soon(self._call_connection_lost, exc)
+
+    def _call_connection_lost(self, exc):
+        if self._fd is None:
+            return
+        self._loop.remove_writer(self._fd)
+        self._fd = None
+        self._wake_flush_waiters(exc or ConnectionError('port closed'))
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            # The settings can't be restored on a port that hung up.
+            self._port.close_port(restore=exc is None and not self._eof)
+
+
+class SerialReader(asyncio.Protocol):
+    '''
+    Protocol collecting input in an RxBuffer, so a coroutine can
+    wait for a terminator with an incremental search; there is
+    one reader per port.  An optional *callback* sees every block
+    as it arrives (e.g., for a diary).
+    '''
+    def __init__(self, maxbytes=2 * 1024 * 1024, callback=None):
+        self.buffer = RxBuffer(maxbytes=maxbytes)
+        self.callback = callback
+        self.transport = None
+        self.exception = None
+        self.eof = False
+        self._waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer.append(data)
+        if self.callback is not None:
+            self.callback(data)
+        self._wakeup()
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.exception = exc
+        self._wakeup()
+
+    def _wakeup(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def wait_data(self):
+        ''' Wait for more input, or for the connection to be lost. '''
+        if self.eof:
+            raise self.exception or EOFError('serial port closed')
+        self._waiter = asyncio.get_running_loop().create_future()
+        await self._waiter
+
+
+class AsyncSerialPort(serial_port):
+    '''
+    serial_port with coroutine I/O.  open() and close() are
+    called from the event loop; the blocking termios calls that
+    can take a noticeable time (drain, break) are run in the
+    loop's default executor.
+    '''
+    def __init__(self, device='/dev/ttyS0', baud=9600,
+                       maxbytes=2 * 1024 * 1024, callback=None):
+        serial_port.__init__(self, device=device, baud=baud, mode='r+b')
+        self.maxbytes = maxbytes
+        self.callback = callback
+        self.baud_settle = None  # seconds; None for the port's profile
+        self.transport = None
+        self.protocol = None
+
+    async def open(self, save=True):
+        if self.transport is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self.open_port(save=save)
+        self.set_cc(vmin=0, vtime=0)
+        self.protocol = SerialReader(self.maxbytes, self.callback)
+        self.transport = SerialTransport(loop, self, self.protocol)
+        await asyncio.sleep(0)   # let connection_made run
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    async def read_until(self, s, timeout=5):
+        '''
+        Return everything received up to and including the
+        first *s* (bytes or str); raise asyncio.TimeoutError
+        after *timeout* seconds, leaving the input buffered.
+        '''
+        if isinstance(s, str):
+            s = s.encode('utf-8')
+        buf = self.protocol.buffer
+        pos = buf.begin
+        deadline = time.monotonic() + timeout
+        while True:
+            # Look only at new bytes, plus enough overlap for a
+            # match straddling two arrivals.
+            start = max(pos, buf.begin)
+            ind = buf.getvalue(start).find(s)
+            if ind != -1:
+                return buf.consume(start + ind + len(s))
+            pos = max(start, buf.end - len(s) + 1)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            await asyncio.wait_for(self.protocol.wait_data(), remaining)
+
+    async def read(self, n=-1, timeout=None):
+        '''
+        Return up to *n* buffered bytes (all if *n* < 0), waiting
+        up to *timeout* seconds for input if none is buffered.
+        '''
+        buf = self.protocol.buffer
+        if not len(buf):
+            await asyncio.wait_for(self.protocol.wait_data(), timeout)
+        if n < 0:
+            return buf.consume(buf.end)
+        return buf.consume(buf.begin + n)
+
+    def clear_input(self):
+        self.protocol.buffer.clear()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('ascii', 'ignore')
+        self.transport.write(data)
+
+    async def write_drain(self, data=b''):
+        ''' Write *data* and wait until it has left the port. '''
+        if data:
+            self.write(data)
+        await self.transport.flushed()
+        await asyncio.get_running_loop().run_in_executor(
+                                        None, termios.tcdrain, self.fd)
+
+    async def send_break(self, quarters=0):
+        fd = self.fd
+        await asyncio.get_running_loop().run_in_executor(
+                                    None, termios.tcsendbreak, fd, quarters)
+
+    async def change_baud(self, baud, settle=None):
+        '''
+        Change the baud rate after pending output has been sent,
+        then wait *settle* seconds (default self.baud_settle)
+        without blocking the loop.
+        '''
+        if self.transport is None:
+            self.set_baud(baud)
+            return
+        await self.write_drain()
+        if not self.set_speed(baud):
+            return
+        self.clear_input()
+        if settle is None:
+            settle = self.baud_settle
+        if settle is None:
+            settle = get_profile().delay(self.get_device())
+        await asyncio.sleep(settle)
+
+
+async def _echo(device, baud):
+    async with AsyncSerialPort(device, baud=baud) as port:
+        while True:
+            try:
+                line = await port.read_until(b'\n', timeout=3600)
+            except asyncio.TimeoutError:
+                continue
+            sys.stdout.write('%s: %s' % (device,
+                                         line.decode('ascii', 'replace')))
+            sys.stdout.flush()
+
+
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [--baud BAUD] device [device ...]')
+    op.add_option('-b', '--baud', dest='baud', type='int', default=9600,
+                  help='baud rate for all ports; default is 9600')
+    o, a = op.parse_args()
+    if not a:
+        op.error('at least one device is required')
+
+    async def run():
+        await asyncio.gather(*[_echo(d, o.baud) for d in a])
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
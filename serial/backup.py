@@ -0,0 +1,278 @@
+'''
+Background backup of downloaded files.
+
+Files are copied by a worker thread, so a slow backup drive never
+holds up the terminal.  Each copy is streamed to DEST/NAME.part
+with a SHA-256 computed from the bytes as they are written; only
+if it matches the source hash is the copy fsynced and renamed into
+place.  A destination that is missing or not writable (e.g., an
+unplugged USB drive) is retried every *retry_interval* seconds.
+
+Pending copies are kept in a small JSON file, rewritten atomically
+whenever it changes, so copies interrupted by a crash or shutdown
+are picked up at the next start-up.  Terminals sharing a queue
+file share one BackupQueue (see get_backup_queue).
+'''
+
+import os, time
+import json
+import shutil
+import hashlib
+from threading import Thread, Lock, Condition
+
+import logging
+L = logging.getLogger()
+
+
+def sha256_file(filename, chunk=1024 * 1024):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class BackupUnavailable(Exception):
+    ''' The destination can't be written now; try again later. '''
+    pass
+
+
+class BackupFailed(Exception):
+    ''' The copy was made but did not match the source. '''
+    pass
+
+
+class BackupQueue(object):
+    def __init__(self, queue_file,
+                       retry_interval=60,
+                       maxtries=3,
+                       chunk=1024 * 1024):
+        '''
+        *queue_file* holds the pending copies; *maxtries* limits
+        attempts that fail verification (unavailable destinations
+        are retried without limit).
+        '''
+        self.queue_file = queue_file
+        self.retry_interval = retry_interval
+        self.maxtries = maxtries
+        self.chunk = chunk
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+        self.jobs = self._load()
+        self.callbacks = []
+        self.unavailable = set()   # destinations already reported
+        self.ncopied = 0
+        self.nbytes = 0
+        self.nfailed = 0
+        self.running = True
+        if self.jobs:
+            L.info("Backup queue %s: resuming %d copies",
+                   queue_file, len(self.jobs))
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _load(self):
+        try:
+            with open(self.queue_file) as f:
+                jobs = json.load(f)
+        except (IOError, OSError):
+            return []
+        except ValueError:
+            L.exception("Backup queue %s is corrupt; ignored",
+                        self.queue_file)
+            return []
+        for job in jobs:
+            job['next_try'] = 0     # retry at once after a restart
+        return jobs
+
+    def _save(self):
+        ''' Write the queue atomically; called with the lock held. '''
+        tmp = self.queue_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.jobs, f, indent=1)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.queue_file)
+        except (IOError, OSError):
+            L.exception("writing backup queue %s", self.queue_file)
+
+    def add_callback(self, func):
+        '''
+        *func(job, ok, msg)* is called in the worker thread after
+        each copy succeeds (ok True) or finally fails (ok False),
+        and with ok None when a destination becomes unavailable;
+        that is reported once, not on every retry, until a copy
+        to the destination succeeds again.
+        '''
+        self.callbacks.append(func)
+
+    def remove_callback(self, func):
+        if func in self.callbacks:
+            self.callbacks.remove(func)
+
+    def _notify(self, job, ok, msg):
+        for func in list(self.callbacks):
+            try:
+                func(job, ok, msg)
+            except Exception:
+                L.exception("backup callback")
+
+    def add(self, source, destinations, sha256=None):
+        ''' Queue copies of *source* to each directory in *destinations*.
+        *sha256* is the source hash, if already known.
+        '''
+        with self.cond:
+            for dest in destinations:
+                if not dest:
+                    continue
+                self.jobs.append(dict(source=os.path.abspath(source),
+                                      dest=dest,
+                                      sha256=sha256,
+                                      tries=0,
+                                      added=time.time(),
+                                      next_try=0))
+            self._save()
+            self.cond.notify()
+
+    def pending(self):
+        with self.lock:
+            return len(self.jobs)
+
+    def summary(self):
+        return ('%d copied (%d bytes), %d failed, %d pending'
+                % (self.ncopied, self.nbytes, self.nfailed, self.pending()))
+
+    def close(self, timeout=None):
+        ''' Stop the worker after the copy in progress, if any. '''
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join(timeout)
+
+    def _next_job(self):
+        ''' Wait for a job that is due; None when closing. '''
+        with self.cond:
+            while self.running:
+                now = time.time()
+                due = [j for j in self.jobs if j['next_try'] <= now]
+                if due:
+                    return due[0]
+                wait = None
+                if self.jobs:
+                    wait = min(j['next_try'] for j in self.jobs) - now
+                self.cond.wait(wait)
+        return None
+
+    def _finish(self, job):
+        with self.lock:
+            if job in self.jobs:
+                self.jobs.remove(job)
+            self._save()
+
+    def run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                nbytes = self.copy(job)
+            except BackupUnavailable as exc:
+                with self.lock:
+                    job['next_try'] = time.time() + self.retry_interval
+                    self._save()
+                if job['dest'] in self.unavailable:
+                    L.debug("Backup to %s still unavailable: %s",
+                            job['dest'], exc)
+                    continue
+                self.unavailable.add(job['dest'])
+                L.warning("Backup to %s unavailable: %s", job['dest'], exc)
+                self._notify(job, None, str(exc))
+                continue
+            except (BackupFailed, IOError, OSError) as exc:
+                with self.lock:
+                    job['tries'] += 1
+                    job['next_try'] = time.time() + self.retry_interval
+                    give_up = job['tries'] >= self.maxtries
+                    if not give_up:
+                        self._save()
+                L.warning("Backup of %s to %s failed: %s",
+                          job['source'], job['dest'], exc)
+                if give_up:
+                    self.nfailed += 1
+                    self._finish(job)
+                    self._notify(job, False, str(exc))
+                continue
+            self.ncopied += 1
+            self.nbytes += nbytes
+            self.unavailable.discard(job['dest'])
+            self._finish(job)
+            L.info("Backed up %s to %s", job['source'], job['dest'])
+            self._notify(job, True, '%d bytes, sha256 verified' % nbytes)
+
+    def _prepare_dest(self, dest):
+        if not os.path.isdir(dest):
+            try:
+                os.mkdir(dest)    # not makedirs: the drive may be missing
+            except OSError as exc:
+                raise BackupUnavailable(str(exc))
+        if not os.access(dest, os.W_OK):
+            raise BackupUnavailable('%s is not writable' % dest)
+
+    def copy(self, job):
+        ''' Copy one file with hash verification; return its size. '''
+        source = job['source']
+        if not os.path.exists(source):
+            raise BackupFailed('source %s is gone' % source)
+        self._prepare_dest(job['dest'])
+        if job['sha256'] is None:
+            job['sha256'] = sha256_file(source, self.chunk)
+        target = os.path.join(job['dest'], os.path.basename(source))
+        part = target + '.part'
+        h = hashlib.sha256()
+        nbytes = 0
+        try:
+            with open(source, 'rb') as fin:
+                try:
+                    fout = open(part, 'wb')
+                except (IOError, OSError) as exc:
+                    raise BackupUnavailable(str(exc))
+                with fout:
+                    while True:
+                        data = fin.read(self.chunk)
+                        if not data:
+                            break
+                        fout.write(data)
+                        h.update(data)
+                        nbytes += len(data)
+                    fout.flush()
+                    os.fsync(fout.fileno())
+            if h.hexdigest() != job['sha256']:
+                raise BackupFailed('sha256 of copy does not match %s'
+                                   % source)
+            shutil.copystat(source, part)
+            os.rename(part, target)
+        except BaseException:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            raise
+        return nbytes
+
+
+_queues = {}
+_queues_lock = Lock()
+
+
+def get_backup_queue(queue_file, **kwargs):
+    ''' The BackupQueue for *queue_file*, started on first use. '''
+    queue_file = os.path.abspath(queue_file)
+    with _queues_lock:
+        if queue_file not in _queues:
+            _queues[queue_file] = BackupQueue(queue_file, **kwargs)
+        return _queues[queue_file]
@@ -0,0 +1,181 @@
+'''
+Baud-rate settle times, measured and remembered per port.
+
+After the local port's speed is changed, some adapters (notably
+USB serial converters) take a while before bytes go out and come
+back at the new rate.  Instead of always sleeping 0.5 s, a
+terminal that can talk to its instrument probes with a no-op
+command until it gets a clean prompt (see probe_settle), and
+records how long that took.  The recorded times tune later
+switches: the first probe is sent when the port has usually
+settled, and serial_port.set_baud, which cannot probe, waits only
+as long as this port has ever needed.
+
+The profile is a small JSON file, by default ~/.baud_settle.json
+(or $UHDAS_BAUD_PROFILE), with an entry for each port: its device
+name and, where sysfs says, the driver, so a different adapter on
+the same device name starts afresh.
+'''
+
+import os, time
+import json
+from threading import Lock
+
+import logging
+L = logging.getLogger()
+
+default_settle = 0.5     # seconds, with nothing known about the port
+margin = 0.02            # seconds added to the longest settle seen
+
+
+def default_filename():
+    return os.environ.get('UHDAS_BAUD_PROFILE',
+                          os.path.join(os.path.expanduser('~'),
+                                       '.baud_settle.json'))
+
+
+def port_key(device):
+    ''' "device" or "device:driver" for *device*. '''
+    name = os.path.basename(os.path.realpath(device))
+    try:
+        driver = os.readlink('/sys/class/tty/%s/device/driver' % name)
+        return '%s:%s' % (device, os.path.basename(driver))
+    except OSError:
+        return device
+
+
+class SettleProfile(object):
+    def __init__(self, filename=None, nkeep=20):
+        '''
+        Settle times for each port, kept in *filename*; the last
+        *nkeep* of each are used.
+        '''
+        if filename is None:
+            filename = default_filename()
+        self.filename = filename
+        self.nkeep = nkeep
+        self.lock = Lock()
+        self.ports = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                self.ports = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.ports = {}
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.ports, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.filename)
+        except (IOError, OSError):
+            L.warning("Can't write baud settle profile %s", self.filename)
+
+    def record(self, device, baud, seconds, nprobes=1):
+        ''' Add a settle time of *seconds* for *device* at *baud*. '''
+        key = port_key(device)
+        with self.lock:
+            entry = self.ports.setdefault(key, {'settle': [], 'switches': 0,
+                                                'retries': 0})
+            entry['settle'] = (entry['settle'] + [round(seconds, 4)]
+                               )[-self.nkeep:]
+            entry['switches'] += 1
+            entry['retries'] += nprobes - 1
+            entry['last_baud'] = baud
+            self.save()
+
+    def _settle(self, device):
+        entry = self.ports.get(port_key(device))
+        if entry is None or not entry['settle']:
+            return None
+        return entry['settle']
+
+    def delay(self, device):
+        ''' Fixed wait after a speed change, for callers that can't
+        probe: the longest settle seen plus a margin.
+        '''
+        settle = self._settle(device)
+        if settle is None:
+            return default_settle
+        return min(default_settle, max(settle) + margin)
+
+    def first_probe(self, device):
+        ''' When to send the first probe: the median settle seen. '''
+        settle = self._settle(device)
+        if settle is None:
+            return 0.0
+        return sorted(settle)[len(settle) // 2]
+
+    def summary(self, device):
+        settle = self._settle(device)
+        if settle is None:
+            return '%s: no baud changes measured' % port_key(device)
+        entry = self.ports[port_key(device)]
+        return ('%s: %d baud changes, settle median %.3f s, max %.3f s, '
+                '%d retries' % (port_key(device), entry['switches'],
+                                self.first_probe(device), max(settle),
+                                entry['retries']))
+
+
+_profiles = {}
+_profiles_lock = Lock()
+
+
+def get_profile(filename=None):
+    ''' The SettleProfile for *filename*, shared by all ports. '''
+    if filename is None:
+        filename = default_filename()
+    filename = os.path.abspath(filename)
+    with _profiles_lock:
+        if filename not in _profiles:
+            _profiles[filename] = SettleProfile(filename)
+        return _profiles[filename]
+
+
+def retry_probe(probe, timeout=0.2, max_timeout=1.6, max_tries=6):
+    '''
+    Call *probe(timeout)* until it returns True, doubling the
+    timeout after each failure, up to *max_timeout*.  *probe*
+    sends a no-op command and returns True only if a clean prompt
+    came back in time.  Return (number of tries, time the good
+    probe was sent); raise the last exception from *probe*, or
+    RuntimeError, if none succeeds in *max_tries*.
+    '''
+    error = None
+    for ntry in range(1, max_tries + 1):
+        t_sent = time.time()
+        try:
+            if probe(timeout):
+                return ntry, t_sent
+        except Exception as exc:
+            error = exc
+        timeout = min(2 * timeout, max_timeout)
+    if error is not None:
+        raise error
+    raise RuntimeError('no clean prompt in %d tries' % max_tries)
+
+
+def probe_settle(probe, device, baud, t_changed=None, profile=None, **kwargs):
+    '''
+    Wait until *device* has settled after its speed was changed
+    to *baud* at *t_changed* (default now), probing as in
+    retry_probe.  The first probe goes out when the profile says
+    the port usually settles.  The time from *t_changed* to the
+    good probe is recorded in the profile and returned.
+    '''
+    if profile is None:
+        profile = get_profile()
+    if t_changed is None:
+        t_changed = time.time()
+    wait = profile.first_probe(device) - (time.time() - t_changed)
+    if wait > 0:
+        time.sleep(wait)
+    ntry, t_sent = retry_probe(probe, **kwargs)
+    settle = t_sent - t_changed
+    profile.record(device, baud, settle, ntry)
+    L.debug("%s settled at %d baud in %.3f s, %d probes",
+            device, baud, settle, ntry)
+    return settle
@@ -0,0 +1,137 @@
+'''
+Buffered diary writer for saving terminal input.
+
+The serial reader thread hands each received block to write(),
+which only puts it on a bounded queue; a separate writer thread
+coalesces queued blocks into large writes.  A slow disk therefore
+cannot stall the reader.  If the queue stays full for longer than
+*block_timeout*, blocks are dropped and counted rather than
+holding up the serial port.
+'''
+
+import os, time
+import queue
+from threading import Thread, Lock
+
+import logging
+L = logging.getLogger()
+
+_SYNC = object()
+_CLOSE = object()
+
+
+class DiaryWriter(object):
+    def __init__(self, filename, mode='ab',
+                 maxqueue=4096,
+                 coalesce_bytes=256 * 1024,
+                 fsync_interval=None,
+                 block_timeout=0.05):
+        '''
+        *fsync_interval* is in seconds; None means fsync only on
+        sync() (e.g., once per cast) and close().
+        '''
+        self.filename = filename
+        self.file = open(filename, mode)   # errors raised to the caller
+        self.queue = queue.Queue(maxqueue)
+        self.coalesce_bytes = coalesce_bytes
+        self.fsync_interval = fsync_interval
+        self.block_timeout = block_timeout
+        self.lock = Lock()
+        self.nwritten = 0
+        self.nwrites = 0
+        self.nblocked = 0        # writes that had to wait for room
+        self.ndropped = 0        # blocks dropped because the queue was full
+        self.bytes_dropped = 0
+        self.nsyncs = 0
+        self.last_sync = time.time()
+        self.dirty = False
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        ''' Queue *data*; called from the reader thread. '''
+        try:
+            self.queue.put_nowait(data)
+            return
+        except queue.Full:
+            pass
+        with self.lock:
+            self.nblocked += 1
+        try:
+            self.queue.put(data, timeout=self.block_timeout)
+        except queue.Full:
+            with self.lock:
+                self.ndropped += 1
+                self.bytes_dropped += len(data)
+
+    def sync(self):
+        ''' Ask the writer thread to flush and fsync what it has. '''
+        self.queue.put(_SYNC)
+
+    def close(self, timeout=10):
+        ''' Write everything queued, fsync, and close the file. '''
+        if self.thread is None:
+            return
+        self.queue.put(_CLOSE)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            L.warning("Diary writer for %s did not finish", self.filename)
+        self.thread = None
+        if self.ndropped:
+            L.warning("Diary %s: %s", self.filename, self.summary())
+
+    def summary(self):
+        return ('%d bytes in %d writes, %d fsyncs; %d waits for room, '
+                '%d blocks (%d bytes) dropped'
+                % (self.nwritten, self.nwrites, self.nsyncs, self.nblocked,
+                   self.ndropped, self.bytes_dropped))
+
+    def _fsync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.dirty = False
+        self.nsyncs += 1
+        self.last_sync = time.time()
+
+    def run(self):
+        timeout = None
+        if self.fsync_interval:
+            timeout = self.fsync_interval
+        closing = False
+        while not closing:
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            parts = []
+            nbytes = 0
+            sync = False
+            while True:
+                if item is _CLOSE:
+                    closing = True
+                elif item is _SYNC:
+                    sync = True
+                elif item is not None:
+                    parts.append(item)
+                    nbytes += len(item)
+                if closing or nbytes >= self.coalesce_bytes:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                if parts:
+                    self.file.write(b''.join(parts))
+                    self.nwritten += nbytes
+                    self.nwrites += 1
+                    self.dirty = True
+                if (sync or closing or (self.dirty and self.fsync_interval and
+                        time.time() - self.last_sync >= self.fsync_interval)):
+                    self._fsync()
+                elif parts:
+                    self.file.flush()
+            except (IOError, OSError):
+                L.exception("writing diary %s", self.filename)
+        self.file.close()
@@ -0,0 +1,153 @@
+'''
+Concurrent recorder downloads from several RDI instruments.
+
+Each instrument's recovery (RdiProtocol.recover: wake up, list
+the recorder, YMODEM download, then verify and back up the file)
+runs in its own thread on its own port, so the downloads overlap
+and each file is checked and copied as soon as its own transfer
+ends.  The scheduler reports per-port and aggregate bytes/s and
+ETA from the receivers' YmodemStats, and can cancel one port
+without disturbing the other.
+
+    S = DownloadScheduler({'master': R_master, 'slave': R_slave})
+    S.start()
+    while S.running():
+        print(S.summary())
+        time.sleep(1)
+'''
+
+import time
+from threading import Thread
+
+import logging
+L = logging.getLogger()
+
+
+def _start_thread(terminal, func):
+    t = Thread(target=func)
+    t.daemon = True
+    t.start()
+    return t
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return '--:--'
+    seconds = int(round(seconds))
+    return '%d:%02d' % (seconds // 60, seconds % 60)
+
+
+class DownloadScheduler(object):
+    def __init__(self, terminals, action='recover'):
+        '''
+        *terminals* is a dictionary of RdiProtocol instances keyed
+        by a short name for reports; *action* is the method run on
+        each.
+        '''
+        self.terminals = terminals
+        self.action = action
+        self.threads = {}
+        self.elapsed = {}     # name: seconds, for completed runs
+        self.errors = {}      # name: exception message
+        self.t0 = None
+        self.t_end = None
+
+    def start(self, start_thread=_start_thread):
+        '''
+        Start all downloads.  *start_thread(terminal, func)* must
+        run *func* in a new thread and return the Thread; the
+        default is a plain daemon thread.  A Tk_terminal passes
+        its run_background method instead.
+        '''
+        self.t0 = time.time()
+        self.t_end = None
+        for name, R in self.terminals.items():
+            R.ymodem = None
+            R.canceled = 0
+            self.threads[name] = start_thread(R, self._job(name, R))
+
+    def _job(self, name, R):
+        def run():
+            t = time.time()
+            try:
+                getattr(R, self.action)()
+            except Exception as exc:
+                L.exception("%s: %s failed", name, self.action)
+                self.errors[name] = str(exc) or exc.__class__.__name__
+                R.report_error("%s: %s" % (name, self.errors[name]))
+            finally:
+                self.elapsed[name] = time.time() - t
+        return run
+
+    def running(self):
+        alive = [t for t in self.threads.values() if t.is_alive()]
+        if not alive and self.t0 is not None and self.t_end is None:
+            self.t_end = time.time()
+        return bool(alive)
+
+    def cancel(self, name=None):
+        ''' Cancel the download on port *name*, or on all ports. '''
+        for key, R in self.terminals.items():
+            if name is None or key == name:
+                R.abort_download()
+
+    def port_status(self, name):
+        R = self.terminals[name]
+        st = dict(name=name, state='waiting', filename='', nbytes=0,
+                  file_bytes=0, size=None, rate=0.0, eta=None, retries=0)
+        thread = self.threads.get(name)
+        ym = R.ymodem
+        if ym is not None:
+            stats = ym.stats
+            st.update(filename=stats.filename, nbytes=stats.nbytes,
+                      file_bytes=stats.file_bytes,
+                      size=stats.size, rate=stats.rate(), eta=stats.eta(),
+                      retries=stats.nretry())
+            if stats.t_end is None:
+                st['state'] = 'downloading'
+            else:
+                st['state'] = 'finishing'
+        if R.canceled:
+            st['state'] = 'canceled'
+        if thread is not None and not thread.is_alive():
+            if name in self.errors:
+                st['state'] = 'failed'
+            elif st['state'] != 'canceled':
+                st['state'] = 'done'
+        return st
+
+    def status(self):
+        ''' Return (list of per-port status, aggregate status). '''
+        ports = [self.port_status(name) for name in sorted(self.terminals)]
+        etas = [p['eta'] for p in ports if p['state'] == 'downloading']
+        total = dict(nbytes=sum(p['nbytes'] for p in ports),
+                     rate=sum(p['rate'] for p in ports
+                              if p['state'] == 'downloading'),
+                     eta=None)
+        if etas and None not in etas:
+            total['eta'] = max(etas)
+        return ports, total
+
+    def summary(self):
+        ports, total = self.status()
+        parts = []
+        for p in ports:
+            if p['state'] == 'downloading':
+                if p['size']:
+                    pct = ' %.0f%%' % (100.0 * min(p['file_bytes'], p['size'])
+                                       / p['size'])
+                else:
+                    pct = ''
+                parts.append('%s%s %.0f B/s ETA %s' % (p['name'], pct,
+                                             p['rate'], format_eta(p['eta'])))
+            else:
+                parts.append('%s %s' % (p['name'], p['state']))
+        parts.append('total %.0f B/s ETA %s' % (total['rate'],
+                                                format_eta(total['eta'])))
+        return ' | '.join(parts)
+
+    def timing(self):
+        ''' Wall-clock time, and time saved over one port at a time. '''
+        end = self.t_end or time.time()
+        wall = end - self.t0
+        return wall, sum(self.elapsed.values()) - wall
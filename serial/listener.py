@@ -0,0 +1,220 @@
+'''
+Blocking listener thread for serial port readers.
+
+The port is watched with poll(), together with the read end of
+a pipe that is written to by stop(); so an idle port costs no
+CPU, and the thread wakes immediately when data arrives or when
+it is told to stop.  Data are read into a preallocated bytearray,
+so a burst is taken in as few, large reads as possible.
+
+Running this module benchmarks the listener against the older
+VMIN=0/VTIME=1 polling loop on a pseudo-terminal:
+
+    python -m uhdas.serial.listener [seconds]
+'''
+from __future__ import print_function
+
+import os, io, sys, time, select, termios, tty, pty
+from threading import Thread
+
+import logging
+L = logging.getLogger()
+
+
+class PortListener(object):
+    def __init__(self, fd, callback, bufsize=65536, on_stop=None):
+        '''
+        *fd* is an open file descriptor; *callback* is called in
+        the listener thread with each block of bytes read.  If the
+        thread ends by itself (hangup or error, not stop()),
+        *on_stop* is called in it with this PortListener.
+        '''
+        self.fd = fd
+        self.callback = callback
+        self.on_stop = on_stop
+        self.hangup = False   # True if the thread ended by itself
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.nwakeups = 0
+        self.nreads = 0
+        self.nbytes = 0
+        self.cpu_time = 0.0   # thread CPU seconds, set when run() ends
+        self.running = False
+        self.thread = None
+        self._rp, self._wp = os.pipe()
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=3):
+        '''
+        Wake the thread through the pipe and wait for it to end.
+        The pipe is closed only if the thread has finished.
+        '''
+        self.running = False
+        if self._rp is None:
+            return
+        os.write(self._wp, b'x')
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                L.warning("PortListener thread did not stop")
+                return
+            self.thread = None
+        os.close(self._rp)
+        os.close(self._wp)
+        self._rp = self._wp = None
+
+    def run(self):
+        '''
+        Thread target.  Returns when stop() is called, or when
+        the port reports an error or hangup.
+        '''
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN | select.POLLPRI)
+        poller.register(self._rp, select.POLLIN)
+        # Unbuffered FileIO on the port fd, so readinto fills self.buf
+        # directly; closefd=False leaves the fd to serial_port.
+        port = io.FileIO(self.fd, 'rb', closefd=False)
+        bad = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        t0 = time.thread_time()
+        while self.running:
+            try:
+                events = poller.poll()
+            except InterruptedError:
+                continue
+            self.nwakeups += 1
+            for fd, event in events:
+                if fd == self._rp:
+                    self.running = False
+                    break
+                if event & select.POLLIN:
+                    try:
+                        n = port.readinto(self.view)
+                    except (OSError, ValueError):
+                        L.exception("PortListener read failed on fd %s", fd)
+                        self.hangup = True
+                        break
+                    if n:
+                        self.nreads += 1
+                        self.nbytes += n
+                        self.callback(bytes(self.view[:n]))
+                    else:
+                        # Readable but empty: the other end has gone.
+                        L.warning("PortListener: end of file on fd %s", fd)
+                        self.hangup = True
+                        break
+                if event & bad:
+                    L.warning("PortListener: poll event %d on fd %s",
+                              event, fd)
+                    self.hangup = True
+                    break
+            if self.hangup:
+                self.running = False
+        self.cpu_time = time.thread_time() - t0
+        if self.hangup and self.on_stop is not None:
+            self.on_stop(self)
+
+
+def _polling_listen(fd, callback, state):
+    ''' The original Tk_terminal.listen loop, for comparison. '''
+    t0 = time.thread_time()
+    while state['running']:
+        state['nwakeups'] += 1
+        cc = os.read(fd, 500)
+        if cc == b"":
+            time.sleep(0.001)
+        else:
+            callback(cc)
+    state['cpu_time'] = time.thread_time() - t0
+
+
+def _open_pty(vmin, vtime):
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    tios = termios.tcgetattr(slave)
+    tios[6][termios.VMIN] = vmin
+    tios[6][termios.VTIME] = vtime
+    termios.tcsetattr(slave, termios.TCSANOW, tios)
+    return master, slave
+
+
+def benchmark(seconds=5, burst=2000000):
+    '''
+    Measure thread CPU time and wakeups for an idle port over
+    *seconds*, and the reads needed to take in a *burst* of bytes,
+    for the old polling loop and for PortListener.  Returns a dictionary of
+    results keyed by method.
+    '''
+    results = {}
+    for name in ('polling', 'poll+pipe'):
+        if name == 'polling':
+            master, slave = _open_pty(0, 1)
+        else:
+            master, slave = _open_pty(0, 0)
+        counts = dict(nreads=0, nbytes=0)
+
+        def callback(cc):
+            counts['nreads'] += 1
+            counts['nbytes'] += len(cc)
+
+        if name == 'polling':
+            state = dict(running=True, nwakeups=0, cpu_time=0.0)
+            th = Thread(target=_polling_listen, args=(slave, callback, state))
+            th.start()
+        else:
+            pl = PortListener(slave, callback)
+            pl.start()
+        time.sleep(seconds)
+        idle_nreads = counts['nreads']
+        if name == 'polling':
+            idle_wakeups = state['nwakeups']
+        else:
+            idle_wakeups = pl.nwakeups
+
+        t0 = time.time()
+        block = b'\x7f' * 4096
+        nsent = 0
+        while nsent < burst:
+            nsent += os.write(master, block)
+        while counts['nbytes'] < nsent and time.time() - t0 < 30:
+            time.sleep(0.01)
+        dt = time.time() - t0
+
+        if name == 'polling':
+            state['running'] = False
+            th.join()
+            cpu_time = state['cpu_time']
+        else:
+            pl.stop()
+            cpu_time = pl.cpu_time
+        os.close(master)
+        os.close(slave)
+        results[name] = dict(cpu=cpu_time,
+                             idle_wakeups=idle_wakeups,
+                             idle_reads=idle_nreads,
+                             burst_reads=counts['nreads'] - idle_nreads,
+                             burst_bytes=counts['nbytes'],
+                             burst_seconds=dt)
+    return results
+
+
+def main():
+    seconds = 5
+    if len(sys.argv) > 1:
+        seconds = float(sys.argv[1])
+    results = benchmark(seconds)
+    print("%-10s %10s %13s %12s %12s" % ('method', 'CPU (s)',
+                                       'idle wakeups', 'burst reads',
+                                       'burst MB/s'))
+    for name, r in results.items():
+        print("%-10s %10.3f %13d %12d %12.1f" % (
+              name, r['cpu'], r['idle_wakeups'], r['burst_reads'],
+              r['burst_bytes'] / max(r['burst_seconds'], 1e-6) / 1e6))
+    print("(Idle period %.1f s; CPU includes the burst.)" % seconds)
+
+if __name__ == '__main__':
+    main()
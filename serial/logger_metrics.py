@@ -0,0 +1,277 @@
+'''
+Throughput and timing metrics for each logger.
+
+Every line a logger writes to its data pipe is counted by a
+LoggerMetrics (one per Logger, kept by its Tracker): lines and
+bytes per second over the last minute, the error rate, a
+histogram of the time between lines, and the longest gap.
+
+Loggers publishes a snapshot of all of them every few seconds
+with a MetricsPublisher: to a small JSON file and/or a zmq PUB
+socket (as the string "logger_metrics <json>"), if it is given
+them.  DAS writes to /home/adcp/log/logger_metrics.json (or
+$UHDAS_LOGGER_METRICS), and publishes on zmq if asked to.
+DAS.check_timeout, the daily report and anything else that wants
+the numbers read them from there rather than from the log files:
+
+    python -m uhdas.serial.logger_metrics [filename]
+
+prints the last snapshot.
+'''
+from __future__ import print_function, division
+
+import os, time
+import json
+from bisect import bisect_right
+from collections import deque
+
+import logging
+L = logging.getLogger()
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+topic = 'logger_metrics'
+
+# Edges, in seconds, of the inter-arrival histogram: bin i holds
+# gaps from gap_edges[i-1] up to but not including gap_edges[i];
+# the first bin holds shorter gaps, the last everything longer.
+gap_edges = [0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60]
+
+
+def default_filename():
+    return os.environ.get('UHDAS_LOGGER_METRICS',
+                          '/home/adcp/log/logger_metrics.json')
+
+
+class LoggerMetrics(object):
+    def __init__(self, name, window=60):
+        '''
+        Metrics for logger *name*; rates are over the last
+        *window* seconds.
+        '''
+        self.name = name
+        self.window = window
+        self.reset()
+
+    def reset(self, t=None):
+        if t is None:
+            t = time.time()
+        self.t_start = t
+        self.lines = 0
+        self.nbytes = 0
+        self.errors = 0
+        self.last_line = None     # time of the last line, any kind
+        self.last_good = 0
+        self.last_error = 0
+        self.max_gap = 0.0
+        self.histogram = [0] * (len(gap_edges) + 1)
+        self.seconds = deque()    # [second, lines, bytes, errors]
+
+    def count(self, ok, nbytes=0, t=None):
+        ''' Count one line of *nbytes*, good if *ok*, arriving at *t*. '''
+        if t is None:
+            t = time.time()
+        if self.last_line is not None:
+            gap = t - self.last_line
+            self.histogram[bisect_right(gap_edges, gap)] += 1
+            if gap > self.max_gap:
+                self.max_gap = gap
+        self.last_line = t
+        self.lines += 1
+        self.nbytes += nbytes
+        if ok:
+            self.last_good = t
+        else:
+            self.errors += 1
+            self.last_error = t
+        sec = int(t)
+        if not self.seconds or self.seconds[-1][0] != sec:
+            self.seconds.append([sec, 0, 0, 0])
+            self._trim(sec)
+        bucket = self.seconds[-1]
+        bucket[1] += 1
+        bucket[2] += nbytes
+        if not ok:
+            bucket[3] += 1
+
+    def _trim(self, now):
+        while self.seconds and self.seconds[0][0] <= now - self.window:
+            self.seconds.popleft()
+
+    def restart(self, t=None):
+        '''
+        Logging is starting again: the time since the last line is
+        counted as a gap, but not as an inter-arrival time.
+        '''
+        if t is None:
+            t = time.time()
+        if self.last_line is not None:
+            self.max_gap = max(self.max_gap, t - self.last_line)
+        self.last_line = None
+
+    def since_good(self, now=None):
+        ''' Seconds since the last good line (or since the epoch). '''
+        if now is None:
+            now = time.time()
+        return now - self.last_good
+
+    def snapshot(self, now=None):
+        ''' The metrics as a dictionary, ready for JSON. '''
+        if now is None:
+            now = time.time()
+        self._trim(int(now))
+        span = min(self.window, max(now - self.t_start, 1e-3))
+        wlines = sum(b[1] for b in self.seconds)
+        wbytes = sum(b[2] for b in self.seconds)
+        werrors = sum(b[3] for b in self.seconds)
+        gap = None
+        if self.last_line is not None:
+            gap = round(now - self.last_line, 3)
+        return dict(name=self.name,
+                    time=round(now, 3),
+                    start=round(self.t_start, 3),
+                    lines=self.lines,
+                    bytes=self.nbytes,
+                    errors=self.errors,
+                    error_rate=(round(self.errors / self.lines, 4)
+                                if self.lines else 0.0),
+                    lines_per_s=round(wlines / span, 3),
+                    bytes_per_s=round(wbytes / span, 1),
+                    recent_error_rate=(round(werrors / wlines, 4)
+                                       if wlines else 0.0),
+                    last_good=round(self.last_good, 3),
+                    last_error=round(self.last_error, 3),
+                    gap=gap,
+                    max_gap=round(self.max_gap, 3),
+                    gap_edges=gap_edges,
+                    gap_histogram=list(self.histogram))
+
+    def summary(self, now=None):
+        return summary_line(self.snapshot(now))
+
+
+def summary_line(snap):
+    ''' One line for the snapshot *snap* of a logger. '''
+    gap = snap['gap']
+    return ('%-10s %7.2f lines/s %9.1f B/s  errors %d (%.1f%%)  '
+            'gap %s  max gap %.1f s'
+            % (snap['name'], snap['lines_per_s'], snap['bytes_per_s'],
+               snap['errors'], 100 * snap['error_rate'],
+               'none' if gap is None else '%.1f s' % gap, snap['max_gap']))
+
+
+class MetricsPublisher(object):
+    def __init__(self, filename=None, zmq_addr=None):
+        '''
+        Write snapshots to *filename*, if given, and publish them
+        on a PUB socket bound to *zmq_addr*, if given.
+        '''
+        self.filename = filename
+        self.write_failed = False    # warned already
+        self.socket = None
+        self.zmq_addr = None
+        if zmq_addr:
+            self.connect(zmq_addr)
+
+    def connect(self, zmq_addr):
+        ''' Start publishing on a PUB socket bound to *zmq_addr*. '''
+        if zmq is None:
+            L.warning("zmq is not available; not publishing metrics on %s",
+                      zmq_addr)
+            return
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            self.zmq_addr = None
+        socket = zmq.Context.instance().socket(zmq.PUB)
+        try:
+            socket.bind(zmq_addr)
+        except zmq.ZMQError as exc:
+            socket.close()
+            L.warning("Can't bind %s (%s); not publishing metrics",
+                      zmq_addr, exc)
+            return
+        self.socket = socket
+        self.zmq_addr = zmq_addr
+
+    def publish(self, snapshots, now=None):
+        '''
+        Publish *snapshots*, a list of LoggerMetrics.snapshot()
+        dictionaries.
+        '''
+        if now is None:
+            now = time.time()
+        msg = json.dumps(dict(time=round(now, 3),
+                              loggers=dict((s['name'], s)
+                                           for s in snapshots)),
+                         sort_keys=True)
+        if self.filename:
+            tmp = self.filename + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    f.write(msg)
+                os.rename(tmp, self.filename)
+                self.write_failed = False
+            except (IOError, OSError) as e:
+                if not self.write_failed:
+                    L.warning("Can't write logger metrics %s: %s",
+                              self.filename, e)
+                    self.write_failed = True
+        if self.socket is not None:
+            try:
+                self.socket.send_string('%s %s' % (topic, msg), zmq.NOBLOCK)
+            except zmq.ZMQError:
+                L.debug("logger metrics not sent on %s", self.zmq_addr)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+def read_metrics(filename=None):
+    ''' The last published metrics, or None if there are none. '''
+    if filename is None:
+        filename = default_filename()
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def summary_lines(metrics, now=None, stale=60):
+    '''
+    Lines describing *metrics* (from read_metrics), with a warning
+    if they are more than *stale* seconds old.
+    '''
+    if metrics is None:
+        return ['no logger metrics available']
+    if now is None:
+        now = time.time()
+    age = now - metrics['time']
+    lines = ['logger metrics at %s UTC' %
+             time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime(metrics['time']))]
+    if age > stale:
+        lines.append('  ** metrics are %.0f s old; DAS may not be running **'
+                     % age)
+    for name in sorted(metrics['loggers']):
+        snap = metrics['loggers'][name]
+        logging_str = '' if snap.get('logging', True) else '  (not logging)'
+        lines.append('  ' + summary_line(snap) + logging_str)
+    return lines
+
+
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [filename]')
+    o, a = op.parse_args()
+    filename = a[0] if a else None
+    print('\n'.join(summary_lines(read_metrics(filename))))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,11 +9,18 @@ from six.moves.tkinter import *
 from six.moves.tkinter_simpledialog import SimpleDialog
 
 import time, sys, os
+import signal
 import tempfile
-from subprocess import Popen, PIPE
+import shlex
+from collections import deque
+from subprocess import Popen, DEVNULL
 
 from pycurrents.system.tkTimeout import Timeout
 
+from uhdas.serial.port_inventory import get_inventory, pid_alive
+from uhdas.serial.logger_metrics import LoggerMetrics, MetricsPublisher
+from uhdas.system.proc_table import get_table
+
 def get_time_string():
     return time.strftime('%H:%M:%S',time.gmtime(time.time()))
 
@@ -28,6 +35,12 @@ def check_path(p, mode = 0o775):
             print("Check Permissions!")
             sys.exit(1)
 
+def _ignore_interrupts():
+    # As for a background job of the shell that used to launch the
+    # loggers: Ctrl-C in the monitor's terminal must not stop them.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGQUIT, signal.SIG_IGN)
+
 class LockError(Exception):
     pass
 
@@ -41,15 +54,18 @@ class DuplicateDeviceError(Exception):
 class Tracker(Frame):
     fmt = '%Y/%m/%d %H:%M:%S'
 
-    def __init__(self, master = None, timeout = 10000):
+    def __init__(self, master = None, timeout = 10000, name = 'generic'):
         Frame.__init__(self, master)
         self.config(relief = GROOVE, bd = 2)
 
+        self.metrics = LoggerMetrics(name)
+
         self.ErrorCount = 0
         self.GoodCount = 0
         self.StartTime = time.time()
         self.LastErrorTime = 0
         self.LastGoodTime = 0
+        self.shown = (0, 0)     # counts last shown in the widgets
 
         self.SV_GoodCount = StringVar()
         self.SV_GoodCount.set('0')
@@ -91,21 +107,35 @@ class Tracker(Frame):
         # distinguished "logging is off" from "logging is on but failing".
 
     def update(self, ok):
+        self.count(ok)
+        self.show()
+
+    def count(self, ok, t = None, nbytes = 0):
+        """ Count one line, without touching the widgets. """
+        if t is None:
+            t = time.time()
+        self.metrics.count(ok, nbytes, t)
         if ok:
             self.GoodCount = self.GoodCount + 1
-            self.LastGoodTime = time.time()
+            self.LastGoodTime = t
+        else:
+            self.ErrorCount = self.ErrorCount + 1
+            self.LastErrorTime = t
+
+    def show(self):
+        """ Bring the widgets up to date with the counts. """
+        if self.GoodCount != self.shown[0]:
             self.SV_GoodCount.set('%d' % self.GoodCount)
             self.SV_LastGoodTime.set(
                      time.strftime(Tracker.fmt, time.gmtime(self.LastGoodTime)))
             self.L_LastGoodTime.config(bg = 'white')
             self.timeout.start()
             self.IV_timed_out.set(0)
-        else:
-            self.ErrorCount = self.ErrorCount + 1
-            self.LastErrorTime = time.time()
+        if self.ErrorCount != self.shown[1]:
             self.SV_ErrorCount.set('%d' % self.ErrorCount)
             self.SV_LastErrorTime.set(
                      time.strftime(Tracker.fmt, time.gmtime(self.LastErrorTime)))
+        self.shown = (self.GoodCount, self.ErrorCount)
 
     def write(self, fp):
         fp.write('Error statistics at ' +
@@ -134,6 +164,9 @@ class LogProcess(object):  # mainly a data structure for ser_adcp parameters
         self.directory = directory
         self.instrument = instrument
         self.yearbase = yearbase
+        self.proc = None           # Popen of the last launch
+        self.t_launch = None
+        self.start_latency = None  # seconds from launch to lock file
 
         pipe_directory = '/tmp/SerialLogger'
 
@@ -160,65 +193,139 @@ class LogProcess(object):  # mainly a data structure for ser_adcp parameters
             pass
 
 
-    def new_connection(self, start_time = None):
-        temp_stderr = os.path.join(tempfile.gettempdir(), 'stderr.%s' % self.device)
-        if start_time:
-            T_opt = " -T %d " % start_time
-        else:
-            T_opt = ""
-        redirection = "2> %s" % temp_stderr     # Bash
+    def command_args(self, start_time = None):
+        ''' The logger command line, as a list for Popen (no shell). '''
         if self.program.endswith('zmq_asc'):
-            command = "%s -y %d -Z %s -d %s -i %s -o %s %s %s %s &" %  (
-                     self.program, self.yearbase,
-                     self.device_path,  self.directory,
-                     self.in_pipe, self.out_pipe, T_opt, self.options,
-                     redirection)
+            args = [self.program, '-y', str(self.yearbase),
+                    '-Z', self.device_path, '-d', self.directory]
         else:  # ser_asc, ser_bin
-            command = "%s -y %d -P %s -b %d -d %s -i %s -o %s %s %s %s &" %  (
-                     self.program, self.yearbase,
-                     self.device_path, self.baud, self.directory,
-                     self.in_pipe, self.out_pipe, T_opt, self.options,
-                     redirection)
-
-        print(command)
-        ret = os.system(command)
-        if ret != 0:
-            raise SystemCommandError("Error in new_connection:\n" \
-                                        + command \
-                                        + "\n returned %d\n" % ret)
-
-        for i in range(10):
-            time.sleep(0.2)
-            if self.is_running():
-                return
-        msg1 = 'Error in new_connection: %s failed to start.\n' % self.program
-        msg2 = 'Command: %s\n' % command
-        msg3 = file(temp_stderr).read()
-        raise SystemCommandError(msg1 + msg2 + msg3)
+            args = [self.program, '-y', str(self.yearbase),
+                    '-P', self.device_path, '-b', str(self.baud),
+                    '-d', self.directory]
+        args += ['-i', self.in_pipe, '-o', self.out_pipe]
+        if start_time:
+            args += ['-T', '%d' % start_time]
+        # Options were written for the shell, e.g. with quoted
+        # NMEA strings, so split them the way it would.
+        return args + shlex.split(self.options)
 
-    def is_running(self, kill=False):
+    def launch(self, start_time = None):
+        '''
+        Start the logger without waiting for it; ready() then says
+        when it has locked its port.  Its stderr goes to a file,
+        which is read if it fails to start.
+        '''
+        self.temp_stderr = os.path.join(tempfile.gettempdir(),
+                                        'stderr.%s' % self.device)
+        args = self.command_args(start_time)
+        print(' '.join(args))
+        self.start_latency = None
+        self.t_launch = time.time()
         try:
-            lockfile = open(self.lock_file, 'r')
-            pid = int(lockfile.readline().split()[0])
-            lockfile.close()
-            if pid == os.getpid():
-                return 0 # The lock is held by this process, not by a ser_* process.
-            os.kill(pid, 0) # raises OSError if no such pid
-            if kill:
-                os.kill(pid, 9)
-                try:
-                    os.remove(lockfile)
-                except:
-                    pass
-                return 2
-            return 1
-        except (OSError, IOError, ValueError):
-            pass
-        except Exception as e:
-            print(e)
-        return 0
+            with open(self.temp_stderr, 'wb') as err:
+                self.proc = Popen(args, stdin=DEVNULL, stdout=DEVNULL,
+                                  stderr=err, close_fds=True,
+                                  preexec_fn=_ignore_interrupts)
+        except OSError as e:
+            raise SystemCommandError("Error in new_connection:\n%s\n%s\n"
+                                     % (' '.join(args), e))
+
+    def ready(self):
+        '''
+        Return True once the launched logger holds its lock file;
+        raise SystemCommandError if it has exited with an error.
+        '''
+        if self.is_running():
+            if self.start_latency is None:
+                self.start_latency = time.time() - self.t_launch
+            return True
+        ret = self.proc.poll()
+        if ret:        # 0 would be a logger that detached itself
+            self.start_failed('exited with status %d' % ret)
+        return False
+
+    def start_failed(self, why):
+        msg1 = 'Error in new_connection: %s failed to start (%s).\n' % (
+                                                        self.program, why)
+        msg2 = 'Command: %s\n' % ' '.join(self.proc.args)
+        try:
+            msg3 = open(self.temp_stderr).read()
+        except (IOError, OSError):
+            msg3 = ''
+        raise SystemCommandError(msg1 + msg2 + msg3)
 
+    def new_connection(self, start_time = None):
+        latencies, errors = start_loggers([self], start_time)
+        if errors:
+            raise errors[self.instrument]
 
+    def is_running(self, kill=False):
+        inventory = get_inventory(lock_dir=os.path.dirname(self.lock_file))
+        pid = inventory.lock_pid(os.path.basename(self.lock_file))
+        if pid is None or pid == os.getpid():
+            return 0 # No lock, or it is held by this process, not by a ser_* process.
+        if self.proc is not None and pid == self.proc.pid:
+            alive = self.proc.poll() is None  # reaps it if it has died
+        else:
+            alive = pid_alive(pid)
+        if not alive:
+            return 0
+        if kill:
+            try:
+                os.kill(pid, 9)
+            except OSError:
+                return 0
+            if self.proc is not None and pid == self.proc.pid:
+                self.proc.wait()
+            try:
+                os.remove(self.lock_file)
+            except OSError:
+                pass
+            return 2
+        return 1
+
+
+
+
+def start_loggers(procs, start_time = None, timeout = 2.0, poll = 0.01):
+    '''
+    Launch the LogProcesses *procs* together, then wait up to
+    *timeout* seconds for all of them to lock their ports; the
+    lock files are watched through the port inventory, so polling
+    is cheap.  Return {instrument: start latency in seconds} for
+    those that started, and {instrument: SystemCommandError} for
+    those that did not.
+    '''
+    errors = {}
+    pending = []
+    for lp in procs:
+        try:
+            lp.launch(start_time)
+            pending.append(lp)
+        except SystemCommandError as e:
+            errors[lp.instrument] = e
+    deadline = time.time() + timeout
+    while pending:
+        for lp in pending[:]:
+            try:
+                if lp.ready():
+                    pending.remove(lp)
+            except SystemCommandError as e:
+                errors[lp.instrument] = e
+                pending.remove(lp)
+        if not pending or time.time() > deadline:
+            break
+        time.sleep(poll)
+    for lp in pending:
+        try:
+            lp.start_failed('no lock file after %.1f s' % timeout)
+        except SystemCommandError as e:
+            errors[lp.instrument] = e
+    latencies = dict((lp.instrument, lp.start_latency) for lp in procs
+                     if lp.start_latency is not None)
+    for name in sorted(latencies):
+        print("Started %s in %.3f s" % (name, latencies[name]))
+    return latencies, errors
 
 
 class LogControl(object):  # mixin for Logger and Loggers
@@ -269,7 +376,9 @@ class LogControl(object):  # mixin for Logger and Loggers
 class Loggers(Frame, LogControl):
     def __init__(self, master = None, yearbase = 2001,
                       quit_button = 1,
-                      bindir = '/usr/local/bin'):
+                      bindir = '/usr/local/bin',
+                      metrics_file = None, metrics_pub = None,
+                      metrics_interval = 10):
         self.self_controlled = 0
         if master == None:
             master = Tk()
@@ -288,11 +397,18 @@ class Loggers(Frame, LogControl):
                                   # to keep both. We need at least one list
                                   # to keep track of the display order.)
         self.EnabledDict = dict() # True by default; can be set to False
+        self.start_latencies = {} # instrument: seconds, at the last start
         self.is_logging = 0
         if self.self_controlled:
             self.make_FB(quit_button = quit_button)
             self.FB.pack(side = TOP, expand = YES)
         self.bind('<Destroy>', self.close_monitor)
+        # Metrics of all loggers, to metrics_file and/or zmq if
+        # given, every metrics_interval seconds.
+        self.publisher = MetricsPublisher(metrics_file, metrics_pub)
+        self.metrics_interval = metrics_interval
+        self.metrics_id = self.after(int(metrics_interval * 1000),
+                                     self.publish_metrics)
 
     def add(self,  device = 'ttyS0', baud = 9600, program = 'ser_asc',
                    options = '', directory = './',
@@ -310,6 +426,33 @@ class Loggers(Frame, LogControl):
         self.LogWinDict[instrument] = LoggerInstance
         self.EnabledDict[instrument] = True
 
+    def metrics(self, now = None):
+        """ Snapshots of the LoggerMetrics of all loggers. """
+        if now is None:
+            now = time.time()
+        snapshots = []
+        for LW in self.LogWins:
+            snap = LW.stats.metrics.snapshot(now)
+            snap['logging'] = bool(LW.is_logging)
+            snap['enabled'] = self.getEnabled(LW.logproc.instrument)
+            snapshots.append(snap)
+        return snapshots
+
+    def publish_metrics(self):
+        self.publisher.publish(self.metrics())
+        self.metrics_id = self.after(int(self.metrics_interval * 1000),
+                                     self.publish_metrics)
+
+    def stop_metrics(self):
+        """ Publish a last time, and stop. """
+        if self.metrics_id is None:
+            return
+        self.after_cancel(self.metrics_id)
+        self.metrics_id = None
+        if self.LogWins:
+            self.publisher.publish(self.metrics())
+        self.publisher.close()
+
     def setEnabled(self, instrument, value):
         self.EnabledDict[instrument] = value
 
@@ -376,11 +519,13 @@ class Loggers(Frame, LogControl):
 
     def close_monitor(self, event = ''):
         if not self.LogWins:
+            self.stop_metrics()
             return
         if self.self_controlled:
             if self.check_stop_logging(): # still logging
                 if not self.confirm_close():
                     return # jump out
+        self.stop_metrics()
         for LW in self.LogWins:
             LW.close_monitor()
         self.LogWins = []
@@ -396,10 +541,19 @@ class Loggers(Frame, LogControl):
         if self.is_logging:
             return
         self.is_logging = 1
-        for LW in self.LogWins:
-            if self.getEnabled(LW.logproc.instrument):
+        # Launch all the loggers that are not already running, wait
+        # for them together, then connect to each.
+        starting = [LW for LW in self.LogWins
+                       if self.getEnabled(LW.logproc.instrument)]
+        launch = [LW.logproc for LW in starting
+                     if not LW.is_logging and not LW.logproc.is_running()]
+        self.start_latencies, errors = start_loggers(launch, start_time)
+        for LW in starting:
+            if LW.logproc.instrument in errors:
+                print(errors[LW.logproc.instrument])
+            else:
                 LW.start_logging(start_time)
-                LW.stats.timeout_warning()    # red until first data arrival
+            LW.stats.timeout_warning()    # red until first data arrival
         if hasattr(self, 'BE'):
             self.BS.configure(state = DISABLED)
             self.BE.configure(state = NORMAL)
@@ -507,7 +661,8 @@ class Logger(Frame, LogControl):
         self.is_logging = 0
 
         self.StatusLine().pack(side = LEFT, expand = NO, pady = 1)
-        self.stats = Tracker(self, timeout = timeout)
+        self.stats = Tracker(self, timeout = timeout,
+                             name = logproc.instrument)
         self.stats.pack(padx = 5, pady = 5, side = LEFT)
 
         self.control = control
@@ -515,7 +670,13 @@ class Logger(Frame, LogControl):
             self.make_FB()
 
         self.pingline = StringVar()
-        self.lines = [''] * self.nlines
+        self.lines = deque([''] * self.nlines, maxlen = self.nlines)
+        self.partial = b''         # start of a line not yet complete
+        self.line_ok = None        # state of the last line, for the colour
+        self.shown_ok = None
+        self.max_shows = 4         # widget updates per second, at most
+        self.last_show = 0
+        self.show_pending = None   # id of a scheduled show_lines
 
         self.MP = Checkbutton(self, textvariable = self.pingline,
                              variable = self.stats.IV_timed_out,
@@ -556,6 +717,9 @@ class Logger(Frame, LogControl):
     def stop_logging(self, cmd_stop = True):
         if not self.is_logging:   return
         self.tk.deletefilehandler(self.fp)
+        if self.show_pending is not None:
+            self.after_cancel(self.show_pending)
+            self.show_lines()
         if cmd_stop:
             self.fp.close()
             cp = open(self.commandpipename, 'wb')
@@ -573,6 +737,9 @@ class Logger(Frame, LogControl):
         if self.is_logging:
             self.tk.deletefilehandler(self.fp)
             self.fp.close()
+        if self.show_pending is not None:
+            self.after_cancel(self.show_pending)
+            self.show_pending = None
         try:
             os.remove(self.logproc.pipe_lock_file)
         except OSError:
@@ -590,6 +757,7 @@ class Logger(Frame, LogControl):
             self.connect_pipe(self.logproc.out_pipe,
                               self.logproc.in_pipe,
                               self.logproc.pipe_lock_file)
+            self.stats.metrics.restart()
             self.MS.configure(fg = 'green')
         except Exception as msg:
             print(msg)
@@ -598,10 +766,7 @@ class Logger(Frame, LogControl):
         try:
             lockfile = open(lockfilename, 'r')
             pid = int(lockfile.readline())
-            cmd = ['ps', '--noheader', '-p%s' % pid, '-o', 'pid']
-            (psout, err) = Popen(cmd, stdout=PIPE,
-                                    stderr=PIPE).communicate()
-            if int(psout) == pid:
+            if get_table().get(pid) is not None:
                 return pid
         except (OSError, IOError, ValueError):
             pass
@@ -625,29 +790,66 @@ class Logger(Frame, LogControl):
         self.commandpipename = commandpipename
         fd = os.open(self.datapipename, os.O_RDONLY| os.O_NONBLOCK)
         self.fp = os.fdopen(fd, 'rb')
+        self.partial = b''
         self.tk.createfilehandler(self.fp, READABLE, self.pipe_reader)
         self.SV_Status.set('Logging')
         self.is_logging = 1
 
     def pipe_reader(self, fp, mask):
-        try:
-            _line = fp.readline()
-            if len(_line) == 0:  # Older python/linux: broken pipe.
-                                 # Newer version raises IOError.
-                raise IOError('broken pipe')
-        except IOError:
+        """
+        Read everything available, count each complete line, and
+        keep the last few; the widgets are updated from
+        show_lines, at most max_shows times per second.
+        """
+        chunks = [self.partial]
+        broken = False
+        while True:
+            try:
+                data = os.read(fp.fileno(), 65536)
+            except BlockingIOError:
+                break
+            except (IOError, OSError):
+                broken = True
+                break
+            if not data:     # writer has gone
+                broken = True
+                break
+            chunks.append(data)
+        lines = b''.join(chunks).split(b'\n')
+        self.partial = lines.pop()
+        now = time.time()
+        for _line in lines:
+            line = _line.strip().decode('ascii', 'ignore')
+            self.lines.append(line)
+            self.line_ok = line.lower().find('error') == -1
+            self.stats.count(self.line_ok, now, len(_line) + 1)
+        if broken:
+            self.show_lines()
             self.stop_logging(False)
             return
-        line = _line.strip().decode('ascii', 'ignore')
-        self.lines = self.lines[-(self.nlines - 1):] + [line]
+        if lines:
+            self.schedule_show(now)
+
+    def schedule_show(self, now):
+        if self.show_pending is not None:
+            return
+        wait = self.last_show + 1.0 / self.max_shows - now
+        if wait <= 0:
+            self.show_lines()
+        else:
+            self.show_pending = self.after(int(wait * 1000) + 1,
+                                           self.show_lines)
+
+    def show_lines(self):
+        self.show_pending = None
+        self.last_show = time.time()
         self.pingline.set("\n".join(self.lines))
         # Lines are separated by \n, but there is no trailing \n;
         # so we don't have a blank line at the bottom of the message window.
-
-        if line.lower().find('error') > -1:
-            self.MP.config(background = 'pink')
-            ok = 0
-        else:
-            self.MP.config(background = 'lightgreen')
-            ok = 1
-        self.stats.update(ok)
+        if self.line_ok is not None and self.line_ok != self.shown_ok:
+            if self.line_ok:
+                self.MP.config(background = 'lightgreen')
+            else:
+                self.MP.config(background = 'pink')
+            self.shown_ok = self.line_ok
+        self.stats.show()
@@ -16,6 +16,7 @@ import time, termios
 import os
 
 from uhdas.serial.tk_terminal import Tk_terminal
+from uhdas.serial.termstats import Stopwatch
 
 import logging
 L = logging.getLogger('oswh_term')
@@ -122,12 +123,13 @@ class terminal(Tk_terminal):
                 L.debug("sending break %d", ii + 1)
                 self.send_break(400)    # at least 300 msec for Ocean Surveyor
                 L.debug("break sent")
-                L.debug("buffer: %s", self.buffer)
-                self.waitfor(b'>', timeout=3, quiet=0.5)
+                L.debug("buffer: %s", self.buffer.getvalue())
+                with Stopwatch(self.latency, 'break'):
+                    self.waitfor(b'>', timeout=3, quiet=0.5)
                 break
             except:
                 L.error("failure waiting for prompt", exc_info = True)
-                L.debug("buffer: %s", self.buffer.decode('ascii', 'ignore'))
+                L.debug("buffer: %s", self.buffer.getvalue().decode('ascii', 'ignore'))
                 if ii == 2:
                     raise
         L.debug("sending TS?")
@@ -162,10 +164,12 @@ class terminal(Tk_terminal):
         for cmd in commands:
             print(cmd)
             cmd = cmd.rstrip().encode('ascii', 'ignore')
-            os.write(self.fd, cmd + b'\r')
-            termios.tcdrain(self.fd)
-            #print "sent %s" % cmd.rstrip()
-            self.waitfor(b'>', 3)
+            with Stopwatch(self.latency, cmd):
+                os.write(self.fd, cmd + b'\r')
+                termios.tcdrain(self.fd)
+                #print "sent %s" % cmd.rstrip()
+                self.waitfor(b'>', 3)
+        L.debug("Command latency: %s", self.latency.summary())
 
     def run_diagnostics(self):
         self.wakeup()
@@ -260,11 +264,9 @@ class terminal(Tk_terminal):
         self.stream.flush()
         termios.tcdrain(self.fd)
         self.waitfor(b'>', 2)
-        self.change_baud(baud)
-        time.sleep(0.5) # ad hoc; without delay, local serial port
-                        # baud rate does not seem to take effect
-                        # before we send a command and receive
-                        # a response.
+        t_changed = time.time()
+        self.change_baud(baud, settle=False)
+        self.settle_baud(baud, t_changed)
 
 
     def make_menu(self, master):
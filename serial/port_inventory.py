@@ -0,0 +1,416 @@
+'''
+Inventory of serial ports and of their lock files.
+
+One PortInventory lists the candidate serial devices in /dev
+(on-board ttyS, USB ttyUSB and ttyACM, and the multiport cards),
+with what sysfs says about each: the driver, whether a ttyS has a
+UART behind it, and for USB adapters the vendor and product ids,
+serial number and /dev/serial/by-id name.  It also reads the UUCP
+lock files (LCK..name) in the lock directory, with the pid of
+each owner and whether that process is alive.
+
+Both lists are cached.  With inotify (Linux, through ctypes) a
+list is read again only after an event in its directory, i.e. a
+device being added or removed or a lock file being written or
+removed; elsewhere the directory mtime is checked.  Liveness of a
+lock owner is checked on each query, since a process can die
+without touching its lock file.  All users in a process share one
+inventory (get_inventory), so sp_lock.is_locked,
+LogProcess.is_running and the device pickers all ask it rather
+than opening files and signalling pids themselves.
+
+    python -m uhdas.serial.port_inventory [--all]
+
+lists the ports.
+'''
+from __future__ import print_function
+
+import os, re, time, errno
+import ctypes, ctypes.util
+from threading import Lock
+
+import logging
+L = logging.getLogger()
+
+# Names of serial devices: on-board, USB, and multiport cards
+# (Cyclades, Comtrol RocketPort, Digi, Moxa, ...).
+device_re = re.compile(r'^(?P<kind>ttyUSB|ttyACM|ttyAMA|ttyMI|ttyS|ttyC|'
+                       r'ttyR|ttyn|ttyM|ttyD|tty_d)\w*\d$')
+
+lock_prefix = 'LCK..'
+
+
+def lock_name(device):
+    ''' The lock file name (no directory) for *device*. '''
+    return lock_prefix + os.path.basename(device)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError, UnicodeDecodeError):
+        return None
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM     # alive, but not ours
+    return True
+
+
+class PortInfo(object):
+    def __init__(self, device, kind):
+        self.device = device
+        self.name = os.path.basename(device)
+        self.kind = kind
+        self.present = True       # False for a ttyS with no UART
+        self.driver = None
+        self.vendor_id = None     # USB, as 4 hex digits
+        self.product_id = None
+        self.serial = None
+        self.manufacturer = None
+        self.product = None
+        self.by_id = None         # /dev/serial/by-id/... link
+
+    def describe(self):
+        ''' One line naming the port and what is known about it. '''
+        parts = [self.device]
+        if self.vendor_id:
+            parts.append('%s:%s' % (self.vendor_id, self.product_id))
+            desc = ' '.join(s for s in (self.manufacturer, self.product) if s)
+            if desc:
+                parts.append(desc)
+            if self.serial:
+                parts.append('serial %s' % self.serial)
+        elif self.driver:
+            parts.append(self.driver)
+        if not self.present:
+            parts.append('(no UART)')
+        return '  '.join(parts)
+
+    def __repr__(self):
+        return 'PortInfo(%r)' % self.device
+
+
+def _sysfs_info(info, sys_dir):
+    base = os.path.join(sys_dir, info.name)
+    if not os.path.isdir(base):
+        return
+    dev = os.path.join(base, 'device')
+    driver = os.path.join(dev, 'driver')
+    if os.path.islink(driver):
+        info.driver = os.path.basename(os.readlink(driver))
+    if info.kind == 'ttyS':
+        port_type = _read(os.path.join(base, 'type'))
+        info.present = port_type not in (None, '0')
+        return
+    # USB: walk up from the interface to the device with the ids.
+    path = os.path.realpath(dev)
+    while path != '/' and path.startswith('/sys/'):
+        vid = _read(os.path.join(path, 'idVendor'))
+        if vid is not None:
+            info.vendor_id = vid
+            info.product_id = _read(os.path.join(path, 'idProduct'))
+            info.serial = _read(os.path.join(path, 'serial'))
+            info.manufacturer = _read(os.path.join(path, 'manufacturer'))
+            info.product = _read(os.path.join(path, 'product'))
+            return
+        path = os.path.dirname(path)
+
+
+# inotify, if libc has it.
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _libc.inotify_init1
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc
+
+
+class DirWatch(object):
+    '''
+    Says whether any of some directories has changed since the
+    last call to changed(): by inotify where possible, otherwise by
+    comparing mtimes.  By default only entries being added, removed
+    or renamed count; with *mask* = DirWatch.contents_mask, so do
+    files written in place.  /dev sees a stream of IN_ATTRIB and
+    IN_MODIFY events from terminal activity, so those are watched
+    only where needed, e.g. for lock files.
+    '''
+    entries_mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+    contents_mask = entries_mask | IN_ATTRIB | IN_CLOSE_WRITE | IN_MODIFY
+
+    def __init__(self, dirs, mask=entries_mask):
+        self.dirs = [d for d in dirs if os.path.isdir(d)]
+        self.mask = mask
+        self.fd = None
+        self.mtimes = None
+        libc = _get_libc()
+        if libc:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                ok = all(libc.inotify_add_watch(fd, d.encode(), self.mask) >= 0
+                         for d in self.dirs)
+                if ok:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+        self.first = True
+
+    def _mtimes(self):
+        result = []
+        for d in self.dirs:
+            try:
+                result.append(os.stat(d).st_mtime_ns)
+            except OSError:
+                result.append(None)
+        return result
+
+    def changed(self):
+        if self.first:
+            self.first = False
+            if self.fd is None:
+                self.mtimes = self._mtimes()
+            return True
+        if self.fd is None:
+            mtimes = self._mtimes()
+            changed = mtimes != self.mtimes
+            self.mtimes = mtimes
+            return changed
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            changed = True
+        return changed
+
+    @property
+    def uses_inotify(self):
+        return self.fd is not None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PortInventory(object):
+    def __init__(self, dev_dir='/dev', lock_dir='/var/lock',
+                 sys_dir='/sys/class/tty'):
+        self.dev_dir = dev_dir
+        self.lock_dir = lock_dir
+        self.sys_dir = sys_dir
+        self.lock = Lock()
+        by_id = os.path.join(dev_dir, 'serial', 'by-id')
+        self.dev_watch = DirWatch([dev_dir, by_id])
+        self.lock_watch = DirWatch([lock_dir], DirWatch.contents_mask)
+        self._ports = {}
+        self._locks = {}       # lock file name: pid, or None if unreadable
+        self.nscans = 0
+
+    # Devices
+
+    def _scan_ports(self):
+        ports = {}
+        try:
+            names = os.listdir(self.dev_dir)
+        except OSError:
+            names = []
+        for name in names:
+            m = device_re.match(name)
+            if m:
+                info = PortInfo(os.path.join(self.dev_dir, name),
+                                m.group('kind'))
+                _sysfs_info(info, self.sys_dir)
+                ports[info.device] = info
+        by_id = os.path.join(self.dev_dir, 'serial', 'by-id')
+        try:
+            links = os.listdir(by_id)
+        except OSError:
+            links = []
+        for link in links:
+            path = os.path.join(by_id, link)
+            target = os.path.realpath(path)
+            if target in ports:
+                ports[target].by_id = path
+        self._ports = ports
+        self.nscans += 1
+
+    def _update_ports(self):
+        if self.dev_watch.changed():
+            self._scan_ports()
+
+    def ports(self, present_only=True):
+        ''' PortInfo for each port, sorted by kind and number. '''
+        with self.lock:
+            self._update_ports()
+            ports = list(self._ports.values())
+        if present_only:
+            ports = [p for p in ports if p.present]
+        key = lambda p: (p.kind, [int(s) if s.isdigit() else s
+                                  for s in re.split(r'(\d+)', p.name)])
+        return sorted(ports, key=key)
+
+    def port(self, device):
+        ''' PortInfo for *device* (a path or name), or None. '''
+        device = self._path(device)
+        with self.lock:
+            self._update_ports()
+            return self._ports.get(os.path.realpath(device),
+                                   self._ports.get(device))
+
+    def exists(self, device):
+        ''' True if *device* exists; ports not in the inventory (e.g.
+        a pty) are looked for directly.
+        '''
+        device = self._path(device)
+        if self.port(device) is not None:
+            return True
+        if device_re.match(os.path.basename(device)) and \
+                os.path.dirname(device) == self.dev_dir:
+            return False
+        return os.path.exists(device)
+
+    def _path(self, device):
+        if os.sep not in device:
+            return os.path.join(self.dev_dir, device)
+        return device
+
+    # Locks
+
+    def _read_pid(self, name):
+        line = _read(os.path.join(self.lock_dir, name))
+        try:
+            return int(line.split()[0])
+        except (AttributeError, IndexError, ValueError):
+            return None
+
+    def _update_locks(self):
+        if self.lock_watch.changed():
+            try:
+                names = os.listdir(self.lock_dir)
+            except OSError:
+                names = []
+            self._locks = dict((n, self._read_pid(n)) for n in names
+                               if n.startswith(lock_prefix))
+        else:
+            # A file caught between creation and the write of its pid.
+            for n, pid in self._locks.items():
+                if pid is None:
+                    self._locks[n] = self._read_pid(n)
+
+    def lock_pid(self, name):
+        ''' Pid in lock file *name* (e.g. "LCK..ttyS0"), or None. '''
+        with self.lock:
+            self._update_locks()
+            return self._locks.get(name)
+
+    def locks(self):
+        ''' {lock file name: (pid, alive)} for all lock files. '''
+        with self.lock:
+            self._update_locks()
+            locks = dict(self._locks)
+        return dict((n, (pid, pid is not None and pid_alive(pid)))
+                    for n, pid in locks.items())
+
+    def lock_status(self, device, remove_stale=True):
+        '''
+        Return (status, pid) for the lock of *device*, status being
+        0 if not locked (a lock of a dead process is removed if
+        *remove_stale*), 1 if locked by this process, 2 if locked by
+        another running process (or the lock file has no pid yet).
+        '''
+        name = lock_name(device)
+        with self.lock:
+            self._update_locks()
+            if name not in self._locks:
+                return 0, 0
+            pid = self._locks[name]
+        if pid is None:
+            # Being written, or not a pid; either way, not ours.
+            return 2, 0
+        if pid == os.getpid():
+            return 1, pid
+        if pid_alive(pid):
+            return 2, pid
+        if remove_stale:
+            try:
+                os.remove(os.path.join(self.lock_dir, name))
+            except OSError as e:
+                L.warning("removing stale lock %s: %s", name, e)
+        return 0, pid
+
+    def summary_lines(self, present_only=True):
+        locks = self.locks()
+        lines = []
+        for p in self.ports(present_only):
+            s = p.describe()
+            pid, alive = locks.get(lock_name(p.device), (None, False))
+            if pid is not None:
+                s += '  locked by %d%s' % (pid, '' if alive else ' (dead)')
+            if p.by_id:
+                s += '\n    ' + p.by_id
+            lines.append(s)
+        return lines
+
+    def close(self):
+        self.dev_watch.close()
+        self.lock_watch.close()
+
+
+_inventories = {}
+_inventories_lock = Lock()
+
+
+def get_inventory(dev_dir='/dev', lock_dir='/var/lock'):
+    ''' The PortInventory for *dev_dir* and *lock_dir*, shared. '''
+    key = (dev_dir, lock_dir)
+    with _inventories_lock:
+        if key not in _inventories:
+            _inventories[key] = PortInventory(dev_dir, lock_dir)
+        return _inventories[key]
+
+
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [--all]')
+    op.add_option('-a', '--all', dest='all', action='store_true',
+                  default=False,
+                  help='include ttyS ports with no UART')
+    o, a = op.parse_args()
+    t0 = time.time()
+    inv = get_inventory()
+    lines = inv.summary_lines(present_only=not o.all)
+    print('\n'.join(lines) or 'no serial ports found')
+    print('(%d ports, %.3f s, %s)' % (len(lines), time.time() - t0,
+                                      'inotify' if inv.dev_watch.uses_inotify
+                                      else 'mtime'))
+
+
+if __name__ == '__main__':
+    main()
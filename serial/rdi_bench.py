@@ -0,0 +1,184 @@
+'''
+Benchmarks for the RDI terminal, run against the pty simulator
+(rdi_sim), so they need no hardware:
+
+  - wakeup: break to banner, and the whole RdiProtocol.wakeup;
+  - rtt: round-trip time of single commands (TS?);
+  - setup: sending a command file, from wakeup check to CS, and
+    the mean round trip of its commands;
+  - baud change: change_all_baud to the data rate and back;
+  - download: YMODEM download of a recorder file, in MB/s,
+    and the whole download with verification.
+
+    python -m uhdas.serial.rdi_bench [--model WH] [--mbytes 2] [--json out.json]
+
+Timings are in seconds.  Run it before and after a change to
+the terminal to see what the change did; --delay, --pace,
+--noise and --settle make the simulated instrument slower or less
+reliable.
+'''
+from __future__ import print_function
+
+import os, time
+import json
+import shutil
+import tempfile
+
+import logging
+L = logging.getLogger()
+
+from uhdas.serial.rdi_engine import RdiEngine
+from uhdas.serial.rdi_sim import RdiSimulator, SyntheticRecorder
+
+# A typical LADCP master setup (cmd_files/300khz_master.cmd).
+setup_commands = ['PS0', 'OL', 'CR1', 'WM15', 'TC2', 'TB 00:00:02.00',
+                  'TE 00:00:00.80', 'TP 00:00.00', 'WP 1', 'WN016', 'WS1600',
+                  'WF1600', 'WV350', 'EZ0011101', 'EX00100', 'CF11101',
+                  'SM1', 'SA011', 'SW05000', 'T?', 'L?', 'TS?', 'CS']
+
+
+class Timings(object):
+    ''' Named lists of measurements. '''
+    def __init__(self):
+        self.values = {}
+        self.units = {}
+
+    def add(self, name, value, units='s'):
+        self.values.setdefault(name, []).append(value)
+        self.units[name] = units
+
+    def stats(self, name):
+        v = self.values[name]
+        return dict(n=len(v), mean=sum(v) / len(v), min=min(v), max=max(v),
+                    units=self.units[name])
+
+    def report(self):
+        lines = ['%-18s %4s %10s %10s %10s %6s' % ('benchmark', 'n', 'mean',
+                                                   'min', 'max', 'units')]
+        for name in self.values:
+            st = self.stats(name)
+            lines.append('%-18s %4d %10.4f %10.4f %10.4f %6s'
+                         % (name, st['n'], st['mean'], st['min'], st['max'],
+                            st['units']))
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return dict((name, self.stats(name)) for name in self.values)
+
+
+def benchmark(model='WH', repeat=3, ncommands=20, mbytes=1.0,
+              delay=0.0, wakeup_delay=0.3, pace=False, noise=0.0,
+              baud_settle=0.0, workdir=None):
+    '''
+    Run each benchmark *repeat* times on a new simulator and
+    RdiEngine; return a Timings.
+    '''
+    keep = workdir is not None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='rdi_bench')
+    workdir = os.path.join(workdir, '')
+    cmd_filename = os.path.join(workdir, 'bench.cmd')
+    with open(cmd_filename, 'w') as f:
+        f.write('\n'.join(setup_commands) + '\n')
+
+    recorder = SyntheticRecorder(nbytes=int(mbytes * 1000000))
+    sim = RdiSimulator(model, recorder=recorder, delay=delay,
+                       wakeup_delay=wakeup_delay, pace=pace,
+                       noise=noise, baud_settle=baud_settle).start()
+    R = RdiEngine(device=sim.device, dataLoc=workdir, logLoc=workdir,
+                  cmd_filename=cmd_filename, cruiseName='BENCH',
+                  stacast='000_00', suffix=model.lower())
+    R.soft_break = sim.soft_break
+    T = Timings()
+    try:
+        for i in range(repeat):
+            R.latency.reset()
+            t0 = time.time()
+            R.wakeup()
+            T.add('wakeup', time.time() - t0)
+            T.add('break-banner', R.latency.max)
+            R.sleep()
+
+        R.wakeup()
+        for i in range(repeat):
+            R.latency.reset()
+            R.send_commands(['TS?'] * ncommands)
+            T.add('command RTT', R.latency.mean())
+            T.add('command RTT max', R.latency.max)
+
+        for i in range(repeat):
+            R.latency.reset()
+            t0 = time.time()
+            R.send_setup()
+            T.add('setup', time.time() - t0)
+            T.add('setup command RTT', R.latency.mean())
+            R.wakeup()   # stop pinging
+
+        for i in range(repeat):
+            t0 = time.time()
+            R.change_all_baud()
+            T.add('baud change', time.time() - t0)
+            t0 = time.time()
+            R.change_all_baud(R.default_baud)
+            T.add('baud change', time.time() - t0)
+
+        for i in range(repeat):
+            R.stacastSV.set('%03d_01' % (i + 1))
+            t0 = time.time()
+            R.download()
+            elapsed = time.time() - t0
+            stats = R.ymodem.stats
+            T.add('download', stats.rate() / 1e6, 'MB/s')
+            T.add('download total', elapsed)
+            if stats.nretry():
+                T.add('download retries', stats.nretry(), 'count')
+            R.wake_if_sleeping()
+    finally:
+        R.close_terminal()
+        sim.stop()
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return T
+
+
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [options]')
+    op.add_option('-m', '--model', dest='model', default='WH',
+                  help='WH, BB, or OS; default is WH')
+    op.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+                  help='times to run each benchmark; default is 3')
+    op.add_option('-c', '--commands', dest='ncommands', type='int',
+                  default=20,
+                  help='commands per RTT measurement; default is 20')
+    op.add_option('-s', '--mbytes', dest='mbytes', type='float', default=1.0,
+                  help='size of the recorder file in MB; default is 1')
+    op.add_option('-d', '--delay', dest='delay', type='float', default=0.0,
+                  help='simulated response delay in seconds')
+    op.add_option('-p', '--pace', dest='pace', action='store_true',
+                  default=False,
+                  help='limit output to the simulated baud rate')
+    op.add_option('--noise', dest='noise', type='float', default=0.0,
+                  help='probability of damage to each YMODEM byte')
+    op.add_option('--settle', dest='settle', type='float', default=0.0,
+                  help='seconds the simulated port takes to settle '
+                       'after a baud change')
+    op.add_option('-j', '--json', dest='json', default=None,
+                  help='also write the results to this JSON file')
+    o, a = op.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    T = benchmark(model=o.model, repeat=o.repeat, ncommands=o.ncommands,
+                  mbytes=o.mbytes, delay=o.delay, pace=o.pace,
+                  noise=o.noise, baud_settle=o.settle)
+    print(T.report())
+    if o.json:
+        results = dict(options=vars(o),
+                       time=time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime()),
+                       results=T.as_dict())
+        with open(o.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
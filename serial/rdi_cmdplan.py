@@ -0,0 +1,110 @@
+'''
+Command files compiled into plans for RdiProtocol.send_setup.
+
+A plan is the list of Steps to send: each command of the file,
+with comments ("#", ";" or "$" to the end of the line) and blank
+lines removed, followed by CK and CS, which are always added here
+(any CK or CS in the file is dropped).  Each Step says what ends
+the instrument's reply (the ">" prompt, or the echo for CS, after
+which the instrument starts pinging) and what text the reply must
+contain.
+
+Plans are cached by file name, size and mtime, so a command file
+is read and checked once however many casts use it:
+
+    plan = load_plan('ladcp.cmd')
+    for step in plan.steps:
+        ...
+'''
+
+import os
+
+import logging
+L = logging.getLogger()
+
+prompt = b'>'
+error_mark = b'ERR'
+
+
+class Step(object):
+    __slots__ = ('cmd', 'expect', 'check', 'timeout')
+
+    def __init__(self, cmd, expect=prompt, check=None, timeout=None):
+        '''
+        Send *cmd*; the reply ends with *expect*, and must contain
+        *check* if given.  *timeout* (s of silence) overrides the
+        sender's default.
+        '''
+        self.cmd = cmd
+        self.expect = expect
+        self.check = check
+        self.timeout = timeout
+
+    def __repr__(self):
+        return 'Step(%r, %r)' % (self.cmd, self.expect)
+
+
+# Added at the end of every plan.  The receive buffer has no CRs.
+final_steps = [Step('CK', check=b'[Parameters saved as USER defaults]'),
+               Step('CS', expect=b'CS\n')]
+
+
+def strip_comment(line):
+    ''' The command on *line*, without comments or whitespace. '''
+    for mark in '#;$':
+        line = line.split(mark, 1)[0]
+    return line.strip()
+
+
+def read_commands(fname):
+    '''
+    Return the commands in file *fname*, without comments, and
+    without CK and CS, which are added when sending.
+    '''
+    cmds = []
+    with open(fname, 'r') as f:
+        for line in f:
+            line = strip_comment(line)
+            if not line:
+                continue
+            if line.upper().startswith(('CK', 'CS')):
+                continue
+            cmds.append(line)
+    return cmds
+
+
+class CommandPlan(object):
+    def __init__(self, commands, filename=None):
+        self.filename = filename
+        self.commands = list(commands)
+        self.steps = [Step(cmd) for cmd in self.commands] + final_steps
+        self.stamp = None        # (size, mtime_ns) of the file read
+
+    @classmethod
+    def from_file(cls, fname):
+        st = os.stat(fname)
+        plan = cls(read_commands(fname), filename=fname)
+        plan.stamp = (st.st_size, st.st_mtime_ns)
+        return plan
+
+    def __len__(self):
+        return len(self.steps)
+
+
+_plans = {}
+
+
+def load_plan(fname):
+    '''
+    The CommandPlan of *fname*, compiled again only if the file
+    has changed since it was last read.  Raises IOError or
+    OSError if it cannot be read.
+    '''
+    st = os.stat(fname)
+    stamp = (st.st_size, st.st_mtime_ns)
+    plan = _plans.get(fname)
+    if plan is None or plan.stamp != stamp:
+        plan = CommandPlan.from_file(fname)
+        _plans[fname] = plan
+        L.debug("Compiled %s: %d commands", fname, len(plan.commands))
+    return plan
@@ -0,0 +1,684 @@
+''' RDI (BB, WH) instrument protocol for LADCP deployment and
+recovery, independent of any user interface.
+
+RdiProtocol is a mixin holding the instrument operations; it is
+combined with a TerminalEngine subclass:
+
+  - rditerm.terminal = RdiProtocol + Tk_terminal (the GUI)
+  - RdiEngine = RdiProtocol + TerminalEngine (headless)
+
+so a cast can be driven from a script, e.g.:
+
+    R = RdiEngine(device='/dev/ttyUSB0', dataLoc='./', logLoc='./',
+                  stacast='012_01', suffix='m')
+    R.wakeup()
+    R.set_clock()
+    R.send_setup()
+
+'''
+from __future__ import print_function
+
+import os
+import time, termios
+import stat
+
+import logging
+L = logging.getLogger()
+
+from uhdas.serial.term_engine import TerminalEngine, Timeout
+from uhdas.serial.termstats import Stopwatch
+from uhdas.serial import rdi_verify
+from uhdas.serial import rdi_index
+from uhdas.serial import rdi_quicklook
+from uhdas.serial.rdi_state import RecorderState
+from uhdas.serial.rdi_cmdplan import Step, load_plan, error_mark
+from uhdas.serial.backup import get_backup_queue
+from uhdas.serial.ymodem import YmodemReceiver, YmodemError, YmodemCanceled
+
+
+break_msec = 400
+
+rdi_baud_codes = {300:0, 1200:1, 2400:2,
+                  4800:3, 9600:4, 19200:5,
+                  38400:6, 57600:7, 115200:8}
+
+# data download rates
+default_databauds = {'BB': 38400, 'WH':115200, 'Unrecognized': 9600}
+
+fmt = '%Y/%m/%d  %H:%M:%S'
+
+
+def time_stamp():
+    return time.strftime(fmt, time.gmtime())
+
+
+class RdiProtocol(object):  # mixin for TerminalEngine subclasses
+    def init_rdi(self, baud = 9600,
+                       data_baud = None,
+                       Loggers = None,
+                       cmd_filename = 'ladcp.cmd',
+                       prefix = 'rdi',
+                       suffix = 'rdi',
+                       cruiseName = 'XXNNNN',
+                       backupDir = '',
+                       dataLoc = './',
+                       logLoc = '',
+                       stacast = '000_01',
+                       datafile_ext = '.dat'):
+        self.default_baud = baud
+        self.data_baud = data_baud
+        self.Loggers = Loggers
+        self.cmd_filename = cmd_filename
+        self.prefix = prefix
+        self.suffix = suffix
+        self.cruiseName = self.make_var(cruiseName)
+        self.backupDir = backupDir
+        # One or more backup directories, each ending in '/'.
+        if isinstance(backupDir, (list, tuple)):
+            self.backupDirs = [d for d in backupDir if d]
+        elif backupDir:
+            self.backupDirs = [backupDir]
+        else:
+            self.backupDirs = []
+        self.dataDir = dataLoc
+        self.logDir = logLoc
+        self.stacastSV = self.make_var(stacast)
+        if not datafile_ext.startswith('.'):
+            datafile_ext = '.%s' % datafile_ext
+        self.datafile_ext = datafile_ext
+        self.type = ''         # After wakeup: BB or WH
+        self.state = RecorderState()   # replies since the last wakeup
+        self.setup_time = None # seconds to send the last command file
+        self.canceled = 0
+        self.ymodem = None     # YmodemReceiver of the last download
+        self.start_backups()
+
+    def add_Loggers(self, Loggers):
+        self.Loggers = Loggers
+
+    def start_logging(self):
+        if not self.Loggers:
+            return
+        self.Loggers.start_logging()
+
+    def stop_logging(self):
+        if not self.Loggers:
+            return
+        self.Loggers.check_stop_logging()
+
+    def make_filename(self, ext):
+        return "%s%s%s%s%s%s" % (self.prefix,self.cruiseName.get(),'_',self.stacastSV.get(),self.suffix, ext)
+
+
+    def insert(self, msg):
+        ''' Insert a comment as if it came from the instrument.
+            Add a leading "#" to each line.
+        '''
+        msg = msg.encode('ascii', 'ignore')
+        linelist = msg.splitlines()
+        msg1 = b"\n#" + b"\n#".join(linelist) + b"\n"
+        self.new_input.put(msg1)
+
+    def start_listening(self, save=True):
+        self.stop_logging()
+        super(RdiProtocol, self).start_listening(save=save)
+
+    def set_clock(self):
+        self.wake_if_sleeping()
+        DateTime = time.strftime('%y%m%d%H%M%S', time.gmtime())
+        self.send_commands(('TS%s' % DateTime, ))
+
+    def clock_offset(self):
+        ''' Return PC time, ADCP time (time tuples), and PC-ADCP in s.
+        '''
+        self.wake_if_sleeping()
+        self.send_commands(('TS?',))
+        if self.state.clock is None:
+            raise ValueError('No time in reply to TS?: %r'
+                             % self.state.replies.get('TS?'))
+        t_adcp, t_pc = self.state.clock
+        return time.gmtime(t_pc), time.gmtime(t_adcp), t_pc - t_adcp
+
+    def show_time_ok(self):
+        t_pc, t_adcp, dt = self.clock_offset()
+        msg = ('  PC time:   %s\n'
+               'ADCP time:   %s\n'
+               'PC-ADCP:     %.0f' % (time.strftime(fmt, t_pc),
+                                        time.strftime(fmt, t_adcp),
+                                        dt))
+        self.insert(msg)
+        self.show_message('Time', msg)
+
+    def showconfig(self):
+        commands = ('RA','RS','RB0','PS3','B?','C?','E?','P?','T?', 'W?')
+        self.wake_if_sleeping()
+        self.send_commands(commands)
+
+    def wakeup(self):
+        self.refresh()
+        self.change_baud(self.default_baud)
+        self.start_listening(save=False)  # save is irrelevant; port is open
+        time.sleep(0.1)
+        self.clear_buffer()
+        self.send_break(break_msec)
+        with Stopwatch(self.latency, 'break'):
+            banner = self.waitfor(b'>', 5)   #1.5
+        self.state = RecorderState(banner)
+        if self.state.model in ('WH', 'BB'):
+            self.type = self.state.model
+        else:
+            L.warning('Wakeup: instrument not identified. Banner:\n%s\n',
+                      banner.decode('ascii', 'ignore'))
+            self.report_error('Wakeup: instrument not identified')
+            self.type = 'Unrecognized'
+
+    def wake_if_sleeping(self):
+        if not self.type:
+            self.wakeup()
+            return
+        try:
+            self.start_listening(save=False)
+            t_sent = time.time()
+            self.stream.write(b'TS?\r')
+            self.stream.flush()
+            self.state.parse('TS?', self.waitfor(b'>',1), t_sent)
+        except Timeout:
+            self.wakeup()
+
+
+    def wakeup_showtime(self):
+        self.wakeup()
+        self.show_time_ok()
+
+    def sleep(self):
+        self.change_baud(self.default_baud)
+        self.wake_if_sleeping()
+        self.stream.write(b'CZ' + b'\r')
+        self.stream.flush()
+        self.state = RecorderState()
+        if self.type == 'BB':
+            self.waitfor('[POWERING DOWN .....]', 2)
+        else:
+            self.waitfor('Powering Down', 5)
+
+
+    def run_diagnostics(self):
+        self.wake_if_sleeping()
+        diagnostics = ('PS0', 'PT200')
+        self.send_commands(diagnostics)
+
+
+    def eraserecorder(self):
+        self.change_baud(self.default_baud)
+        self.start_listening(save=False) # save is irrelevant; port is open
+        self.wake_if_sleeping()
+        self.stream.write(b'RE ErAsE' + b'\r')
+        self.stream.flush()
+        self.state.parse('RE ErAsE', self.waitfor(b'>', 5))
+
+    def send_commands(self, commands, timeout=None):
+        '''
+        Send each command and wait for its prompt; the replies
+        update self.state.
+        '''
+        self.send_steps([Step(cmd.rstrip()) for cmd in commands], timeout)
+
+    def send_steps(self, steps, timeout=None):
+        '''
+        Send each rdi_cmdplan.Step as soon as the reply to the one
+        before has ended, recording its round trip in self.latency.
+        Return the replies (bytes) with "ERR" in them.
+        '''
+        if timeout is None:
+            timeout = 2  # short timeout is OK with streamwaitfor
+        self.start_listening(save=False)
+        errors = []
+        for step in steps:
+            cmd = step.cmd
+            with Stopwatch(self.latency, cmd):
+                t_sent = time.time()
+                self.stream.write(cmd.encode('ascii', 'ignore') + b'\r')
+                self.stream.flush()
+                reply = self.streamwaitfor(step.expect,
+                                           timeout=step.timeout or timeout)
+            if step.check is not None and step.check not in reply:
+                raise Timeout('%s: no %r in reply' % (cmd, step.check))
+            if error_mark in reply:
+                errors.append(reply)
+            if cmd:
+                self.state.parse(cmd, reply, t_sent)
+        L.debug("Command latency: %s", self.latency.summary())
+        return errors
+
+    def send_setup(self):
+        self.wake_if_sleeping()
+        fn = self.cmd_filename
+        L.info("Sending command file: %s", fn)
+        self.insert("Sending command file: %s" % (fn,))
+
+        t0 = time.time()
+        try:
+            plan = load_plan(fn)
+            errors = self.send_steps(plan.steps)
+            self.state = RecorderState()
+        except Timeout:
+            L.exception('Timeout while sending commands')
+            self.report_error('Timout while sending commands')
+            return
+        except IOError:
+            L.exception("looking for file %s", fn)
+            self.report_error("Can't find or read file %s" % (fn,))
+            self.ask_send_setup()
+            return
+
+        self.setup_time = time.time() - t0
+        for reply in errors:
+            msg = reply.decode('ascii', 'replace').strip().rstrip('>').strip()
+            L.warning("Command error: %s", msg)
+            self.insert("Command error: %s" % msg)
+        if errors:
+            self.report_error('%d commands were rejected; see the log'
+                              % len(errors))
+        L.info("Data collection started; %d commands in %.2f s",
+               len(plan), self.setup_time)
+        self.insert("Data collection started, %s\n" % time_stamp())
+        logfilename = self.make_filename(".log")
+        logfilename = self.logDir + logfilename
+        self.append_to_file(logfilename)
+        self.insert("Deployment logfile written to %s" % logfilename)
+        self.sync_diary()
+        self.stop_listening()
+
+    def ask_send_setup(self):
+        ''' Choose another command file and send it; nothing to
+        ask without a user interface.
+        '''
+        pass
+
+    # This may not be useful; it is supposed to
+    # get a single ensemble in hex-ascii mode.
+    def start_ascii(self):
+        self.wake_if_sleeping()
+        self.stream.write(b'CF01010\r')
+        self.stream.flush()
+        termios.tcdrain(self.fd)
+        self.stream.write(b'CS\r')
+        self.stream.flush()
+        termios.tcdrain(self.fd)
+        self.waitfor(b'>')
+
+
+    # ping at will
+    def start_binary(self, cmdlist = None):
+        self.wake_if_sleeping()
+        self.set_clock()
+        if cmdlist:
+            self.send_commands(cmdlist)
+        self.stream.write(b'CF11110\r') # serial out, no recorder
+        self.stream.flush()
+        termios.tcdrain(self.fd)
+        self.change_all_baud()
+        self.stream.write(b'CS\r')
+        self.stream.flush()
+        termios.tcdrain(self.fd)
+        self.state = RecorderState()
+        self.waitfor(b'CS\n')
+        self.stop_listening(restore=False)
+        self.start_logging()
+
+    def get_data_baud(self):
+        if self.data_baud is None:
+            db = default_databauds.get(self.type, self.default_baud)
+            return db
+        return self.data_baud
+
+    def change_all_baud(self, baud = None):
+        if baud is None:
+            baud = self.get_data_baud()
+
+        # Retried with back-off: this used to time out occasionally
+        # right after a YMODEM download (end_ymodem_download).
+        self.start_listening(save=False)
+        self.wait_prompt()
+
+        self.stream.write(b'CB%d11\r' % (rdi_baud_codes[baud],))
+        self.stream.flush()
+        termios.tcdrain(self.fd)
+        self.waitfor(b'>', 3)
+        t_changed = time.time()
+        self.change_baud(baud, settle=False)
+        self.settle_baud(baud, t_changed)
+
+    def list_recorder(self):
+        ''' Ask for what is on the recorder, unless already known
+        since the last wakeup; return self.state.
+        '''
+        if self.type == 'BB':
+            cmds = ('RA', 'RS')
+        else:
+            cmds = ('RA', 'RS', 'RF', 'RR')
+        cmds = [cmd for cmd in cmds if not self.state.known(cmd)]
+        if cmds:
+            try:
+                self.send_commands(cmds)
+            except Timeout:
+                self.wakeup()
+                self.send_commands(cmds)
+        else:
+            self.insert('Recorder: %s' % self.state.summary())
+        return self.state
+
+    def find_number_recorded(self):
+        if not self.state.known('RA'):
+            try:
+                self.send_commands(('RA',))
+            except Timeout:
+                self.wakeup()
+                self.send_commands(('RA',))
+        if self.state.nfiles is None:
+            raise ValueError('No file count in reply to RA: %r'
+                             % self.state.replies.get('RA'))
+        return self.state.nfiles
+
+
+    def download(self):
+        """
+        download menu item callback: start the download process
+        """
+        self.wake_if_sleeping()
+        nrec = self.find_number_recorded()
+        ndown = self.ask_integer('Download',
+                'File to download, %d to %d' % (1, nrec),
+                initialvalue = nrec,
+                minvalue = 1,
+                maxvalue = nrec)
+        if ndown is None:
+            return
+
+        self.ymodem_download(ndown)
+
+
+
+    def ask_data_filename(self):
+        """
+        Return the name for the downloaded file, or None to
+        cancel; an existing file is never overwritten.
+        """
+        fn = self.dataDir + self.make_filename(self.datafile_ext)
+        while True:
+            fn1 = self.ask_string('Download', 'Save recorder file as:',
+                                  initialvalue = fn)
+            if fn1 is None:
+                return None
+            if not os.path.exists(fn1):
+                return fn1
+            self.report_error("File %s already exists" % fn1)
+            if not self.interactive:
+                return None
+
+    def ymodem_filename(self, name, ifile):
+        """
+        YmodemReceiver namer: the first file of a batch gets the
+        chosen station/cast name, later ones a numbered variant.
+        """
+        self.insert("Receiving: %s" % name)
+        if ifile == 0:
+            return self.data_filename
+        root, ext = os.path.splitext(self.data_filename)
+        n = ifile
+        while os.path.exists('%s_%d%s' % (root, n, ext)):
+            n += 1
+        return '%s_%d%s' % (root, n, ext)
+
+    def ymodem_progress(self, stats):
+        self.set_status("Ymodem download on %s: %s"
+                                % (self.get_device(), stats.progress()))
+
+    def run_ymodem(self):
+        """
+        Receive the file(s) with the built-in YMODEM receiver.
+
+        With a user interface this is run in a separate thread,
+        which exits when the transfer is finished.
+        """
+        self.open_port(save=False)
+        self.set_cc(vmin = 0, vtime = 0)
+        self.ymodem = YmodemReceiver(self.fd, self.ymodem_filename,
+                                     progress = self.ymodem_progress)
+        if self.canceled:
+            self.ymodem.cancel()
+        self.ymodem_error = None
+        try:
+            self.ymodem_files = self.ymodem.receive()
+        except YmodemCanceled:
+            self.canceled = 1
+        except (YmodemError, OSError) as exc:
+            L.exception("ymodem download")
+            self.ymodem_error = str(exc)
+        L.info("Ymodem download: %s", self.ymodem.stats.summary())
+        termios.tcflush(self.fd, termios.TCIOFLUSH)
+        self.listening = False  # otherwise start_listening will not work right
+        self.end_ymodem_download()
+
+    def abort_download(self):
+        """
+        callback for Cancel button; signal the thread to end
+        """
+        self.canceled = 1
+        if self.ymodem is not None:
+            self.ymodem.cancel()
+
+    def ymodem_download(self, filenum = None):
+        # filenum is None for all files (WH only); otherwise file number
+        self.data_filename = self.ask_data_filename()
+        if self.data_filename is None:
+            return
+        self.ymodem = None
+        self.ymodem_files = []
+        dbaud = self.get_data_baud()
+        self.change_all_baud(dbaud)
+
+        if filenum:
+            self.stream.write(b'RY%d\r' % filenum)
+        else:
+            self.stream.write(b'RY\r')
+        self.stream.flush()
+        if self.type == 'WH':
+            self.waitfor(b'now')
+        self.stop_listening(restore=False)
+
+        self.canceled = 0
+        self.set_status("Ymodem download on %s at %d baud."
+                                % (self.get_device(), dbaud))
+        self.download_started()
+        self.clear_buffer()
+        self.run_download()
+
+    def run_download(self):
+        ''' Run the transfer; here it blocks until it is finished. '''
+        self.run_ymodem()
+
+    def download_started(self):
+        pass
+
+    def download_finished(self):
+        pass
+
+    def end_ymodem_download(self):
+        self.download_finished()
+        self.start_listening(save=False)
+
+        # For unknown reasons, the following baud change can
+        # time out at the initial "send_commands(['']" line.
+        # We don't want this to block completing the finish_downloads
+        # operation.
+        try:
+            self.change_all_baud(self.default_baud)
+        except Timeout:
+            L.warning("Timeout at change_all_baud in end_ymodem_download")
+
+        for line in self.ymodem.stats.summary().splitlines():
+            self.insert("ymodem download: %s" % line)
+        if self.canceled:
+            L.info("cancelled download")
+            self.insert("DOWNLOAD CANCELED")
+            return
+
+        self.insert("ymodem download number of retries: %d"
+                    % self.ymodem.stats.nretry())
+        self.schedule_idle(self.finish_download)
+
+    def finish_download(self):
+        logfilename = self.make_filename(".log")
+        logfilename = self.logDir + logfilename
+        if self.ymodem_error or not self.ymodem_files:
+            msglines = ['Download failed: %s' % (self.ymodem_error or
+                                                 'no file was received')]
+            msglines.append('Quitting without backup.')
+            for line in msglines:
+                self.insert(line)
+            self.append_to_file(logfilename)
+            self.report_error('\n'.join(msglines))
+            return
+
+        for fn1 in self.ymodem_files:
+            nbytes = os.stat(fn1)[stat.ST_SIZE]
+            self.insert("File written as %s, %d bytes" % (fn1, nbytes))
+            os.chmod(fn1, 0o444) # Read-only.
+            result = self.verify_file(fn1)
+            self.cast_summary(fn1)
+            if result is not None:
+                self.backup_file(fn1, result['sha256'])
+            else:
+                self.backup_file(fn1)
+        self.append_to_file(logfilename)
+        self.insert("Recovery logfile appended to %s" % logfilename)
+        self.sleep()
+        self.sync_diary()
+
+    def verify_file(self, fn1):
+        ''' Check the ensembles and checksums of a downloaded file,
+        and write the result, and an ensemble index, to sidecars
+        next to it.
+        '''
+        indexes = []
+        def index(a, starts, lengths):
+            indexes.append(rdi_index.index_from(a, starts, lengths))
+        try:
+            result = rdi_verify.verify_file(fn1, callback=index)
+            rdi_verify.write_sidecar(result, fn1)
+            rdi_index.save_index(indexes[0], fn1)
+        except Exception as exc:
+            L.exception("verifying %s", fn1)
+            self.insert("Verification of %s failed: %s" % (fn1, exc))
+            return None
+        self.insert(rdi_verify.summary(result))
+        self.insert("SHA-256 %s" % result['sha256'])
+        if not result['ok']:
+            self.report_error(rdi_verify.summary(result))
+        return result
+
+    def cast_summary(self, fn1):
+        ''' Put the quick-look summary of the cast in the transcript,
+        and so in the cast log.
+        '''
+        try:
+            result = rdi_quicklook.quicklook(fn1)
+        except Exception as exc:
+            L.exception("quick-look of %s", fn1)
+            self.insert("Quick-look of %s failed: %s" % (fn1, exc))
+            return None
+        lines = rdi_quicklook.summary_lines(result)
+        L.info("%s", '\n'.join(lines))
+        self.insert('\n'.join(lines))
+        return result
+
+    def start_backups(self):
+        '''
+        Attach to the background backup queue; copies left over
+        from an interrupted session resume now.
+        '''
+        self.backup_sources = set()
+        self.backups = None
+        if not self.backupDirs:
+            return
+        qfile = os.path.join(self.logDir or '.', 'backup_queue.json')
+        self.backups = get_backup_queue(qfile)
+        self.backups.add_callback(self.backup_done)
+
+    def backup_file(self, fn1, sha256=None):
+        ''' Queue the file, and its sidecars, for backup. '''
+        if self.backups is None:
+            return
+        sources = [fn1]
+        for fn in (rdi_verify.sidecar_name(fn1), rdi_index.index_name(fn1)):
+            if os.path.exists(fn):
+                sources.append(fn)
+        for fn in sources:
+            self.backup_sources.add(os.path.abspath(fn))
+            self.backups.add(fn, self.backupDirs,
+                             sha256 = sha256 if fn == fn1 else None)
+        self.insert("File %s queued for backup to %s"
+                    % (os.path.basename(fn1), ', '.join(self.backupDirs)))
+
+    def backup_done(self, job, ok, msg):
+        ''' BackupQueue callback, in its worker thread. '''
+        if job['source'] not in self.backup_sources:
+            return
+        name = os.path.basename(job['source'])
+        if ok:
+            self.insert("File %s backed up to %s (%s)"
+                        % (name, job['dest'], msg))
+        elif ok is None:
+            self.insert("Backup to %s unavailable (%s); will retry"
+                        % (job['dest'], msg))
+        else:
+            self.insert("BACKUP OF %s TO %s FAILED: %s"
+                        % (name, job['dest'], msg))
+
+    def append_to_file(self, fn):
+        self.update(oneshot=True)  # include anything not yet shown
+        self.render()
+        try:
+            f = open(fn, 'ab')       # open in binary mode so a
+                                     # junk character won't trigger
+                                     # UnicodeEncodeError
+
+            txt = self.display.get().encode('utf-8')#2/9/16 added encode to avoid unicode error. Pedro Pena
+            f.write(txt)
+            f.close()
+        except:
+            L.exception("writing to file <%s>", fn)
+            self.report_error("Can't write to file %s" % fn)
+
+    def start_deploy_recover(self):
+        self.clear()
+        self.insert("***************************** %s\n" % time_stamp())
+        self.wakeup_showtime()
+        self.list_recorder()
+
+    def deploy(self):
+        ''' Whole deployment: initialize, set the clock, send the
+        setup and start pinging.
+        '''
+        self.start_deploy_recover()
+        self.set_clock()
+        self.send_setup()
+
+    def recover(self):
+        ''' Whole recovery: initialize, then download the last file. '''
+        self.start_deploy_recover()
+        self.download()
+
+
+class RdiEngine(RdiProtocol, TerminalEngine):
+    ''' Headless RDI terminal; keyword arguments are those of
+    rditerm.terminal, plus *transcript* for the session text file.
+    '''
+    def __init__(self, device = '/dev/ttyS0',
+                       baud = 9600,
+                       transcript = None,
+                       **kwargs):
+        TerminalEngine.__init__(self, device=device, baud=baud,
+                                transcript=transcript)
+        self.init_rdi(baud=baud, **kwargs)
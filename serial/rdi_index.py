@@ -0,0 +1,254 @@
+'''
+Ensemble index for downloaded RDI (BB, WH) recorder files.
+
+The index is a NumPy structured array with one record per good
+ensemble: byte offset, length (nb, without the checksum),
+ensemble number and instrument time (Unix seconds, NaN if the
+clock fields are bad), found with rdi_verify.find_ensembles and
+the ensemble number and RTC of each variable leader.  It is kept
+in a sidecar, FILE.index.npz, with the size and mtime of the file
+it describes; if either has changed, the index is rebuilt.
+
+    idx = EnsembleIndex('rdiKM1001_012_01m.dat')
+    ens = idx[100]                 # bytes of the 101st ensemble
+    top = idx.first(10)
+    late = idx.time_range(t0, t1)  # positions in the index
+
+Running this module builds (or checks) the index of each file:
+
+    python -m uhdas.serial.rdi_index file [file ...]
+'''
+from __future__ import print_function
+
+import os, time
+
+import numpy as np
+
+import logging
+L = logging.getLogger()
+
+from uhdas.serial.rdi_verify import find_ensembles
+
+index_dtype = np.dtype([('offset', '<i8'),
+                        ('length', '<u2'),
+                        ('ens', '<u4'),
+                        ('time', '<f8')])
+
+index_version = 1
+VL_ID = 0x0080          # variable leader
+
+
+def index_name(filename):
+    return filename + '.index.npz'
+
+
+def _u16(a, i):
+    return a[i].astype(np.int64) | (a[i + 1].astype(np.int64) << 8)
+
+
+def _rtc_seconds(yy, mo, dd, hh, mi, ss, hu):
+    ''' Unix seconds from RDI RTC fields (arrays); NaN where invalid. '''
+    year = np.where(yy < 80, 2000 + yy, 1900 + yy)
+    bad = ((mo < 1) | (mo > 12) | (dd < 1) | (dd > 31) |
+           (hh > 23) | (mi > 59) | (ss > 59) | (hu > 99))
+    mo = np.clip(mo, 1, 12)
+    dd = np.clip(dd, 1, 31)
+    days = ((year - 1970).astype('datetime64[Y]').astype('datetime64[M]')
+            + (mo - 1).astype('timedelta64[M]')).astype('datetime64[D]') \
+           + (dd - 1).astype('timedelta64[D]')
+    t = (days.astype(np.int64) * 86400.0 + hh * 3600.0 + mi * 60.0 + ss
+         + hu / 100.0)
+    t[bad] = np.nan
+    return t
+
+
+def find_type(a, starts, lengths, type_id, nbytes=2):
+    '''
+    Return the file offsets of the data type *type_id* (e.g.
+    VL_ID) in each ensemble, or -1 where it is missing or has
+    fewer than *nbytes* bytes inside the ensemble.
+    '''
+    n = len(starts)
+    found_at = np.full(n, -1, dtype=np.int64)
+    if not n:
+        return found_at
+    ntypes = a[starts + 5].astype(np.int64)
+    for k in range(int(ntypes.max())):
+        # Look up data type k where it is still unknown; the
+        # leaders come first, so this is short.
+        todo = np.flatnonzero((found_at < 0) & (k < ntypes))
+        if not len(todo):
+            break
+        s = starts[todo]
+        off = _u16(a, s + 6 + 2 * k)
+        ok = off + nbytes <= lengths[todo]
+        todo, s, off = todo[ok], s[ok], off[ok]
+        found = _u16(a, s + off) == type_id
+        found_at[todo[found]] = s[found] + off[found]
+    return found_at
+
+
+def index_from(a, starts, lengths):
+    '''
+    Build the index array from the uint8 array *a* of the file,
+    and the offsets and lengths of its good ensembles.
+    '''
+    n = len(starts)
+    idx = np.zeros(n, dtype=index_dtype)
+    if not n:
+        return idx
+    idx['offset'] = starts
+    idx['length'] = lengths
+    vl = find_type(a, starts, lengths, VL_ID, 12)
+    good = vl >= 0
+    idx['ens'] = np.iinfo(np.uint32).max      # no variable leader
+    idx['time'] = np.nan
+    v = vl[good]
+    if len(v):
+        idx['ens'][good] = _u16(a, v + 2) | (a[v + 11].astype(np.int64) << 16)
+        rtc = [a[v + 4 + j].astype(np.int64) for j in range(7)]
+        idx['time'][good] = _rtc_seconds(*rtc)
+    return idx
+
+
+def build_index(filename):
+    ''' Return the index array for *filename*, reading it once. '''
+    if not os.path.getsize(filename):
+        return np.zeros(0, dtype=index_dtype)
+    a = np.memmap(filename, dtype=np.uint8, mode='r')
+    starts, lengths, nbad, partial = find_ensembles(a)
+    return index_from(a, starts, lengths)
+
+
+def _file_stamp(filename):
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime_ns
+
+
+def save_index(idx, filename):
+    ''' Write *idx* as the sidecar of *filename*; return its name,
+    or None if it could not be written.
+    '''
+    size, mtime_ns = _file_stamp(filename)
+    fn = index_name(filename)
+    tmp = fn + '.tmp.npz'
+    try:
+        np.savez(tmp, index=idx, size=size, mtime_ns=mtime_ns,
+                 version=index_version)
+        os.rename(tmp, fn)
+    except (IOError, OSError):
+        L.exception("writing index %s", fn)
+        return None
+    return fn
+
+
+def load_index(filename):
+    ''' The saved index of *filename*, or None if missing or stale. '''
+    fn = index_name(filename)
+    try:
+        with np.load(fn) as z:
+            if (int(z['version']) != index_version or
+                    (int(z['size']), int(z['mtime_ns']))
+                        != _file_stamp(filename)):
+                return None
+            return z['index']
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+class EnsembleIndex(object):
+    def __init__(self, filename, save=True):
+        '''
+        Open *filename* with its index, building the index (and,
+        with *save*, writing the sidecar) if it is missing or stale.
+        '''
+        self.filename = filename
+        self.index = load_index(filename)
+        self.rebuilt = self.index is None
+        if self.rebuilt:
+            self.index = build_index(filename)
+            if save:
+                save_index(self.index, filename)
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            if os.path.getsize(self.filename):
+                self._data = np.memmap(self.filename, dtype=np.uint8,
+                                       mode='r')
+            else:
+                self._data = np.zeros(0, dtype=np.uint8)
+        return self._data
+
+    def close(self):
+        self._data = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def ensemble(self, i):
+        ''' Bytes of ensemble *i*, with its checksum. '''
+        rec = self.index[i]
+        start = int(rec['offset'])
+        return self.data[start:start + int(rec['length']) + 2].tobytes()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.ensemble(j) for j in range(*i.indices(len(self)))]
+        return self.ensemble(i)
+
+    def first(self, n=1):
+        return self[:n]
+
+    def last(self, n=1):
+        return self[max(0, len(self) - n):]
+
+    def time_range(self, t0=None, t1=None):
+        ''' Positions of the ensembles with t0 <= time < t1 (Unix s). '''
+        t = self.index['time']
+        mask = ~np.isnan(t)
+        if t0 is not None:
+            mask &= t >= t0
+        if t1 is not None:
+            mask &= t < t1
+        return np.flatnonzero(mask)
+
+    def find_ens(self, ens):
+        ''' Position of ensemble number *ens*, or -1. '''
+        i = np.flatnonzero(self.index['ens'] == ens)
+        if len(i):
+            return int(i[0])
+        return -1
+
+    def summary(self):
+        if not len(self):
+            return '%s: no ensembles' % os.path.basename(self.filename)
+        idx = self.index
+        t = idx['time'][~np.isnan(idx['time'])]
+        s = '%s: %d ensembles, numbers %d to %d' % (
+                os.path.basename(self.filename), len(idx),
+                idx['ens'][0], idx['ens'][-1])
+        if len(t):
+            fmt = '%Y/%m/%d %H:%M:%S'
+            s += ', %s to %s' % (time.strftime(fmt, time.gmtime(t.min())),
+                                 time.strftime(fmt, time.gmtime(t.max())))
+        return s
+
+
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog file [file ...]')
+    o, a = op.parse_args()
+    if not a:
+        op.error('at least one file is required')
+    for fn in a:
+        t0 = time.time()
+        idx = EnsembleIndex(fn)
+        print(idx.summary())
+        print('   %s, %.2f s' % ('built' if idx.rebuilt else 'up to date',
+                                 time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+'''
+Quick-look summary of a downloaded LADCP cast, to catch a bad
+cast before the package goes back in the water.
+
+The variable leader of every ensemble is read through a NumPy
+structured dtype laid over the memory-mapped file (a strided
+view when the ensembles are evenly spaced, as they are in a
+clean file; a gather of the leader bytes otherwise), so there is
+no Python loop over ensembles.  From it come the ensemble count
+and time span, maximum pressure and depth, heading, pitch and
+roll ranges, the transmit voltage (battery) trend, and gaps in
+time or ensemble number.
+
+    python -m uhdas.serial.rdi_quicklook file [file ...]
+'''
+from __future__ import print_function
+
+import os, time
+
+import numpy as np
+
+import logging
+L = logging.getLogger()
+
+from uhdas.serial import rdi_index
+
+# WorkHorse variable leader, through the pressure fields.
+vl_fields = [('vl_id', '<u2', 0), ('ens', '<u2', 2), ('rtc', ('u1', 7), 4),
+             ('ens_msb', 'u1', 11), ('bit', '<u2', 12),
+             ('sound_speed', '<u2', 14), ('xducer_depth', '<u2', 16),
+             ('heading', '<u2', 18), ('pitch', '<i2', 20), ('roll', '<i2', 22),
+             ('salinity', '<u2', 24), ('temperature', '<i2', 26),
+             ('adc', ('u1', 8), 34), ('esw', '<u4', 42),
+             ('pressure', '<u4', 48)]
+vl_nbytes = 52           # enough for pressure; the BB leader is shorter
+vl_nbytes_bb = 34        # through temperature and MPT
+
+# WorkHorse transmit voltage scale, microvolts per ADC count,
+# by frequency (kHz)
+xmit_voltage_scale = {75: 2092719, 150: 592157, 300: 592157,
+                      600: 380667, 1200: 253765, 2400: 253765}
+frequencies = {0: 75, 1: 150, 2: 300, 3: 600, 4: 1200, 5: 2400}
+
+
+def vl_dtype(nbytes):
+    ''' The variable leader fields within its first *nbytes*. '''
+    fields = [f for f in vl_fields if f[2] + np.dtype(f[1]).itemsize <= nbytes]
+    return np.dtype({'names': [f[0] for f in fields],
+                     'formats': [f[1] for f in fields],
+                     'offsets': [f[2] for f in fields],
+                     'itemsize': nbytes})
+
+
+def read_leaders(a, vl, nbytes):
+    '''
+    Return the variable leaders at file offsets *vl* (all valid)
+    as a structured array.  Evenly spaced ensembles get a strided
+    view of *a*; others a copy of just the leader bytes.
+    '''
+    n = len(vl)
+    dtype = vl_dtype(nbytes)
+    if n > 1:
+        step = np.diff(vl)
+        if (step == step[0]).all() and step[0] >= nbytes:
+            return np.ndarray(shape=(n,), dtype=dtype, buffer=a,
+                              offset=int(vl[0]), strides=(int(step[0]),))
+    raw = a[vl[:, np.newaxis] + np.arange(nbytes)]
+    return raw.view(dtype).reshape(n)
+
+
+def p2z(p, lat=30.0):
+    ''' Depth (m) from pressure (dbar), UNESCO 1983 (Saunders and
+    Fofonoff), at latitude *lat*.
+    '''
+    x = np.sin(np.radians(lat)) ** 2
+    g = 9.780318 * (1.0 + (5.2788e-3 + 2.36e-5 * x) * x) + 1.092e-6 * p
+    return ((((-1.82e-15 * p + 2.279e-10) * p - 2.2512e-5) * p
+             + 9.72659) * p) / g
+
+
+def quicklook(filename, idx=None, gap_factor=3.0, lat=30.0):
+    '''
+    Return a dictionary summarizing the cast in *filename*; *idx*
+    is its EnsembleIndex, opened here if not given.  A time gap is
+    an interval longer than *gap_factor* times the median.
+    '''
+    t0 = time.time()
+    if idx is None:
+        idx = rdi_index.EnsembleIndex(filename)
+    result = dict(filename=os.path.basename(filename), nens=len(idx))
+    if not len(idx):
+        result['seconds'] = round(time.time() - t0, 3)
+        return result
+    a = idx.data
+    starts = idx.index['offset']
+    lengths = idx.index['length'].astype(np.int64)
+    vl = rdi_index.find_type(a, starts, lengths, rdi_index.VL_ID, vl_nbytes)
+    wh = True
+    if not (vl >= 0).any():      # BB: no pressure in the leader
+        vl = rdi_index.find_type(a, starts, lengths, rdi_index.VL_ID,
+                                 vl_nbytes_bb)
+        wh = False
+    keep = vl >= 0
+    vl = vl[keep]
+    result['nleaders'] = len(vl)
+    if not len(vl):
+        result['seconds'] = round(time.time() - t0, 3)
+        return result
+    d = read_leaders(a, vl, vl_nbytes if wh else vl_nbytes_bb)
+
+    t = idx.index['time'][keep]
+    tgood = t[~np.isnan(t)]
+    if len(tgood):
+        result['time_start'] = float(tgood[0])
+        result['time_end'] = float(tgood[-1])
+        result['duration'] = float(tgood[-1] - tgood[0])
+    ens = idx.index['ens'][keep].astype(np.int64)
+    result['ens_first'] = int(ens[0])
+    result['ens_last'] = int(ens[-1])
+
+    # Gaps: in time, and in ensemble numbers.
+    dt = np.diff(tgood)
+    result['ngaps'] = 0
+    result['max_gap'] = 0.0
+    if len(dt):
+        median = float(np.median(dt))
+        result['ping_interval'] = median
+        big = np.flatnonzero(dt > gap_factor * max(median, 1e-3))
+        result['ngaps'] = len(big)
+        if len(big):
+            j = big[np.argmax(dt[big])]
+            result['max_gap'] = float(dt[j])
+            result['max_gap_time'] = float(tgood[j])
+    result['nmissing'] = int(np.clip(np.diff(ens) - 1, 0, None).sum())
+
+    if wh:
+        p = d['pressure'].astype(float) / 1000.0      # dbar
+        imax = int(np.argmax(p))
+        result['pressure_max'] = float(p[imax])
+        result['depth_max'] = float(p2z(p[imax], lat))
+        if not np.isnan(t[imax]):
+            result['bottom_time'] = float(t[imax])
+    result['xducer_depth_max'] = float(d['xducer_depth'].max()) / 10.0
+
+    heading = d['heading'] / 100.0
+    pitch = d['pitch'] / 100.0
+    roll = d['roll'] / 100.0
+    result['heading_range'] = [float(heading.min()), float(heading.max())]
+    result['pitch_range'] = [float(pitch.min()), float(pitch.max())]
+    result['roll_range'] = [float(roll.min()), float(roll.max())]
+    result['tilt_max'] = float(np.hypot(pitch, roll).max())
+    result['temperature_range'] = [float(d['temperature'].min()) / 100.0,
+                                   float(d['temperature'].max()) / 100.0]
+
+    # Transmit voltage (ADC channel 1): mean of the first and last
+    # tenths of the cast, and a linear trend.
+    v = d['adc'][:, 1].astype(float)
+    n10 = max(1, len(v) // 10)
+    scale = None
+    fl = rdi_index.find_type(a, starts[:1], lengths[:1], 0x0000, 8)
+    if fl[0] >= 0:
+        freq = frequencies.get(int(a[fl[0] + 4]) & 0x07)
+        scale = xmit_voltage_scale.get(freq)
+        result['frequency'] = freq
+    if scale and wh:
+        v = v * scale * 1e-6
+        result['voltage_units'] = 'V'
+    else:
+        result['voltage_units'] = 'counts'
+    result['voltage_start'] = float(v[:n10].mean())
+    result['voltage_end'] = float(v[-n10:].mean())
+    tv = t[~np.isnan(t)]
+    if len(tv) > 1 and tv[-1] > tv[0]:
+        slope = np.polyfit((tv - tv[0]) / 3600.0, v[~np.isnan(t)], 1)[0]
+        result['voltage_trend'] = float(slope)       # per hour
+    result['seconds'] = round(time.time() - t0, 3)
+    return result
+
+
+def _fmt_time(t):
+    return time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime(t))
+
+
+def summary_lines(r):
+    ''' Text lines describing a quicklook() result. '''
+    lines = ['Cast %s: %d ensembles' % (r['filename'], r['nens'])]
+    if not r.get('nleaders'):
+        lines.append('  no variable leaders found; CHECK FILE')
+        return lines
+    if 'time_start' in r:
+        lines.append('  %s to %s (%.1f min), ensembles %d to %d'
+                     % (_fmt_time(r['time_start']), _fmt_time(r['time_end']),
+                        r['duration'] / 60.0, r['ens_first'], r['ens_last']))
+    gaps = '  %d time gaps' % r['ngaps']
+    if r['ngaps']:
+        gaps += ', longest %.1f s at %s' % (r['max_gap'],
+                                            _fmt_time(r['max_gap_time']))
+    gaps += '; %d ensemble numbers missing' % r['nmissing']
+    lines.append(gaps)
+    if 'pressure_max' in r:
+        s = '  max pressure %.1f dbar, depth %.1f m' % (r['pressure_max'],
+                                                        r['depth_max'])
+        if 'bottom_time' in r:
+            s += ' at %s' % _fmt_time(r['bottom_time'])
+        lines.append(s)
+    else:
+        lines.append('  max transducer depth %.1f m' % r['xducer_depth_max'])
+    lines.append('  heading %.1f to %.1f, pitch %.1f to %.1f, '
+                 'roll %.1f to %.1f, max tilt %.1f deg'
+                 % tuple(r['heading_range'] + r['pitch_range']
+                         + r['roll_range'] + [r['tilt_max']]))
+    s = '  transmit voltage %.1f to %.1f %s' % (r['voltage_start'],
+                                               r['voltage_end'],
+                                               r['voltage_units'])
+    if 'voltage_trend' in r:
+        s += ' (%+.2f per hour)' % r['voltage_trend']
+    lines.append(s)
+    return lines
+
+
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [--lat LAT] file [file ...]')
+    op.add_option('--lat', dest='lat', type='float', default=30.0,
+                  help='latitude for depth from pressure; default is 30')
+    o, a = op.parse_args()
+    if not a:
+        op.error('at least one file is required')
+    for fn in a:
+        r = quicklook(fn, lat=o.lat)
+        print('\n'.join(summary_lines(r)))
+        print('  (%.2f s)' % r['seconds'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,480 @@
+'''
+Simulated RDI instrument (WorkHorse, Broadband, Ocean Surveyor)
+on a pseudo-terminal, for exercising the terminals without
+hardware.
+
+The simulator opens a pty pair and answers on the master side;
+a terminal opens the slave, whose name is RdiSimulator.device.
+It wakes on a break, answers TS?, TS, RA, RS, RF, RR, CK, CS, CZ,
+CB and RE, echoes and acknowledges any other command, and serves
+RY with YMODEM from a synthetic recorder of valid PD0 ensembles.
+Responses can be delayed, output paced at the simulated baud
+rate, and noise added to YMODEM blocks or to text replies.
+
+A pty can't carry a real break, so the instrument wakes on the
+RDI software break, "===", instead; a terminal is told to send
+it with serial_port.soft_break:
+
+    sim = RdiSimulator('WH', recorder=SyntheticRecorder(nbytes=2000000))
+    R = RdiEngine(device=sim.device)
+    R.soft_break = b'==='
+    R.wakeup()
+
+Running this module starts a simulator and prints its device:
+
+    python -m uhdas.serial.rdi_sim [--model WH] [--mbytes 2] [--delay 0.05]
+'''
+from __future__ import print_function
+
+import os, time, select, tty, pty
+import calendar
+
+import numpy as np
+
+import logging
+L = logging.getLogger()
+
+from uhdas.serial.ymodem import YmodemSender, YmodemError
+
+
+banners = {
+    'WH': (b'\r\n[BREAK Wakeup A]\r\n'
+           b'WorkHorse Broadband ADCP Version 51.40\r\n'
+           b'Teledyne RD Instruments (c) 1996-2010\r\n'
+           b'All Rights Reserved.\r\n>'),
+    'BB': (b'\r\n\r\nRD Instruments Broadband ADCP Version 5.59\r\n'
+           b'Copyright (c) RD Instruments 1991-1996\r\n>'),
+    'OS': (b'\r\n[BREAK Wakeup A]\r\n'
+           b'Ocean Surveyor Version 23.17\r\n'
+           b'Teledyne RD Instruments (c) 1996-2010\r\n'
+           b'All Rights Reserved.\r\n>'),
+    }
+
+powering_down = {'WH': b'Powering Down\r\n',
+                 'BB': b'[POWERING DOWN .....]\r\n',
+                 'OS': b'Powering Down\r\n'}
+
+baud_codes = {0:300, 1:1200, 2:2400, 3:4800, 4:9600,
+              5:19200, 6:38400, 7:57600, 8:115200}
+
+
+def ensemble_dtype(ncells):
+    ''' PD0 ensemble with header, fixed and variable leaders,
+    velocity, correlation, echo intensity and percent good.
+    '''
+    beams = (ncells, 4)
+    return np.dtype([('hid', '<u2'), ('nbytes', '<u2'), ('spare', 'u1'),
+                     ('ntypes', 'u1'), ('offsets', '<u2', 6),
+                     # fixed leader, 59 bytes
+                     ('fl_id', '<u2'), ('fw', 'u1', 2), ('config', '<u2'),
+                     ('sim', 'u1'), ('lag', 'u1'), ('nbeams', 'u1'),
+                     ('ncells', 'u1'), ('pings', '<u2'), ('cell_len', '<u2'),
+                     ('blank', '<u2'), ('fl_rest', 'u1', 43),
+                     # variable leader, 65 bytes
+                     ('vl_id', '<u2'), ('ens', '<u2'), ('rtc', 'u1', 7),
+                     ('ens_msb', 'u1'), ('bit', '<u2'), ('sound_speed', '<u2'),
+                     ('xducer_depth', '<u2'), ('heading', '<u2'),
+                     ('pitch', '<i2'), ('roll', '<i2'), ('salinity', '<u2'),
+                     ('temperature', '<i2'), ('mpt', 'u1', 3),
+                     ('att_std', 'u1', 3), ('adc', 'u1', 8), ('esw', '<u4'),
+                     ('vl_spare', '<u2'), ('pressure', '<u4'),
+                     ('pressure_var', '<u4'), ('vl_spare2', 'u1'),
+                     ('rtc_y2k', 'u1', 8),
+                     ('vel_id', '<u2'), ('vel', '<i2', beams),
+                     ('cor_id', '<u2'), ('cor', 'u1', beams),
+                     ('amp_id', '<u2'), ('amp', 'u1', beams),
+                     ('pg_id', '<u2'), ('pg', 'u1', beams),
+                     ('checksum', '<u2')])
+
+
+def make_cast(nens, ncells=25, t0=None, dt=1.0, max_depth=1000.0,
+              gaps=(), seed=0):
+    '''
+    Return *nens* PD0 ensembles as bytes: a cast to *max_depth*
+    meters and back, one ensemble every *dt* seconds from time
+    *t0* (default now), with the heading turning, noisy pitch and
+    roll, and the transmit voltage falling.  *gaps* is a sequence
+    of (ensemble index, seconds) adding a time gap before that
+    ensemble.
+    '''
+    rng = np.random.RandomState(seed)
+    dtype = ensemble_dtype(ncells)
+    a = np.zeros(nens, dtype=dtype)
+    nb = dtype.itemsize - 2
+    a['hid'] = 0x7f7f
+    a['nbytes'] = nb
+    a['ntypes'] = 6
+    fl = dtype.fields['fl_id'][1]
+    vl = dtype.fields['vl_id'][1]
+    a['offsets'] = [fl, vl] + [dtype.fields[k][1]
+                               for k in ('vel_id', 'cor_id', 'amp_id', 'pg_id')]
+    a['fl_id'] = 0x0000
+    a['fw'] = (51, 40)
+    a['config'] = 0x41ca         # 300 kHz, beam 20 deg, convex
+    a['nbeams'] = 4
+    a['ncells'] = ncells
+    a['pings'] = 1
+    a['cell_len'] = 800
+    a['blank'] = 176
+    a['vl_id'] = 0x0080
+    a['vel_id'] = 0x0100
+    a['cor_id'] = 0x0200
+    a['amp_id'] = 0x0300
+    a['pg_id'] = 0x0400
+
+    if t0 is None:
+        t0 = time.time()
+    t = t0 + dt * np.arange(nens, dtype=float)
+    for i, seconds in gaps:
+        t[i:] += seconds
+    ens = np.arange(1, nens + 1)
+    a['ens'] = ens & 0xffff
+    a['ens_msb'] = ens >> 16
+    secs = np.floor(t).astype(np.int64)
+    hund = ((t - secs) * 100).astype(int)
+    for i, s in enumerate(secs):
+        tt = time.gmtime(s)
+        a['rtc'][i] = (tt.tm_year % 100, tt.tm_mon, tt.tm_mday,
+                       tt.tm_hour, tt.tm_min, tt.tm_sec, hund[i])
+        a['rtc_y2k'][i] = (tt.tm_year // 100, tt.tm_year % 100, tt.tm_mon,
+                           tt.tm_mday, tt.tm_hour, tt.tm_min, tt.tm_sec,
+                           hund[i])
+
+    frac = np.arange(nens) / max(nens - 1, 1.0)
+    depth = max_depth * (1 - np.abs(2 * frac - 1))
+    a['xducer_depth'] = np.round(depth * 10)
+    a['pressure'] = np.round(depth * 1000)      # decapascals
+    a['sound_speed'] = 1500
+    a['salinity'] = 35
+    a['temperature'] = np.round(2000 - 1.5 * depth)
+    a['heading'] = np.round((t - t0) * 5.0 % 360 * 100)
+    a['pitch'] = np.round(rng.normal(0, 300, nens))
+    a['roll'] = np.round(rng.normal(0, 300, nens))
+    a['adc'][:, 1] = np.round(82 - 8 * frac + rng.normal(0, 1, nens))
+    a['adc'][:, 0] = 90
+    a['vel'] = rng.randint(-1000, 1000, size=(nens, ncells, 4))
+    a['cor'] = rng.randint(60, 128, size=(nens, ncells, 4))
+    a['amp'] = rng.randint(40, 200, size=(nens, ncells, 4))
+    a['pg'] = 100
+
+    b = a.view(np.uint8).reshape(nens, dtype.itemsize)
+    a['checksum'] = b[:, :nb].sum(axis=1, dtype=np.uint64) & 0xffff
+    return a.tobytes()
+
+
+class SyntheticRecorder(object):
+    ''' A recorder holding *nfiles* casts of about *nbytes* each. '''
+    def __init__(self, nfiles=1, nbytes=1000000, ncells=25, dt=1.0,
+                       max_depth=1000.0, name='RDI', seed=0):
+        self.nfiles = nfiles
+        self.nbytes = nbytes
+        self.ncells = ncells
+        self.dt = dt
+        self.max_depth = max_depth
+        self.name = name
+        self.seed = seed
+        self.cache = {}
+
+    def erase(self):
+        self.nfiles = 0
+        self.cache = {}
+
+    def filename(self, i):
+        return '%s%03d.000' % (self.name, i)
+
+    def _nens(self):
+        return max(1, self.nbytes // ensemble_dtype(self.ncells).itemsize)
+
+    def data(self, i):
+        ''' Contents of file *i* (0-based), made on first use. '''
+        if i not in self.cache:
+            nens = self._nens()
+            t0 = time.time() - (self.nfiles - i) * 2 * nens * self.dt
+            self.cache[i] = make_cast(nens, ncells=self.ncells, t0=t0,
+                                      dt=self.dt, max_depth=self.max_depth,
+                                      seed=self.seed + i)
+        return self.cache[i]
+
+    def size(self, i):
+        return self._nens() * ensemble_dtype(self.ncells).itemsize
+
+    def used(self):
+        return sum(self.size(i) for i in range(self.nfiles))
+
+
+class RdiSimulator(object):
+    def __init__(self, model='WH',
+                       recorder=None,
+                       delay=0.0,
+                       wakeup_delay=0.3,
+                       pace=False,
+                       baud=9600,
+                       noise=0.0,
+                       text_noise=0.0,
+                       baud_settle=0.0,
+                       soft_break=b'===',
+                       seed=None):
+        '''
+        *model* is 'WH', 'BB' or 'OS'.  *delay* is the time taken
+        to answer each command and *wakeup_delay* the time from
+        break to banner, in seconds.  With *pace*, output goes no
+        faster than the simulated *baud* (changed by CB).  *noise*
+        is the probability of each byte of a YMODEM block being
+        damaged, and *text_noise* the same for other output.
+        For *baud_settle* seconds after CB, replies are garbled, as
+        through a port that has not yet settled at the new rate.
+        '''
+        self.model = model
+        if recorder is None:
+            recorder = SyntheticRecorder()
+        self.recorder = recorder
+        self.delay = delay
+        self.wakeup_delay = wakeup_delay
+        self.pace = pace
+        self.baud = baud
+        self.noise = noise
+        self.text_noise = text_noise
+        self.baud_settle = baud_settle
+        self.garble_until = 0.0
+        self.soft_break = soft_break
+        self.rng = np.random.RandomState(seed)
+        self.state = 'asleep'        # or 'command', 'pinging'
+        self.clock_offset = 0.0
+        self.nbreaks = 0
+        self.ncommands = 0
+        self.sender = None
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+        self.poller = select.poll()
+        self.poller.register(self.master, select.POLLIN)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        from threading import Thread
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.sender is not None:
+            self.sender.cancel()
+        if self.thread is not None:
+            self.thread.join(2)
+        os.close(self.master)
+        os.close(self.slave)
+
+    # Output
+
+    def write(self, data):
+        ''' Write to the terminal, at the simulated baud rate if pacing. '''
+        if not self.pace:
+            os.write(self.master, data)
+            return
+        chunk = max(1, self.baud // 100)     # about 10 ms of output
+        t = time.time()
+        for i in range(0, len(data), chunk):
+            block = data[i:i + chunk]
+            os.write(self.master, block)
+            t += len(block) * 10.0 / self.baud
+            dt = t - time.time()
+            if dt > 0:
+                time.sleep(dt)
+
+    def _damage(self, data, p):
+        ''' Return *data* with each byte replaced with probability *p*. '''
+        if not p:
+            return data
+        nerr = self.rng.binomial(len(data), p)
+        if not nerr:
+            return data
+        data = bytearray(data)
+        for i in self.rng.randint(0, len(data), nerr):
+            data[i] = self.rng.randint(256)
+        return bytes(data)
+
+    def reply(self, text):
+        if isinstance(text, str):
+            text = text.encode('ascii')
+        if self.delay:
+            time.sleep(self.delay)
+        if time.time() < self.garble_until:
+            # No byte survives at the wrong baud rate.
+            text = self.rng.randint(0x80, 0x100, len(text)).astype('u1')
+            self.write(text.tobytes())
+            return
+        self.write(self._damage(text, self.text_noise))
+
+    # Input
+
+    def run(self):
+        buf = bytearray()
+        while self.running:
+            if not self.poller.poll(200):
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:          # no terminal has the slave open
+                time.sleep(0.1)
+                continue
+            buf += data
+            if self.soft_break and self.soft_break in buf:
+                del buf[:]
+                self.wake()
+                continue
+            if self.state != 'command':
+                del buf[:-len(self.soft_break or b'x')]
+                continue
+            while True:
+                i = buf.find(b'\r')
+                if i == -1:
+                    break
+                line = bytes(buf[:i]).decode('ascii', 'replace').strip()
+                del buf[:i + 1]
+                try:
+                    self.command(line)
+                except Exception:
+                    L.exception('simulator command %r', line)
+                if self.state != 'command':
+                    del buf[:]
+                    break
+
+    def wake(self):
+        self.nbreaks += 1
+        self.state = 'command'
+        time.sleep(self.wakeup_delay)
+        self.write(banners[self.model])
+
+    def clock(self):
+        return time.time() + self.clock_offset
+
+    def command(self, line):
+        ''' Echo and act on one command line. '''
+        self.ncommands += 1
+        cmd = line.upper()
+        echo = line + '\r\n'
+        nfiles = self.recorder.nfiles
+        if cmd == 'TS?':
+            t = time.strftime('%y/%m/%d,%H:%M:%S', time.gmtime(self.clock()))
+            if self.model == 'BB':
+                self.reply(echo + 'TS = %s\r\n>' % t)
+            else:
+                self.reply(echo + 'TS %s --- Time Set (yr/mon/day,hr:min:sec)'
+                                  '\r\n>' % t)
+        elif cmd.startswith('TS') and len(cmd) >= 14:
+            try:
+                t = calendar.timegm(time.strptime(cmd[2:14], '%y%m%d%H%M%S'))
+                self.clock_offset = t - time.time()
+                self.reply(echo + '>')
+            except ValueError:
+                self.reply(echo + 'ERR 010:  ILLEGAL TIME\r\n>')
+        elif cmd == 'RA':
+            if self.model == 'BB':
+                self.reply(echo + 'FILES: %d\r\n>' % nfiles)
+            else:
+                self.reply(echo + '%d\r\n>' % nfiles)
+        elif cmd == 'RS':
+            used = self.recorder.used() // 1000000
+            self.reply(echo + 'RS = %05d,%05d ----- RECORDER SPACE used/free'
+                              ' (MB)\r\n>' % (used, 2000 - used))
+        elif cmd == 'RF':
+            used = self.recorder.used()
+            self.reply(echo + 'RF = %d,%d ----- RECORDER SPACE used/free'
+                              ' (bytes)\r\n>' % (used, 2000000000 - used))
+        elif cmd == 'RR':
+            lines = ['Recorder Directory:']
+            for i in range(nfiles):
+                lines.append('%s  %10d bytes' % (self.recorder.filename(i),
+                                                  self.recorder.size(i)))
+            self.reply(echo + '\r\n'.join(lines) + '\r\n>')
+        elif cmd == 'RE ERASE':
+            self.recorder.erase()
+            self.reply(echo + '[ERASING...]\r\n>')
+        elif cmd == 'CK':
+            self.reply(echo + '[Parameters saved as USER defaults]\r\n>')
+        elif cmd == 'CS':
+            self.reply(echo)
+            self.state = 'pinging'
+        elif cmd == 'CZ':
+            self.reply(echo + powering_down[self.model].decode('ascii'))
+            self.state = 'asleep'
+        elif cmd.startswith('CB') and len(cmd) >= 3 and cmd[2].isdigit():
+            self.reply(echo + '>')
+            self.baud = baud_codes.get(int(cmd[2]), self.baud)
+            self.garble_until = time.time() + self.baud_settle
+        elif cmd.startswith('RY'):
+            self.serve_ymodem(cmd[2:].strip())
+        else:
+            self.reply(echo + '>')
+
+    def serve_ymodem(self, arg):
+        nfiles = self.recorder.nfiles
+        if arg:
+            try:
+                ifiles = [int(arg) - 1]
+            except ValueError:
+                ifiles = []
+        else:
+            ifiles = list(range(nfiles))
+        if not ifiles or not all(0 <= i < nfiles for i in ifiles):
+            self.reply('RY%s\r\nERR 027:  FILE NOT FOUND\r\n>' % arg)
+            return
+        if self.model == 'BB':
+            self.reply('RY%s\r\n' % arg)
+        else:
+            self.reply('RY%s\r\nStart your YMODEM receive now\r\n' % arg)
+        files = [(self.recorder.filename(i), self.recorder.data(i),
+                  time.time()) for i in ifiles]
+        corrupt = None
+        if self.noise:
+            corrupt = lambda frame: self._damage(frame, self.noise)
+        self.sender = YmodemSender(self.master, corrupt=corrupt,
+                                   write=self.write)
+        try:
+            self.sender.send(files)
+        except YmodemError as exc:
+            L.warning('simulator YMODEM send: %s', exc)
+        L.info('simulator YMODEM send: %s', self.sender.stats.summary())
+        time.sleep(0.2)
+        self.write(b'\r\n>')
+
+
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [options]')
+    op.add_option('-m', '--model', dest='model', default='WH',
+                  help='WH, BB, or OS; default is WH')
+    op.add_option('-n', '--nfiles', dest='nfiles', type='int', default=1,
+                  help='number of recorder files; default is 1')
+    op.add_option('-s', '--mbytes', dest='mbytes', type='float', default=1.0,
+                  help='size of each recorder file in MB; default is 1')
+    op.add_option('-d', '--delay', dest='delay', type='float', default=0.0,
+                  help='response delay in seconds')
+    op.add_option('-p', '--pace', dest='pace', action='store_true',
+                  default=False,
+                  help='limit output to the simulated baud rate')
+    op.add_option('--noise', dest='noise', type='float', default=0.0,
+                  help='probability of damage to each YMODEM byte')
+    o, a = op.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    recorder = SyntheticRecorder(nfiles=o.nfiles,
+                                 nbytes=int(o.mbytes * 1000000))
+    sim = RdiSimulator(o.model, recorder=recorder, delay=o.delay,
+                       pace=o.pace, noise=o.noise).start()
+    print('%s simulator on %s; wakes on %r' % (o.model, sim.device,
+                                               sim.soft_break))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+
+
+if __name__ == '__main__':
+    main()
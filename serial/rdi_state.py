@@ -0,0 +1,138 @@
+'''
+Structured state of an RDI instrument, parsed from its replies.
+
+A RecorderState holds what the instrument has said since it was
+last woken: model and firmware (from the banner), the number of
+recorder files (RA), recorder space (RS, RF), the file list (RR)
+and the clock (TS?).  RdiProtocol starts a new one at each
+wakeup and feeds it every reply taken from the receive buffer,
+so a value already known in the session is used without asking
+again, and nothing has to be found in the display.
+
+The parsers accept the replies of WorkHorse and Broadband
+firmware seen so far; anything not understood leaves the field
+as None.
+'''
+
+import re
+import time
+import calendar
+
+import logging
+L = logging.getLogger()
+
+_int_re = re.compile(r'\b(\d+)\b')
+_pair_re = {'RS': re.compile(r'RS\s*=\s*(\d+)\s*,\s*(\d+)'),
+            'RF': re.compile(r'RF\s*=\s*(\d+)\s*,\s*(\d+)')}
+_file_re = re.compile(r'^\s*(\S+\.\d{3})[^\d\n]+(\d+)', re.M)
+_ts_re = re.compile(r'(\d\d/\d\d/\d\d,\d\d:\d\d:\d\d)')
+_version_re = re.compile(r'Version\s+([\d.]+)')
+
+
+def _text(reply):
+    if isinstance(reply, bytes):
+        reply = reply.decode('ascii', 'replace')
+    return reply.replace('\r', '')
+
+
+def _after_echo(text, cmd):
+    ''' The reply without the echoed command and the prompt. '''
+    i = text.find(cmd)
+    if i != -1:
+        text = text[i + len(cmd):]
+    return text.rstrip('>').strip()
+
+
+class RecorderState(object):
+    def __init__(self, banner=None):
+        self.t_wakeup = time.time()
+        self.banner = None
+        self.model = None         # 'WH', 'BB', 'OS', or None
+        self.firmware = None
+        self.nfiles = None        # RA
+        self.space_mb = None      # RS: (used, free) megabytes
+        self.space_bytes = None   # RF: (used, free) bytes
+        self.files = None         # RR: list of (name, nbytes)
+        self.clock = None         # TS?: (ADCP, PC) Unix seconds
+        self.replies = {}         # command: last reply text
+        if banner is not None:
+            self.parse_banner(banner)
+
+    def parse_banner(self, banner):
+        text = _text(banner)
+        self.banner = text.strip()
+        if 'WorkHorse' in text:
+            self.model = 'WH'
+        elif 'Broadband' in text:
+            self.model = 'BB'
+        elif 'Ocean Surveyor' in text:
+            self.model = 'OS'
+        m = _version_re.search(text)
+        if m:
+            self.firmware = m.group(1)
+
+    def known(self, cmd):
+        ''' True if the reply to *cmd* is already in hand. '''
+        attr = {'RA': 'nfiles', 'RS': 'space_mb',
+                'RF': 'space_bytes', 'RR': 'files'}.get(cmd.strip().upper())
+        return attr is not None and getattr(self, attr) is not None
+
+    def parse(self, cmd, reply, t_sent=None):
+        '''
+        Update the state from the *reply* to *cmd*; *t_sent* is
+        the PC time the command was sent (for TS?).
+        '''
+        cmd = cmd.strip()
+        key = cmd.upper()
+        text = _after_echo(_text(reply), cmd)
+        self.replies[key] = text
+        try:
+            if key == 'RA':
+                m = _int_re.search(text)
+                if m:
+                    self.nfiles = int(m.group(1))
+            elif key in _pair_re:
+                m = _pair_re[key].search(text)
+                if m:
+                    value = (int(m.group(1)), int(m.group(2)))
+                    if key == 'RS':
+                        self.space_mb = value
+                    else:
+                        self.space_bytes = value
+            elif key == 'RR':
+                self.files = [(name, int(n))
+                              for name, n in _file_re.findall(text)]
+            elif key == 'TS?':
+                m = _ts_re.search(text)
+                if m:
+                    t = calendar.timegm(time.strptime(m.group(1),
+                                                      '%y/%m/%d,%H:%M:%S'))
+                    if t_sent is None:
+                        t_sent = time.time()
+                    self.clock = (t, t_sent)
+            elif key.startswith('TS'):
+                self.clock = None             # clock was set
+            elif key == 'RE ERASE':
+                self.nfiles = 0
+                self.files = []
+                self.space_mb = self.space_bytes = None
+        except ValueError:
+            L.warning("Can't parse reply to %s: %r", cmd, text)
+
+    def clock_offset(self):
+        ''' PC - ADCP in seconds, from the last TS?, or None. '''
+        if self.clock is None:
+            return None
+        t_adcp, t_pc = self.clock
+        return t_pc - t_adcp
+
+    def summary(self):
+        parts = ['%s %s' % (self.model or 'instrument',
+                            self.firmware or '(firmware unknown)')]
+        if self.nfiles is not None:
+            parts.append('%d recorder files' % self.nfiles)
+        if self.space_mb is not None:
+            parts.append('%d MB used, %d MB free' % self.space_mb)
+        if self.clock is not None:
+            parts.append('PC-ADCP %.0f s' % self.clock_offset())
+        return ', '.join(parts)
@@ -0,0 +1,212 @@
+'''
+Integrity check for downloaded RDI (BB, WH) recorder files.
+
+The file is memory-mapped and walked with the same rules as
+ser_subs.c block_size() and checksum_bad() for BLOCK_OS:
+
+  - an ensemble starts with 0x7f 0x7f;
+  - bytes 2-3 are the little-endian ensemble length nb, which
+    must satisfy 117 < nb < NBUF (8192);
+  - the 2 bytes after the ensemble are the little-endian sum of
+    its nb bytes, mod 65536;
+  - after a bad checksum the search resumes 1 byte further on.
+
+All candidate headers, lengths and checksums are computed at once
+with NumPy; only the chaining from one good ensemble to the next
+is a Python loop, with one step per good ensemble.
+
+The result, with a SHA-256 of the file, is written as a JSON
+sidecar, FILE.verify.json:
+
+    python -m uhdas.serial.rdi_verify file [file ...]
+'''
+from __future__ import print_function
+
+import os, sys, time
+import json
+import hashlib
+
+import numpy as np
+
+NBUF = 8192          # as in serial_c/ser.h
+min_nbytes = 117     # block_size() requires nb > 117
+
+
+def sha256_file(filename, chunk=4 * 1024 * 1024):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def find_ensembles(a):
+    '''
+    Given a uint8 array, return (starts, lengths, nbad, partial):
+    the offsets and lengths (nb, without checksum) of the good
+    ensembles in file order; the number of candidate headers with
+    a bad checksum outside good ensembles; and the offset of an
+    incomplete ensemble at the end, or -1.
+    '''
+    n = len(a)
+    empty = np.zeros(0, dtype=np.int64)
+    if n < 4:
+        return empty, empty, 0, -1
+    cand = np.flatnonzero((a[:-3] == 0x7f) & (a[1:-2] == 0x7f))
+    nb = a[cand + 2].astype(np.int64) | (a[cand + 3].astype(np.int64) << 8)
+    ok = (nb > min_nbytes) & (nb < NBUF)
+    cand = cand[ok]
+    nb = nb[ok]
+
+    complete = cand + nb + 2 <= n
+    partial = cand[~complete]
+    cand = cand[complete]
+    nb = nb[complete]
+
+    # Sum each candidate ensemble with one reduceat over the
+    # interleaved (start, end) offsets; the even-numbered results
+    # are the ensembles, and no file-sized temporary is needed.
+    # The uint16 accumulator wraps exactly as the checksum does.
+    end = cand + nb
+    if len(cand):
+        bounds = np.empty(2 * len(cand), dtype=np.int64)
+        bounds[0::2] = cand
+        bounds[1::2] = end
+        cs = np.add.reduceat(a, bounds, dtype=np.uint16)[0::2]
+    else:
+        cs = np.zeros(0, dtype=np.uint16)
+    block_cs = a[end].astype(np.uint16) | (a[end + 1].astype(np.uint16) << 8)
+    good = cs == block_cs
+
+    gstart = cand[good]
+    gnb = nb[good]
+
+    # Chain: the next ensemble is the first good one at or after
+    # the end of the previous one.
+    starts = []
+    lengths = []
+    i = 0
+    ngood = len(gstart)
+    while i < ngood:
+        starts.append(gstart[i])
+        lengths.append(gnb[i])
+        stop = gstart[i] + gnb[i] + 2
+        i += 1
+        if i < ngood and gstart[i] < stop:
+            i = np.searchsorted(gstart, stop)
+    starts = np.array(starts, dtype=np.int64)
+    lengths = np.array(lengths, dtype=np.int64)
+
+    def outside(offsets):
+        if not len(starts):
+            return offsets
+        j = np.searchsorted(starts, offsets, side='right') - 1
+        inside = (j >= 0) & (offsets < starts[j] + lengths[j] + 2)
+        return offsets[~inside]
+
+    nbad = len(outside(cand[~good]))
+    partial = outside(partial)
+    if len(partial):
+        partial = int(partial[0])
+    else:
+        partial = -1
+    return starts, lengths, nbad, partial
+
+
+def verify_file(filename, callback=None):
+    '''
+    Return a dictionary describing the integrity of *filename*.
+    *callback(a, starts, lengths)*, if given, is called with the
+    file's uint8 array and its good ensembles, so other work on
+    them (e.g. rdi_index.index_from) needs no second pass.
+    '''
+    t0 = time.time()
+    nbytes = os.path.getsize(filename)
+    if nbytes:
+        a = np.memmap(filename, dtype=np.uint8, mode='r')
+    else:
+        a = np.zeros(0, dtype=np.uint8)
+    starts, lengths, nbad, partial = find_ensembles(a)
+    if callback is not None:
+        callback(a, starts, lengths)
+    del a
+    if len(starts):
+        last_end = int(starts[-1] + lengths[-1] + 2)
+        first = int(starts[0])
+    else:
+        last_end = 0
+        first = 0
+    nused = int((lengths + 2).sum())
+    result = dict(filename=os.path.basename(filename),
+                  nbytes=nbytes,
+                  sha256=sha256_file(filename),
+                  good_ensembles=len(starts),
+                  bad_ensembles=nbad,
+                  leading_bytes=first,
+                  junk_bytes=last_end - first - nused,
+                  tail_bytes=nbytes - last_end,
+                  truncated_tail=partial >= last_end,
+                  ensemble_bytes_min=int(lengths.min()) if len(lengths) else 0,
+                  ensemble_bytes_max=int(lengths.max()) if len(lengths) else 0,
+                  verify_seconds=0.0,
+                  verified=time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime()))
+    result['ok'] = (result['good_ensembles'] > 0 and nbad == 0 and
+                    result['junk_bytes'] == 0 and result['tail_bytes'] == 0)
+    result['verify_seconds'] = round(time.time() - t0, 3)
+    return result
+
+
+def summary(result):
+    ''' One-line description of a verify_file() result. '''
+    s = ('%(filename)s: %(good_ensembles)d good, %(bad_ensembles)d bad '
+         'ensembles; %(junk_bytes)d junk bytes, %(tail_bytes)d tail bytes'
+         % result)
+    if result['truncated_tail']:
+        s += ' (truncated ensemble at end)'
+    if result['leading_bytes']:
+        s += '; %d bytes before first ensemble' % result['leading_bytes']
+    if not result['ok']:
+        s += '; CHECK FILE'
+    return s
+
+
+def sidecar_name(filename):
+    return filename + '.verify.json'
+
+
+def write_sidecar(result, filename):
+    ''' Write *result* next to data file *filename*; return its name. '''
+    fn = sidecar_name(filename)
+    with open(fn, 'w') as f:
+        json.dump(result, f, indent=1, sort_keys=True)
+        f.write('\n')
+    return fn
+
+
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [--no-sidecar] file [file ...]')
+    op.add_option('-n', '--no-sidecar', dest='sidecar',
+                  action='store_false', default=True,
+                  help='only print the results')
+    o, a = op.parse_args()
+    if not a:
+        op.error('at least one file is required')
+    status = 0
+    for fn in a:
+        result = verify_file(fn)
+        print(summary(result))
+        print('   sha256 %s, %.2f s' % (result['sha256'],
+                                       result['verify_seconds']))
+        if o.sidecar:
+            write_sidecar(result, fn)
+        if not result['ok']:
+            status = 1
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+'''
+Replay recorded serial data to several ports at once, with the
+original timing, for load-testing the loggers offline.
+
+Each stream sends one or more files to one port.  Messages and
+their times come from
+
+  - FILE.raw with its FILE.raw.log (ser_bin): the offset, size
+    and monotonic time of each block;
+  - time-tagged ascii (ser_asc -T): a "$UNIXD,dday,monotonic"
+    line before each message;
+  - any other file: the serialport.writer formats (line,
+    dosline, ens, nbraw, osraw), one message every *gap* s.
+
+The intervals between messages are divided by *speed*; with
+speed 0 messages go out as fast as the baud rate allows.  The
+line time of each message (10 bits per byte) is always honoured,
+so a pty is paced like the real port.  All streams run on one
+asyncio event loop; for each, the achieved byte rate and the
+lateness of the messages are reported against the target.
+
+    python -m uhdas.serial.replay [--speed 10] /dev/ttyS1@4800:gps.txt \
+                                  pty:adcp.raw,adcp2.raw
+
+A device of "pty" makes a new pseudo-terminal; its slave name is
+printed for the program under test to open.
+'''
+from __future__ import print_function
+
+import os, sys, time, tty, pty
+import fcntl, termios, struct
+import asyncio
+
+import logging
+L = logging.getLogger()
+
+from uhdas.serial.serialport import writer
+from uhdas.serial.aioserial import AsyncSerialPort, SerialTransport, SerialReader
+
+
+def raw_log_messages(filename):
+    ''' (seconds, bytes) for each block of a ser_bin .raw file. '''
+    with open(filename, 'rb') as f, open(filename + '.log') as log:
+        for line in log:
+            # pc_dday offset nbytes [pingnum ping_dday] monotonic_dday
+            tokens = line.split()
+            if len(tokens) < 4:
+                continue
+            try:
+                offset = int(tokens[1])
+                nbytes = int(tokens[2])
+                t = float(tokens[-1]) * 86400
+            except ValueError:
+                continue
+            f.seek(offset)
+            data = f.read(nbytes)
+            if len(data) < nbytes:
+                break
+            yield t, data
+
+
+def unixd_messages(filename):
+    ''' (seconds, bytes) for each message of a time-tagged ascii file. '''
+    t = None
+    lines = []
+    with open(filename, 'rb') as f:
+        for line in f:
+            if line.startswith(b'$UNIXD,'):
+                if t is not None and lines:
+                    yield t, b''.join(lines)
+                fields = line.split(b',')
+                try:
+                    t = float(fields[-1]) * 86400  # monotonic if present
+                except ValueError:
+                    t = None
+                lines = []
+            elif t is not None:
+                lines.append(line)
+    if t is not None and lines:
+        yield t, b''.join(lines)
+
+
+def gap_messages(filename, format='line', gap=1.0):
+    ''' (seconds, bytes) for the messages of a serialport.writer format. '''
+    w = writer(None, format=format, gap=gap, verbose=False)
+    with open(filename, 'rb') as f:
+        for i, block in enumerate(w.blocks(f)):
+            yield i * gap, block
+
+
+def file_messages(filename, format='line', gap=1.0):
+    ''' Messages of *filename*, timed as its type allows. '''
+    if os.path.exists(filename + '.log') and not filename.endswith('.log'):
+        return raw_log_messages(filename)
+    with open(filename, 'rb') as f:
+        first = f.readline()
+    if first.startswith(b'$UNIXD,'):
+        return unixd_messages(filename)
+    return gap_messages(filename, format, gap)
+
+
+class PtyPort(object):
+    '''
+    The master side of a new pty, standing in for a serial_port
+    in SerialTransport; the program under test opens the slave,
+    self.slave_name.
+    '''
+    def __init__(self):
+        self.fd, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.slave_name = os.ttyname(self.slave)
+
+    def get_device(self):
+        return self.slave_name
+
+    def unread(self):
+        ''' Bytes written but not yet read from the slave. '''
+        buf = fcntl.ioctl(self.slave, termios.TIOCINQ, b'\0\0\0\0')
+        return struct.unpack('i', buf)[0]
+
+    async def drained(self, timeout=10):
+        ''' Wait for the program on the slave to read everything, since
+        closing the pty discards what is left.
+        '''
+        deadline = time.monotonic() + timeout
+        while self.unread() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def close_port(self, restore=True):
+        os.close(self.fd)
+        os.close(self.slave)
+
+
+class ReplayStream(object):
+    bits_per_byte = 10      # 8N1
+    max_buffered = 65536    # bytes written ahead before waiting
+
+    def __init__(self, device, filenames,
+                       baud=9600,
+                       format='line',
+                       gap=1.0,
+                       speed=1.0,
+                       max_gap=60.0):
+        '''
+        Send *filenames* to *device* ("pty" for a new pty) at
+        *baud*.  Intervals are divided by *speed* (0 for as fast as
+        the baud rate allows) after cutting any longer than
+        *max_gap* seconds, such as logging stops.
+        '''
+        self.filenames = filenames
+        self.baud = baud
+        self.format = format
+        self.gap = gap
+        self.speed = speed
+        self.max_gap = max_gap
+        self.pty = None
+        self.port = None
+        if device == 'pty':
+            self.pty = PtyPort()
+            device = self.pty.slave_name
+        self.device = device
+        self.nmessages = 0
+        self.nbytes = 0
+        self.t_start = None
+        self.t_end = None
+        self.t_target = None   # when the last message was due to end
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+        self.done = False
+
+    def messages(self):
+        for fn in self.filenames:
+            for t, data in file_messages(fn, self.format, self.gap):
+                yield t, data
+
+    async def _open(self):
+        if self.pty is not None:
+            loop = asyncio.get_running_loop()
+            transport = SerialTransport(loop, self.pty, SerialReader())
+            await asyncio.sleep(0)
+            return transport
+        self.port = AsyncSerialPort(self.device, baud=self.baud)
+        await self.port.open()
+        return self.port.transport
+
+    async def run(self):
+        transport = await self._open()
+        try:
+            now = time.monotonic()
+            self.t_start = target = line_free = now
+            t_prev = None
+            for t, data in self.messages():
+                if not self.speed:
+                    target = line_free
+                elif t_prev is not None:
+                    dt = min(max(0.0, t - t_prev), self.max_gap)
+                    target += dt / self.speed
+                t_prev = t
+                due = max(target, line_free)
+                now = time.monotonic()
+                if due > now:
+                    await asyncio.sleep(due - now)
+                    now = time.monotonic()
+                transport.write(data)
+                line_free = (max(now, line_free)
+                             + len(data) * self.bits_per_byte / self.baud)
+                lag = now - target
+                self.lag_max = max(self.lag_max, lag)
+                self.lag_total += lag
+                self.nmessages += 1
+                self.nbytes += len(data)
+                self.t_target = target + (len(data) * self.bits_per_byte
+                                          / self.baud)
+                if transport.get_write_buffer_size() > self.max_buffered:
+                    await transport.flushed()
+            await transport.flushed()
+            # The last message is sent when it has left the line.
+            self.t_end = max(time.monotonic(), line_free)
+            if self.pty is not None:
+                await self.pty.drained()
+        finally:
+            self.done = True
+            transport.close()
+
+    def status(self):
+        ''' Counts, and achieved and target rates in bytes/s. '''
+        st = dict(device=self.device, messages=self.nmessages,
+                  nbytes=self.nbytes, rate=0.0, target_rate=0.0,
+                  lag_mean=0.0, lag_max=self.lag_max, done=self.done)
+        if self.t_start is None or not self.nmessages:
+            return st
+        end = self.t_end or time.monotonic()
+        if end > self.t_start:
+            st['rate'] = self.nbytes / (end - self.t_start)
+        line_rate = self.baud / float(self.bits_per_byte)
+        if self.speed and self.t_target > self.t_start:
+            st['target_rate'] = min(line_rate, self.nbytes /
+                                    (self.t_target - self.t_start))
+        else:
+            st['target_rate'] = line_rate
+        if self.nmessages:
+            st['lag_mean'] = self.lag_total / self.nmessages
+        return st
+
+    def summary(self):
+        st = self.status()
+        pct = 0.0
+        if st['target_rate']:
+            pct = 100.0 * st['rate'] / st['target_rate']
+        return ('%(device)s: %(messages)d messages, %(nbytes)d bytes, '
+                % st + '%.0f of %.0f bytes/s (%.0f%%), late mean %.3f '
+                's max %.3f s' % (st['rate'], st['target_rate'], pct,
+                                  st['lag_mean'], st['lag_max']))
+
+
+class Replayer(object):
+    ''' Runs several ReplayStreams on one event loop. '''
+    def __init__(self, streams, report_interval=None, report=print):
+        self.streams = streams
+        self.report_interval = report_interval
+        self.report = report
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            for s in self.streams:
+                self.report(s.summary())
+
+    async def _run(self):
+        reporter = None
+        if self.report_interval:
+            reporter = asyncio.ensure_future(self._report())
+        try:
+            await asyncio.gather(*[s.run() for s in self.streams])
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+
+    def run(self):
+        asyncio.run(self._run())
+
+    def summary(self):
+        return '\n'.join(s.summary() for s in self.streams)
+
+
+def parse_stream(arg, **kwargs):
+    ''' "device[@baud]:file[,file...]" to a ReplayStream. '''
+    device, files = arg.split(':', 1)
+    if '@' in device:
+        device, baud = device.split('@', 1)
+        kwargs['baud'] = int(baud)
+    return ReplayStream(device, files.split(','), **kwargs)
+
+
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [options] device[@baud]:file[,file...] ...')
+    op.add_option('-s', '--speed', dest='speed', type='float', default=1.0,
+                  help='speed factor; 0 for as fast as the baud rate allows')
+    op.add_option('-b', '--baud', dest='baud', type='int', default=9600,
+                  help='default baud rate; default is 9600')
+    op.add_option('-f', '--format', dest='format', default='line',
+                  help='line, dosline, ens, nbraw, or osraw, for files '
+                       'without timing; default is line')
+    op.add_option('-g', '--gap', dest='gap', type='float', default=1.0,
+                  help='seconds between messages for files without timing')
+    op.add_option('--max-gap', dest='max_gap', type='float', default=60.0,
+                  help='longest interval replayed, in original seconds')
+    op.add_option('-w', '--wait', dest='wait', type='float', default=0.0,
+                  help='seconds to wait before starting, e.g. to start '
+                       'a logger on a pty')
+    op.add_option('-r', '--report', dest='report', type='float', default=10.0,
+                  help='seconds between progress reports; 0 for none')
+    o, a = op.parse_args()
+    if not a:
+        op.error('at least one stream is required')
+    logging.basicConfig(level=logging.WARNING)
+
+    streams = [parse_stream(arg, baud=o.baud, format=o.format, gap=o.gap,
+                            speed=o.speed, max_gap=o.max_gap) for arg in a]
+    for s in streams:
+        if s.pty is not None:
+            print('pty %s: %s' % (s.device, ', '.join(s.filenames)))
+    sys.stdout.flush()
+    time.sleep(o.wait)
+    R = Replayer(streams, report_interval=o.report or None)
+    try:
+        R.run()
+    except KeyboardInterrupt:
+        pass
+    print(R.summary())
+
+
+if __name__ == '__main__':
+    main()
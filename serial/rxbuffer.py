@@ -0,0 +1,148 @@
+'''
+Bounded receive buffer for the serial terminals.
+
+Incoming characters are kept as a list of chunks rather than
+a single bytes object, so appending is cheap and the memory
+used is capped.  Positions are absolute offsets into the
+stream of received bytes; they keep increasing when the
+buffer is cleared, consumed, or trimmed, so a search can
+resume where it left off and look only at the new bytes.
+'''
+
+from collections import deque
+
+
+class RxBuffer(object):
+    def __init__(self, maxbytes=2 * 1024 * 1024):
+        self.maxbytes = maxbytes
+        self._chunks = deque()
+        self._nbytes = 0
+        self.begin = 0      # absolute offset of the first byte held
+        self.end = 0        # absolute offset after the last byte held
+        self.ndropped = 0   # bytes discarded to stay within maxbytes
+
+    def __len__(self):
+        return self._nbytes
+
+    def append(self, data):
+        if not data:
+            return
+        self._chunks.append(bytes(data))
+        self._nbytes += len(data)
+        self.end += len(data)
+        if self._nbytes > self.maxbytes:
+            self._drop(self._nbytes - self.maxbytes)
+
+    def clear(self):
+        self._chunks.clear()
+        self._nbytes = 0
+        self.begin = self.end
+
+    def _drop(self, n):
+        ''' Discard the oldest *n* bytes, whole chunks at a time
+        where possible.
+        '''
+        self.ndropped += n
+        self.begin += n
+        self._nbytes -= n
+        while n:
+            chunk = self._chunks[0]
+            if len(chunk) <= n:
+                self._chunks.popleft()
+                n -= len(chunk)
+            else:
+                self._chunks[0] = chunk[n:]
+                n = 0
+
+    def _tail(self, start):
+        ''' Return (offset, bytes) for everything from absolute
+        offset *start* to the end, joining only the chunks needed.
+        '''
+        start = max(start, self.begin)
+        if start >= self.end:
+            return self.end, b''
+        parts = []
+        pos = self.end
+        for chunk in reversed(self._chunks):
+            parts.append(chunk)
+            pos -= len(chunk)
+            if pos <= start:
+                break
+        parts.reverse()
+        return start, b''.join(parts)[start - pos:]
+
+    def getvalue(self, start=None):
+        ''' Return the bytes held, optionally from absolute offset *start*.
+        '''
+        if start is None:
+            start = self.begin
+        return self._tail(start)[1]
+
+    def rfind(self, s, start=None):
+        ''' Absolute offset of the last occurrence of *s* at or
+        after *start*, or -1.
+        '''
+        if start is None:
+            start = self.begin
+        offset, data = self._tail(start)
+        ind = data.rfind(s)
+        if ind == -1:
+            return -1
+        return offset + ind
+
+    def finditer(self, regex, start=None):
+        ''' Iterate over matches of the compiled *regex* in the bytes
+        from *start*; match positions are relative to max(start, begin).
+        '''
+        if start is None:
+            start = self.begin
+        return regex.finditer(self._tail(start)[1])
+
+    def consume(self, stop):
+        ''' Remove and return the bytes before absolute offset *stop*.
+        '''
+        stop = min(stop, self.end)
+        if stop <= self.begin:
+            return b''
+        n = stop - self.begin
+        parts = []
+        got = 0
+        while got < n:
+            chunk = self._chunks.popleft()
+            if got + len(chunk) > n:
+                keep = got + len(chunk) - n
+                self._chunks.appendleft(chunk[-keep:])
+                chunk = chunk[:-keep]
+            parts.append(chunk)
+            got += len(chunk)
+        self._nbytes -= n
+        self.begin = stop
+        return b''.join(parts)
+
+    def scanner(self, s):
+        return Scanner(self, s)
+
+
+class Scanner(object):
+    ''' Incremental search for a fixed string in an RxBuffer.
+
+    Each call to search() looks only at bytes that arrived since
+    the previous call, plus an overlap of len(s) so a match that
+    straddles two arrivals is still found.
+    '''
+    def __init__(self, rxbuf, s):
+        if isinstance(s, str):
+            s = s.encode('utf-8')
+        self.rxbuf = rxbuf
+        self.s = s
+        self.pos = rxbuf.begin
+
+    def search(self):
+        ''' Return the absolute offset of the last new match, or -1.
+        '''
+        ind = self.rxbuf.rfind(self.s, self.pos)
+        if ind == -1:
+            self.pos = max(self.pos, self.rxbuf.end - len(self.s))
+        else:
+            self.pos = ind + len(self.s)
+        return ind
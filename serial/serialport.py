@@ -11,6 +11,7 @@ from future.builtins import object
 import termios, sys, os, tty, time, struct, select
 
 from uhdas.serial import sp_lock
+from uhdas.serial.baud_settle import get_profile
 
 baud_table = {300       :  termios.B300,
               600       :  termios.B600,
@@ -65,6 +66,7 @@ class serial_port(object):
         self.fd = None
         self.is_open = 0
         self.old_tios = None
+        self.soft_break = None  # bytes to send instead of a break
 
     def open_port(self, save=True):
         if self.is_open:
@@ -91,15 +93,24 @@ class serial_port(object):
         self.is_open = 0
 
     def set_baud(self, baud):
+        if self.set_speed(baud):
+            # Some ports need a delay; as long as this one has
+            # needed before (see baud_settle), at most 0.5 s.
+            time.sleep(get_profile().delay(self.__device))
+
+    def set_speed(self, baud):
+        ''' Set the baud rate without waiting for it to settle;
+        return True if it changed.
+        '''
         self.__baud = baud;
         self.open_port()
         tios = termios.tcgetattr(self.fd)
         if tios[ospeed] == baud_table[baud]:
-            return
+            return False
         tios[ospeed] = baud_table[baud] # Output speed
         tios[ispeed] = termios.B0    # Input speed (B0 => match output)
         termios.tcsetattr(self.fd, termios.TCSAFLUSH, tios)
-        time.sleep(0.5) # some ports need this delay
+        return True
 
 
     def get_baud(self):
@@ -150,81 +161,90 @@ class serial_port(object):
 
     def send_break(self, quarters = 0): # 0 is 0.25 to 0.5 s
         self.open_port()
+        if self.soft_break:
+            # e.g., b'===' for an RDI instrument; a pty can't carry a break
+            os.write(self.fd, self.soft_break)
+            termios.tcdrain(self.fd)
+            return
         termios.tcsendbreak(self.fd, quarters)  # 2 should ensure at least 0.5 s
 
 class writer(object):
     ''' Given a serial_port object, write various file types.
+
+    The *_blocks generators split a file into the messages that
+    are written one per *gap* seconds; replay.py uses them to
+    drive several ports at once with proper timing.
     '''
-    def __init__(self, port, format = 'line', gap = 1):
-        write_table = {'line':self.line_write,
-                       'dosline':self.dosline_write,
-                       'ens':self.ensemble_write,
-                       'nbraw':self.nbraw_write,
-                       'osraw':self.osraw_write}
-        self.write = write_table[format]
+    def __init__(self, port, format = 'line', gap = 1, verbose = True):
+        block_table = {'line':self.line_blocks,
+                       'dosline':self.dosline_blocks,
+                       'ens':self.ensemble_blocks,
+                       'nbraw':self.nbraw_blocks,
+                       'osraw':self.osraw_blocks}
+        self.blocks = block_table[format]
+        self.format = format
         self.port = port  # serial_port instance
         self.gap = gap
+        self.verbose = verbose
 
-    def line_write(self, sourcefile):
+    @staticmethod
+    def line_blocks(sourcefile):
         while 1:
             line = sourcefile.readline()
-            if line == '':
+            if not line:
                 break
-            print(line)
-            self.port.stream.write(line)
-            self.port.stream.flush()
-            time.sleep(self.gap)
+            yield line
 
-    def dosline_write(self, sourcefile):
+    @staticmethod
+    def dosline_blocks(sourcefile):
         while 1:
             line = sourcefile.readline()
-            if line == '':
+            if not line:
                 break
-            #print line,
-            self.port.stream.write(line.rstrip() + '\r\n')
-            self.port.stream.flush()
-            time.sleep(self.gap)
-
+            yield line.rstrip() + b'\r\n'
 
-    def ensemble_write(self, sourcefile):
+    @staticmethod
+    def ensemble_blocks(sourcefile):
         finished = None
         while not finished:
+            chunks = []
             for ichunk in range(8):
                 chunk = sourcefile.read(128)
                 if len(chunk) != 128:
                     finished = 1
                     break
-                self.port.stream.write(chunk)
-                self.port.stream.flush()
-            time.sleep(self.gap)
-
+                chunks.append(chunk)
+            if chunks:
+                yield b''.join(chunks)
 
-    def osraw_write(self, sourcefile):
+    @staticmethod
+    def osraw_blocks(sourcefile):
         while 1:
             chunk1 = sourcefile.read(4)
             if len(chunk1) != 4:
                 break
             nbytes = struct.unpack('<xxH', chunk1)[0]
             chunk2 = sourcefile.read(nbytes - 2);
-            block = chunk1 + chunk2
-            #self.stream.write(block)
-            #self.stream.flush()
-            os.write(self.port.fd, block)
-            print('%d  %d' % (nbytes, len(block)))
-            time.sleep(self.gap)
+            yield chunk1 + chunk2
 
-    def nbraw_write(self, sourcefile):
+    @staticmethod
+    def nbraw_blocks(sourcefile):
         while 1:
             chunk1 = sourcefile.read(2)
             if len(chunk1) != 2:
                 break
             nbytes = struct.unpack('>H', chunk1)[0]
             chunk2 = sourcefile.read(nbytes);
-            block = chunk1 + chunk2
-            #self.port.stream.write(block)
-            #self.port.stream.flush()
+            yield chunk1 + chunk2
+
+    def write(self, sourcefile):
+        for block in self.blocks(sourcefile):
             os.write(self.port.fd, block)
-            print('%d  %d' % (nbytes, len(block)))
+            if self.verbose:
+                if self.format == 'line':
+                    print(block)
+                elif self.format in ('osraw', 'nbraw'):
+                    print('%d  %d' % (len(block) - 2, len(block)))
             time.sleep(self.gap)
 
     def sendfiles(self, filenames):
@@ -13,6 +13,8 @@ from __future__ import print_function
 
 import os
 
+from uhdas.serial.port_inventory import get_inventory
+
 lock_dir = '/var/lock'
 
 pid = 0  # global, for reporting.
@@ -42,28 +44,9 @@ def is_locked(device):
                 1 if locked by this process,
                 2 if locked by another running process
     '''
-    fn = lock_file(device)
-    if not os.access(fn, os.F_OK):
-        return 0  # File does not exist; not locked.
-
-    line = open(fn).readline()     # Let these raise default exceptions for now.
-    field = line.split()[0]
     global pid
-    pid = int(field.strip())
-
-    try:
-        os.kill(pid, 0)
-    except OSError:
-        # Process is dead; delete the lock file.
-        try:
-            os.remove(fn)  # raise default exception for now
-        except OSError as e:
-            print(e)
-        return 0
-    if pid == os.getpid():
-        return 1
-    else:
-        return 2
+    status, pid = get_inventory(lock_dir=lock_dir).lock_status(device)
+    return status
 
 def check_lock(device):
     status = is_locked(device)
@@ -0,0 +1,463 @@
+'''
+GUI-free serial terminal engine.
+
+TerminalEngine holds everything a terminal does with the port:
+the listener thread, the receive buffer, waitfor/streamwaitfor,
+sending, and saving the incoming characters.  It runs without a
+display, so instrument sessions can be scripted, run in parallel
+threads, or benchmarked against a pseudo-terminal.
+
+tk_terminal.Tk_terminal is a thin Tk adapter on top of it; it
+overrides the small set of hooks near the end of the class
+(status, dialogs, scheduling) that are no-ops or logging here.
+'''
+from __future__ import print_function
+
+import termios, time
+from threading import Lock, Condition
+import queue
+
+import logging
+L = logging.getLogger()
+
+from uhdas.serial.serialport import serial_port
+from uhdas.serial import baud_settle
+from uhdas.serial.rxbuffer import RxBuffer
+from uhdas.serial.termstats import LatencyStats, UpdateStats
+from uhdas.serial.listener import PortListener
+from uhdas.serial.transcript import TranscriptView
+from uhdas.serial.diary import DiaryWriter
+
+
+class Timeout(Exception):
+    pass
+
+
+class Value(object):
+    ''' Minimal stand-in for a Tk StringVar or IntVar. '''
+    def __init__(self, value=None):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+class TerminalEngine(serial_port):
+    interactive = False    # True if the user can be asked questions
+
+    def __init__(self,
+                 device='/dev/ttyS0',
+                 baud=9600,
+                 termination=b'\r\n',
+                 maxbuffer=2 * 1024 * 1024,
+                 display=None,
+                 transcript=None):
+        '''
+        *display* is anything with the terminal_display text
+        interface; by default it is a TranscriptView, written to
+        the file *transcript* or to a temporary file.
+        '''
+        serial_port.__init__(self, device = device,
+                                   baud = baud,
+                                   mode = 'r+b');
+        self.termination = termination
+        if display is None:
+            display = TranscriptView(transcript)
+        self.display = display
+        self.buffer = RxBuffer(maxbytes=maxbuffer)
+        self.update_lock = Lock()
+        self.save = 0
+        self.outfile_name = "term_diary.txt"
+        self.outfile = None
+        self.diary_fsync_interval = 10  # seconds; None for per-cast only
+        self.new_input = queue.Queue(0)  # 0 -> unbounded size
+        # The listen thread bumps input_seq and notifies input_cond
+        # after each put, so waitfor can wake as soon as input arrives.
+        self.input_cond = Condition()
+        self.input_seq = 0
+        self.latency = LatencyStats()
+        # update() drains the queue for up to drain_budget seconds per
+        # tick; the display is redrawn at most max_renders times per
+        # second, with everything received in between in one insert.
+        self.drain_budget = 0.02
+        self.max_renders = 10
+        self.pending_display = []
+        self.last_render = 0
+        self.render_scheduled = False
+        self.ui_stats = UpdateStats()
+        self.listener = None
+        self.listening = 0
+        self.status = ''
+
+        self.update_search = None
+        self.update_scanner = None
+        self.update_search_callback = lambda x: None
+        # return True to end the update cycle
+
+    def wait_input(self, seq, timeout):
+        """
+        Block until input newer than *seq* has been queued, or
+        until *timeout* seconds have passed.
+        """
+        with self.input_cond:
+            if self.input_seq == seq and self.new_input.empty():
+                self.input_cond.wait(max(0, timeout))
+
+    def waitfor(self, s=None, timeout=5, quiet=0):
+        """
+        Wait for the string *s* to appear in the buffer; if *quiet*
+        is nonzero, first wait until the input has been quiet for
+        that many seconds.  Each stage times out after *timeout*
+        seconds.
+        """
+        timeout = max(0.2, int(timeout*10) / 10.0)
+        if quiet > 0:
+            nchar = self.buffer.end
+            deadline = time.time() + timeout
+            quiet_until = time.time() + quiet
+            while True:
+                seq = self.input_seq
+                self.update(oneshot=True)
+                now = time.time()
+                if self.buffer.end > nchar:
+                    nchar = self.buffer.end
+                    quiet_until = now + quiet
+                elif now >= quiet_until and (not s or len(self.buffer) > 0):
+                    break
+                if now >= deadline:
+                    raise Timeout
+                if s and len(self.buffer) == 0:
+                    wake = deadline
+                else:
+                    wake = min(deadline, quiet_until)
+                self.wait_input(seq, wake - now)
+        if not s:
+            self.render()
+            return ''
+        scanner = self.buffer.scanner(s)
+        deadline = time.time() + timeout
+        while True:
+            seq = self.input_seq
+            self.update(oneshot = True) ###
+            ind = scanner.search()
+            if ind != -1:
+                self.render()
+                return self.buffer.consume(ind + 1)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Timeout
+            self.wait_input(seq, remaining)
+
+    def streamwaitfor(self, s, timeout=2, maxnchar=50000):
+        """
+        Wait for the string *s* to appear in the buffer,
+        or until *timeout* seconds of no activity, or until
+        *maxnchar* have been received.
+        """
+        nchar = n_orig = self.buffer.end
+        idle = max(0.2, int(timeout*10) / 10.0)
+        scanner = self.buffer.scanner(s)
+        deadline = time.time() + idle
+        while True:
+            seq = self.input_seq
+            self.update(oneshot = True) ###
+            n = self.buffer.end
+            if n > nchar:
+                nchar = n
+                deadline = time.time() + idle
+            ind = scanner.search()
+            if ind != -1:
+                self.render()
+                return self.buffer.consume(ind + 1)
+            if n - n_orig >= maxnchar:
+                raise Timeout
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Timeout
+            self.wait_input(seq, remaining)
+
+    def clear_buffer(self):
+        self.buffer.clear()
+        if self.update_scanner is not None:
+            self.update_scanner.pos = self.buffer.end
+
+    def start_listening(self, save=True):
+        if self.listening:
+            self.clear_buffer()
+            return
+        self.open_port(save=save)      # Might already be open, but make sure.
+        self.listening = 1
+        self.listening_changed()
+        self.listen()
+        self.clear_buffer()
+        self.update()
+
+    def update(self, oneshot = False):
+        if not self.update_lock.acquire(False):
+            if self.listening and not oneshot:
+                self.schedule(50, self.update)
+            return
+        qdepth = self.new_input.qsize()
+        cclist = []
+        t_stop = time.time() + self.drain_budget
+        try:
+            # Drain until empty, but within the time budget, so a
+            # blast of input can't lock up the GUI.
+            while True:
+                cclist.append(self.new_input.get_nowait())
+                if time.time() > t_stop:
+                    break
+        except queue.Empty:
+            pass
+
+        cc = b''.join(cclist).replace(b'\r', b'')
+        self.ui_stats.tick(qdepth, len(cc))
+        if cc:
+            self.buffer.append(cc)
+            self.pending_display.append(cc)
+        if self.pending_display:
+            if time.time() - self.last_render >= 1.0 / self.max_renders:
+                self.render()
+            elif not self.render_scheduled:
+                self.render_scheduled = True
+                self.schedule(int(1000 / self.max_renders), self.render)
+
+        if cc:
+            if self.update_search:
+                ind = self.update_scanner.search()
+                if ind != -1:
+                    self.listening = False
+                    self.listener.stop()
+                    self.update_search_callback()
+                    self.update_search = None
+                    self.update_scanner = None
+        if self.listener is not None and self.listener.hangup:
+            self.port_hung_up()
+        if self.listening and not oneshot:
+            self.schedule(50, self.update)
+        self.update_lock.release()
+
+    def render(self):
+        ''' Show everything received since the last render in one insert.
+        '''
+        self.render_scheduled = False
+        if not self.pending_display:
+            return
+        t0 = time.time()
+        cc = b''.join(self.pending_display)
+        self.pending_display = []
+        self.display.append(cc)
+        self.refresh_display()
+        self.last_render = time.time()
+        self.ui_stats.render(len(cc), self.last_render - t0)
+
+    def stats_summary(self):
+        return ('Commands: %s\nDisplay: %s'
+                % (self.latency.summary(), self.ui_stats.summary()))
+
+    def set_update_search_callback(self, s, func):
+        self.update_lock.acquire()
+        self.update_search = s
+        self.update_scanner = self.buffer.scanner(s)
+        self.update_search_callback = func
+        self.update_lock.release()
+
+    def listen(self):
+        ''' Start the listener thread for the serial port.
+            It blocks in poll() until input arrives, so vmin and
+            vtime are both 0: a read after poll never blocks.
+        '''
+        if not self.fd:
+            return
+        self.set_cc(vmin = 0, vtime = 0)
+        termios.tcflush(self.fd, termios.TCIOFLUSH)
+        self.listener = PortListener(self.fd, self.receive,
+                                     on_stop=self.listener_stopped)
+        self.listener.start()
+
+    def listener_stopped(self, listener):
+        ''' Called in the listener thread when it has stopped by
+            itself; wake any waitfor, so that update() sees it.
+        '''
+        with self.input_cond:
+            self.input_seq += 1
+            self.input_cond.notify_all()
+
+    def port_hung_up(self):
+        ''' The listener stopped by itself, after a hangup (e.g. a
+            USB adapter unplugged) or a read error: stop listening
+            and close the port, which can't be used any more.
+        '''
+        L.warning("%s: port hung up; not listening", self.get_device())
+        self.stop_listening(restore=False)
+
+    def receive(self, cc):
+        ''' Called in the listener thread with each block read.
+        '''
+        self.new_input.put(cc)  # via queue to main thread
+        with self.input_cond:
+            self.input_seq += 1
+            self.input_cond.notify_all()
+        if self.save:
+            self.outfile.write(cc)
+
+    def stop_listening(self, restore=True):
+        if not self.listening:
+            return
+        self.listening = 0
+        self.listening_changed()
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        self.close_port(restore=restore)
+
+    def send(self, s):
+        '''Send a string, wait for its echo
+        '''
+        s = s.encode('ascii', 'ignore')
+        if self.termination:
+            self.stream.write(s + self.termination)
+            self.stream.flush()
+            self.waitfor(s)
+        else:                # for old NB: one character at a time
+            for i in range(len(s)):
+                self.stream.write(s[i:i+1])
+                self.stream.flush()
+                self.waitfor(s[i:i+1])
+
+    def close_terminal(self, event = ''):
+        self.stop_listening()
+        if self.save:
+            self.end_save()
+
+    def clear(self):
+        self.pending_display = []
+        self.display.clear()
+
+    def begin_save(self, filename = None):
+        ''' Start saving all received characters; raises IOError
+        if the file cannot be opened.
+        '''
+        if filename is not None:
+            self.outfile_name = filename
+        self.end_save()
+        self.outfile = DiaryWriter(self.outfile_name,
+                                   fsync_interval=self.diary_fsync_interval)
+        self.save = 1
+
+    def sync_diary(self):
+        ''' Force the saved input to disk, e.g., at the end of a cast. '''
+        if self.save:
+            self.outfile.sync()
+
+    def end_save(self):
+        try:
+            self.outfile.close()
+            L.info("Diary %s: %s", self.outfile_name, self.outfile.summary())
+        except:
+            pass
+        self.save = 0
+
+    def change_baud(self, baud = None, settle = True):
+        ''' Change the local baud rate; with *settle* false, don't
+        wait for the port to settle (see settle_baud).
+        '''
+        self.open_port(save=False)
+        if baud is None:
+            baud = self.get_baud()
+        if settle:
+            self.set_baud(baud)
+        else:
+            self.set_speed(baud)
+        self.set_status()
+
+    def probe_prompt(self, timeout, prompt=b'>'):
+        ''' Send an empty command; return True if nothing but the
+        *prompt* comes back within *timeout* seconds.
+        '''
+        self.clear_buffer()
+        self.stream.write(b'\r')
+        self.stream.flush()
+        try:
+            reply = self.waitfor(prompt, timeout)
+        except Timeout:
+            return False
+        return reply.strip() == prompt
+
+    def wait_prompt(self):
+        ''' Wait for the instrument to answer an empty command,
+        probing with back-off; raise Timeout if it never does.
+        '''
+        try:
+            baud_settle.retry_probe(self.probe_prompt)
+        except RuntimeError:
+            raise Timeout('no prompt from %s' % self.get_device())
+
+    def settle_baud(self, baud, t_changed=None):
+        '''
+        After both ends have changed to *baud* (the local port at
+        *t_changed*), probe until a clean prompt comes back instead
+        of sleeping a fixed time; the settle time is recorded in the
+        port's baud_settle profile.  Raise Timeout if the port never
+        settles.
+        '''
+        try:
+            return baud_settle.probe_settle(self.probe_prompt,
+                                            self.get_device(), baud,
+                                            t_changed)
+        except RuntimeError:
+            raise Timeout('no prompt from %s at %d baud'
+                          % (self.get_device(), baud))
+
+    ## Hooks for a user interface.
+
+    def set_status(self, msg = None):
+        if msg is None:
+            if self.listening:
+                C = 'connected.'
+            else:
+                C = 'not connected.'
+            msg = 'Device %s, at %d Baud, is %s' % (
+                   self.get_device(), self.get_baud(), C)
+        self.status = msg
+        L.debug("%s: %s", self.get_device(), msg)
+
+    def listening_changed(self):
+        self.set_status()
+
+    def schedule(self, ms, func):
+        ''' Call *func* after *ms* milliseconds from an event loop;
+        there is none here, so waitfor drives update() instead.
+        '''
+        pass
+
+    def schedule_idle(self, func):
+        ''' Call *func* once pending work is done; here, at once. '''
+        func()
+
+    def refresh(self):
+        ''' Let a user interface process pending events. '''
+        pass
+
+    def refresh_display(self):
+        pass
+
+    def make_var(self, value):
+        ''' A holder for a setting the user interface may edit. '''
+        return Value(value)
+
+    def report_error(self, msg):
+        L.error("%s: %s", self.get_device(), msg)
+
+    def show_message(self, title, msg):
+        L.info("%s: %s\n%s", self.get_device(), title, msg)
+
+    def ask_integer(self, title, prompt, initialvalue,
+                    minvalue=None, maxvalue=None):
+        return initialvalue
+
+    def ask_string(self, title, prompt, initialvalue):
+        return initialvalue
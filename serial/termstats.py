@@ -0,0 +1,109 @@
+'''
+Simple counters and timers for measuring terminal performance.
+'''
+
+import time
+from collections import deque
+
+
+class LatencyStats(object):
+    ''' Per-command round-trip times, in seconds.
+
+    Keeps running totals for the session and the most recent
+    *nkeep* (command, seconds) pairs.
+    '''
+    def __init__(self, nkeep=200):
+        self.recent = deque(maxlen=nkeep)
+        self.reset()
+
+    def reset(self):
+        self.recent.clear()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, cmd, seconds):
+        self.recent.append((cmd, seconds))
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def summary(self):
+        if not self.count:
+            return 'no commands timed'
+        return ('%d commands, RTT mean %.1f ms, min %.1f ms, max %.1f ms'
+                % (self.count, 1000 * self.mean(),
+                   1000 * self.min, 1000 * self.max))
+
+
+class Stopwatch(object):
+    ''' Context manager timing one command into a LatencyStats.
+    '''
+    def __init__(self, stats, cmd):
+        self.stats = stats
+        self.cmd = cmd
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.stats.record(self.cmd, time.time() - self.t0)
+        return False
+
+
+class UpdateStats(object):
+    ''' Counters for the Tk_terminal.update cycle: queue depth,
+    bytes moved per tick, and time spent rendering.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.ticks = 0
+        self.nbytes = 0
+        self.last_qdepth = 0
+        self.max_qdepth = 0
+        self.last_tick_bytes = 0
+        self.max_tick_bytes = 0
+        self.renders = 0
+        self.render_bytes = 0
+        self.render_time = 0.0
+        self.max_render_time = 0.0
+
+    def tick(self, qdepth, nbytes):
+        self.ticks += 1
+        self.nbytes += nbytes
+        self.last_qdepth = qdepth
+        self.max_qdepth = max(self.max_qdepth, qdepth)
+        self.last_tick_bytes = nbytes
+        self.max_tick_bytes = max(self.max_tick_bytes, nbytes)
+
+    def render(self, nbytes, seconds):
+        self.renders += 1
+        self.render_bytes += nbytes
+        self.render_time += seconds
+        self.max_render_time = max(self.max_render_time, seconds)
+
+    def summary(self):
+        mean_render = 0.0
+        if self.renders:
+            mean_render = self.render_time / self.renders
+        return ('%d ticks, %d bytes; queue depth %d (max %d); '
+                'bytes/tick %d (max %d); %d renders, '
+                'render time mean %.1f ms, max %.1f ms'
+                % (self.ticks, self.nbytes,
+                   self.last_qdepth, self.max_qdepth,
+                   self.last_tick_bytes, self.max_tick_bytes,
+                   self.renders, 1000 * mean_render,
+                   1000 * self.max_render_time))
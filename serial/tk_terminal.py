@@ -15,16 +15,21 @@ from future.builtins import object
 from six.moves.tkinter import *
 from six.moves import tkinter_tkfiledialog
 from six.moves import tkinter_messagebox
+from six.moves.tkinter_tksimpledialog import askinteger, askstring
 import Pmw
 
-import termios, sys, os, time
-from threading import Thread, Lock
+import sys, os, time
+import functools
 import queue
+from threading import Thread, Event, current_thread
 
 import logging
 L = logging.getLogger()
 
-from uhdas.serial.serialport import serial_port, baud_table, port_flags
+from uhdas.serial.serialport import baud_table, port_flags
+from uhdas.serial.transcript import TranscriptView
+from uhdas.serial.term_engine import TerminalEngine
+from uhdas.serial.port_inventory import get_inventory, lock_name
 
 L.info("tk_terminal %s", time.strftime('%H:%M:%S'))
 
@@ -77,17 +82,29 @@ class flag_display(object):
                            'Quit': self.dialog.destroy}
         button_function[result]()
 
-class Timeout(Exception):
-    pass
-
 def no_action(event):
     return "break"
 
 
 
 class terminal_display(Frame):
-    def __init__(self, master):
+    '''
+    Text widget showing the terminal session.
+
+    With *scrollback* > 0 the widget keeps only about that many
+    lines, trimming old ones in bulk; everything is also written to
+    a Transcript (a temporary file unless *transcript* names one),
+    and get() and the search helpers work on the transcript, so
+    they see the whole session since the last clear().
+    With *scrollback* = 0 the widget holds the whole session.
+    '''
+    def __init__(self, master, scrollback=0, transcript=None):
         Frame.__init__(self, master)
+        self.scrollback = scrollback
+        self.view = None
+        if scrollback > 0:
+            self.view = TranscriptView(transcript)
+            self.trim_lines = max(100, scrollback // 10)
         self.Text = Text(self, width = 80, height = 30, wrap = CHAR,
                          setgrid = NO)
         # setting state = 'disabled' disables everything, not
@@ -100,23 +117,38 @@ class terminal_display(Frame):
 
     def append(self, str):
         self.Text.insert(END, str)
+        if self.view is not None:
+            self.view.append(str)
+            nlines = int(self.Text.index('end - 1 c').split('.')[0])
+            if nlines > self.scrollback + self.trim_lines:
+                self.Text.delete('1.0', '%d.0' % (nlines - self.scrollback))
         self.Text.see(END)
 
     def get(self, start = '1.0', end = END):
+        if self.view is not None and start == '1.0' and end == END:
+            return self.view.get()
         return self.Text.get(start, end)
 
     def mark(self, index = "end - 1 c", gravity = "left",
              name = "BeforeCommand"):
         self.Text.mark_set(name, index)
         self.Text.mark_gravity(name, gravity)
+        if self.view is not None:
+            self.view.mark(name)
 
     def unmark(self, name = "BeforeCommand"):
         self.Text.mark_unset(name)
+        if self.view is not None:
+            self.view.unmark(name)
 
     def get_after_mark(self, name = "BeforeCommand"):
+        if self.view is not None:
+            return self.view.get_after_mark(name)
         return self.Text.get(name, END)
 
     def get_line_with(self, _str, **kwargs):
+        if self.view is not None:
+            return self.view.get_line_with(_str, **kwargs)
         if 'backwards' not in kwargs:
             kwargs['backwards'] = 1
         try:
@@ -130,6 +162,8 @@ class terminal_display(Frame):
             return ""
 
     def get_lines_from(self, _str):
+        if self.view is not None:
+            return self.view.get_lines_from(_str)
         try:
             ind = self.Text.search(_str, END, backwards = 1)
             if ind == '':
@@ -142,6 +176,8 @@ class terminal_display(Frame):
 
     def clear(self):
         self.Text.delete('1.0', END)
+        if self.view is not None:
+            self.view.clear()
 
 
 class EntryHistory(Entry):
@@ -178,24 +214,49 @@ class EntryHistory(Entry):
 
 
 
-class Tk_terminal(serial_port):
+def ui_method(wait=False):
+    '''
+    Decorator for Tk_terminal methods that use Tk.  When called
+    from a worker thread (see Tk_terminal.run_background), the call
+    is queued for the Tk thread; with *wait*, the worker blocks
+    until it has run and gets its return value.
+    '''
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if current_thread() is self.ui_thread:
+                return method(self, *args, **kwargs)
+            return self.call_ui(method, (self,) + args, kwargs, wait)
+        return wrapper
+    return decorate
+
+
+class _Reply(object):
+    def __init__(self):
+        self.event = Event()
+        self.value = None
+        self.exc = None
+
+
+class Tk_terminal(TerminalEngine):
+    interactive = True
+
     def __init__(self,
                  master=None,
                  device='/dev/ttyS0',
                  baud=9600,
                  standalone=0,
                  termination=b'\r\n',
-                 show_cwd=False):
-        serial_port.__init__(self, device = device,
-                                   baud = baud,
-                                   mode = 'r+b');
+                 show_cwd=False,
+                 maxbuffer=2 * 1024 * 1024,
+                 scrollback=0,
+                 transcript=None):
         if not master:
             master = Tk()
             master.protocol("WM_DELETE_WINDOW", self.close_terminal)
             standalone = 1
         self.master = master
         self.standalone = standalone
-        self.termination = termination
         self.Frame = Frame(master, relief = RIDGE, borderwidth = 2)
         self.Frame.pack(expand = YES, fill = BOTH)
         lw = Pmw.LabeledWidget(self.Frame, labelpos = 'w',
@@ -206,23 +267,22 @@ class Tk_terminal(serial_port):
                                 width = 40,
                                 state = DISABLED)
         self.entry.pack(side = BOTTOM, expand = NO, fill = X)
-        self.display = terminal_display(self.Frame)
-        self.display.bind('<Destroy>', self.close_terminal)
+        display = terminal_display(self.Frame, scrollback=scrollback,
+                                   transcript=transcript)
+        display.bind('<Destroy>', self.close_terminal)
         # Putting the binding here seems to keep the close_terminal
         # function from trying to configure a menu item that is
         # already gone.  There may be a cleaner way to ensure that
         # close_terminal is executed early in the shutdown process.
-        self.buffer = b''
-        self.update_lock = Lock()
-        self.save = 0
-        self.outfile_name = "term_diary.txt"
-        self.outfile = None
-        self.new_input = queue.Queue(0)  # 0 -> unbounded size
-        self.listening = 0
-
-        self.update_search = None
-        self.update_search_callback = lambda x: None
-        # return True to end the update cycle
+        self.statusSV = StringVar()
+        self.ui_thread = current_thread()
+        self.ui_calls = queue.Queue()
+        self.worker = None
+        TerminalEngine.__init__(self, device = device,
+                                      baud = baud,
+                                      termination = termination,
+                                      maxbuffer = maxbuffer,
+                                      display = display)
 
         self.connectedIV = IntVar()
         self.connectedIV.set(self.listening)
@@ -249,7 +309,6 @@ class Tk_terminal(serial_port):
                               font=NORMAL,
                               anchor=W)
             cwd_label.pack(side=RIGHT)
-        self.statusSV = StringVar()
         self.statusframe = Frame(self.Frame)
         self.statusframe.pack(side = TOP, anchor = W, expand = YES, fill = X)
         self.statusline = Pmw.LabeledWidget(self.statusframe, ##toprow,
@@ -265,198 +324,153 @@ class Tk_terminal(serial_port):
               textvariable = self.statusSV).pack()
         self.set_status()
 
+    ## Running a sequence of commands in a worker thread, so that
+    ## several terminals in one window can work at the same time.
+
+    def run_background(self, func, *args, **kwargs):
+        '''
+        Run *func(\*args)* in a worker thread; Tk calls made from it
+        are carried out here by pump_ui.  With *unattended* (default
+        True), dialogs are skipped and their default values used.
+        Returns the Thread.
+        '''
+        unattended = kwargs.pop('unattended', True)
+        def target():
+            try:
+                func(*args)
+            except Exception as exc:
+                L.exception("%s: in background run", self.get_device())
+                self.report_error("%s: %s" % (self.get_device(), exc))
+        if unattended:
+            self.interactive = False
+        self.menubar.disableall()
+        self.worker = Thread(target = target)
+        self.worker.daemon = True
+        self.worker.start()
+        self.pump_ui()
+        return self.worker
+
+    def call_ui(self, func, args, kwargs, wait):
+        if not wait:
+            self.ui_calls.put((func, args, kwargs, None))
+            return None
+        reply = _Reply()
+        self.ui_calls.put((func, args, kwargs, reply))
+        reply.event.wait()
+        if reply.exc is not None:
+            raise reply.exc
+        return reply.value
+
+    def pump_ui(self):
+        ''' Carry out queued Tk calls while a worker is running. '''
+        while True:
+            try:
+                func, args, kwargs, reply = self.ui_calls.get_nowait()
+            except queue.Empty:
+                break
+            value = exc = None
+            try:
+                value = func(*args, **kwargs)
+            except Exception as e:
+                exc = e
+                if reply is None:
+                    L.exception("%s: in %s", self.get_device(), func.__name__)
+            if reply is not None:
+                reply.value, reply.exc = value, exc
+                reply.event.set()
+        self.update(oneshot = True)
+        if self.worker is not None and self.worker.is_alive():
+            self.Frame.after(20, self.pump_ui)
+        elif self.worker is not None:
+            self.worker = None
+            self.interactive = True
+            self.menubar.enableall()
+            self.Frame.after_idle(self.pump_ui)  # anything queued at the end
+
+    @ui_method()
+    def _set_var(self, var, value):
+        var.set(value)
+
+    @ui_method()
     def set_status(self, msg = None):
-        if msg is None:
-            if self.listening:
-                C = 'connected.'
-            else:
-                C = 'not connected.'
-            msg = 'Device %s, at %d Baud, is %s' % (
-                   self.get_device(), self.get_baud(), C)
-        self.statusSV.set(msg)
-
-    def waitfor(self, s=None, timeout=5, quiet=0):
-        nchar = len(self.buffer)
-        nloops = max(2, int(timeout*10))
-        qnloops = max(0, int(quiet*10))
-        ii = 0
-        jj = 0
-        while ii < qnloops:
-            jj += 1
-            if jj == nloops:
-                raise Timeout
-            time.sleep(0.1)
-            self.update(oneshot=True)
-            n = len(self.buffer)
-            if n > nchar:
-                nchar = n
-                ii = 0
-            elif not s or n > 0:
-                ii += 1
-        if not s:
-            return ''
-        for ii in range(nloops):
-            time.sleep(0.05)
-            self.update(oneshot = True) ###
-            if isinstance(s ,str):
-                s = s.encode('utf-8')
-            ind = self.buffer.rfind(s)
-            if ind != -1:
-                buf = self.buffer[:ind+1]
-                self.buffer = self.buffer[ind+1:]
-                return buf
-            time.sleep(0.05)
-        raise Timeout
-
-    def streamwaitfor(self, s, timeout=2, maxnchar=50000):
-        """
-        Wait for the string *s* to appear in the buffer,
-        or until *timeout* seconds of no activity, or until
-        *maxnchar* have been received.
-        """
-        nchar = n_orig = len(self.buffer)
-        nloops = max(2, int(timeout*10))
-        ii = 0
-        while ii < nloops:
-            time.sleep(0.05)
-            self.update(oneshot = True) ###
-            n = len(self.buffer)
-            if n > nchar:
-                nchar = n
-                ii = 0
-            ind = self.buffer.rfind(s)
-            if ind != -1:
-                buf = self.buffer[:ind+1]
-                self.buffer = self.buffer[ind+1:]
-                return buf
-            if n - n_orig >= maxnchar:
-                raise Timeout
-            time.sleep(0.05)
-            ii += 1
-        raise Timeout
-
-    def clear_buffer(self):
-        self.buffer = b''
-        self.buffer_i0 = 0
-
-    def start_listening(self, save=True):
+        TerminalEngine.set_status(self, msg)
+        self.statusSV.set(self.status)
+
+    @ui_method()
+    def listening_changed(self):
         if self.listening:
-            self.clear_buffer()
-            return
-        self.open_port(save=save)      # Might already be open, but make sure.
-        self.entry.config(state = NORMAL)
-        self.config_menuitem('File', 'Disconnect', state = NORMAL)
-        self.config_menuitem('File', 'Connect*', state = DISABLED)
-        self.listening = 1
+            self.entry.config(state = NORMAL)
+            self.config_menuitem('File', 'Disconnect', state = NORMAL)
+            self.config_menuitem('File', 'Connect*', state = DISABLED)
+        else:
+            self.entry.config(state = DISABLED)
+            self.config_menuitem('File', 'Disconnect', state = DISABLED)
+            self.config_menuitem('File', 'Connect*', state = NORMAL)
         self.set_status()      # after changing self.listening
-        self.thread1 = Thread(target = self.listen)
-        self.thread1.start()
         self.connectedIV.set(self.listening)
-        self.clear_buffer()
-        self.update()
 
-    def update(self, oneshot = False):
-        if not self.update_lock.acquire(False):
-            if self.listening and not oneshot:
-                self.Frame.after(50, self.update)
-            return
-        try:
-            # change to loop count, so it can't get stuck
-            # if there is too large a blast of input?
-            # while 1:
-            cclist = []
-            for ii in range(50):
-                cc = self.new_input.get_nowait()
-                cclist.extend(cc.split(b'\r'))
-        except queue.Empty:
-            pass
-
-        if cclist:
-            cc = b''.join(cclist)
-            self.display.append(cc)
-            self.buffer += cc
-            self.display.update_idletasks()
-            #self.display.update()
-
-            if self.update_search:
-                s = self.update_search
-                self.buffer_i0 -= len(cc)
-                ind = self.buffer.rfind(s, self.buffer_i0)
-                if ind != -1:
-                    self.listening = False
-                    self.update_search_callback()
-                    self.update_search = None
-                    self.buffer_i0 = ind + len(s)
-                else:
-                    self.buffer_i0 = -len(s)
-        if self.listening and not oneshot:
-            self.Frame.after(50, self.update)
-        self.update_lock.release()
-
-    def set_update_search_callback(self, s, func):
-        self.update_lock.acquire()
-        self.update_search = s
-        self.update_search_callback = func
-        self.update_lock.release()
-
-    def listen(self):
-        ''' Thread target for listening to a serial port.
-            We set vmin to 0 so it won't block; the sleep
-            then ensures the main thread gets a time slice.
-        '''
-        if not self.fd:
-            return
-        self.set_cc(vmin = 0, vtime = 1) # vtime in 0.1 s
-        termios.tcflush(self.fd, termios.TCIOFLUSH)
-        while self.listening:
-            cc = os.read(self.fd, 500)
-            if cc == b"":
-                time.sleep(0.001)
-            else:
-                self.new_input.put(cc)  # via queue to main thread
-                if self.save:
-                    self.outfile.write(cc)
-
-
-    # Looks like one must use os.read instead of <fileobject>.read
-    # for any value of vmin other than 0.
-
-    def stop_listening(self, restore=True):
-        if not self.listening:
+    @ui_method()
+    def schedule(self, ms, func):
+        self.Frame.after(ms, func)
+
+    def schedule_idle(self, func):
+        if current_thread() is not self.ui_thread:
+            func()             # a worker just carries on
             return
-        self.listening = 0
-        self.entry.config(state = DISABLED)
-        self.config_menuitem('File', 'Disconnect', state = DISABLED)
-        self.config_menuitem('File', 'Connect*', state = NORMAL)
-        self.set_status()
-        self.thread1.join(3)
-        self.close_port(restore=restore)
-        self.connectedIV.set(self.listening)
+        self.Frame.after_idle(func)
 
-    def send(self, s):
-        '''Send a string, wait for its echo
-        '''
-        s = s.encode('ascii', 'ignore')
-        if self.termination:
-            self.stream.write(s + self.termination)
-            self.stream.flush()
-            self.waitfor(s)
-        else:                # for old NB: one character at a time
-            for i in range(len(s)):
-                self.stream.write(s[i])
-                self.stream.flush()
-                self.waitfor(s[i])
+    def refresh(self):
+        if current_thread() is self.ui_thread:
+            self.Frame.update()
+
+    # A worker waits for the display, because searches read it.
+    render = ui_method(wait=True)(TerminalEngine.render)
+    clear = ui_method(wait=True)(TerminalEngine.clear)
+
+    def refresh_display(self):
+        self.display.update_idletasks()
+
+    def make_var(self, value):
+        var = StringVar()
+        var.set(value)
+        return var
+
+    @ui_method()
+    def report_error(self, msg):
+        tkinter_messagebox.showerror(message = msg)
+
+    @ui_method()
+    def show_message(self, title, msg):
+        Pmw.MessageDialog(title = title, message_text = msg,
+                          buttons = ('OK',))   #.activate()
+        # activate() segfaults on jaunty
+
+    @ui_method(wait=True)
+    def ask_integer(self, title, prompt, initialvalue,
+                    minvalue=None, maxvalue=None):
+        if not self.interactive:
+            return initialvalue
+        return askinteger(title, prompt,
+                          initialvalue = initialvalue,
+                          minvalue = minvalue,
+                          maxvalue = maxvalue)
+
+    @ui_method(wait=True)
+    def ask_string(self, title, prompt, initialvalue):
+        if not self.interactive:
+            return initialvalue
+        return askstring(title, prompt, initialvalue = initialvalue)
+
+    def show_stats(self):
+        msg = self.stats_summary()
+        L.info(msg)
+        self.show_message('Terminal statistics', msg)
 
     def close_terminal(self, event = ''):
-        self.stop_listening()
-        if self.save:
-            self.end_save()
+        TerminalEngine.close_terminal(self, event)
         if self.standalone:
             self.master.quit()
 
-    def clear(self):
-        self.display.clear()
-
 
     def ask_write_file(self):
         fn = tkinter_tkfiledialog.asksaveasfilename(initialfile ='term_diary.txt',
@@ -485,30 +499,54 @@ class Tk_terminal(serial_port):
         self.begin_save()
 
     def begin_save(self, filename = None):
-        if filename is not None:
-            self.outfile_name = filename
-        self.end_save()
         try:
-            self.outfile = open(self.outfile_name, 'ab')
+            TerminalEngine.begin_save(self, filename)
         except:
             L.exception("writing to file <%s>", self.outfile_name)
             tkinter_messagebox.showerror(message = "Can't write to file %s" %
                                               self.outfile_name)
             self.ask_save_file()
+            return
         self.config_menuitem('File', 'Save incoming', state = DISABLED)
         self.config_menuitem('File', 'Stop saving', state = NORMAL)
-        self.save = 1
 
     def end_save(self):
-        try:
-            self.outfile.close()
-        except:
-            pass
+        TerminalEngine.end_save(self)
         self.config_menuitem('File', 'Save incoming', state = NORMAL)
         self.config_menuitem('File', 'Stop saving', state = DISABLED)
-        self.save = 0
 
     def ask_device(self):
+        ''' Choose a port from the inventory, or any device file. '''
+        inventory = get_inventory()
+        ports = inventory.ports()
+        locks = inventory.locks()
+        items = []
+        for p in ports:
+            item = p.describe()
+            pid, alive = locks.get(lock_name(p.device), (None, False))
+            if pid is not None and alive and pid != os.getpid():
+                item += '  (in use, pid %d)' % pid
+            items.append(item)
+        dialog = Pmw.SelectionDialog(self.Frame,
+                       title = 'Select serial port device',
+                       buttons = ('OK', 'Other...', 'Cancel'),
+                       defaultbutton = 'OK',
+                       scrolledlist_labelpos = 'n',
+                       label_text = 'Serial ports',
+                       scrolledlist_items = items)
+        dialog.component('scrolledlist').component('listbox').configure(
+                                                                width = 70)
+        result = dialog.activate()
+        selection = dialog.getcurselection()
+        dialog.destroy()
+        if result == 'Other...':
+            self.ask_device_file()
+        elif result == 'OK' and selection:
+            fn = ports[items.index(selection[0])].device
+            self.set_device(fn)
+            self.set_status()
+
+    def ask_device_file(self):
         fn = tkinter_tkfiledialog.askopenfilename(initialfile = self.get_device(),
                        initialdir = '/dev',
                        filetypes = (('ttyUSB', 'ttyUSB*'),
@@ -526,13 +564,16 @@ class Tk_terminal(serial_port):
         self.set_status()
 
 
-    def change_baud(self, baud = None):
+    def change_baud(self, baud = None, settle = True):
         self.open_port(save=False)
         if baud == None:
             baud = self.baudIV.get()
         else:
-            self.baudIV.set(baud)
-        self.set_baud(baud)
+            self._set_var(self.baudIV, baud)
+        if settle:
+            self.set_baud(baud)
+        else:
+            self.set_speed(baud)
         self.set_status()
 
 
@@ -601,6 +642,9 @@ class Tk_terminal(serial_port):
         mb.addmenuitem('Port', 'command', '',
                        label = 'View/Set',
                        command = self.view_set)
+        mb.addmenuitem('Port', 'command', '',
+                       label = 'Statistics',
+                       command = self.show_stats)
         self.menubar = mb
 
     def config_menuitem(self, menu, item, **kw):
@@ -0,0 +1,161 @@
+'''
+On-disk transcript of everything shown in a terminal display.
+
+The display widget can then be limited to a modest scrollback,
+while the whole session stays available for saving and for the
+backwards searches used to pick values out of instrument
+responses.  Positions are byte offsets into the transcript.
+
+The display is written in the UI thread while a worker thread
+may be reading it back, so each seek and the read or write that
+follows it are done under a lock.
+'''
+
+import re
+import tempfile
+from threading import Lock
+
+
+class Transcript(object):
+    def __init__(self, filename=None, blocksize=65536):
+        if filename is None:
+            self.file = tempfile.TemporaryFile()
+        else:
+            self.file = open(filename, 'w+b')
+        self.blocksize = blocksize
+        self.size = 0
+        self.lock = Lock()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('latin-1', 'replace')
+        with self.lock:
+            self.file.seek(self.size)
+            self.file.write(data)
+            self.size += len(data)
+
+    def read(self, start=0, end=None):
+        if end is None or end > self.size:
+            end = self.size
+        if start >= end:
+            return b''
+        with self.lock:
+            self.file.flush()
+            self.file.seek(start)
+            return self.file.read(end - start)
+
+    def rfind(self, pattern, start=0, regexp=False):
+        '''
+        Return the offset of the last match of *pattern* at or
+        after *start*, or -1.  With *regexp*, the pattern is a
+        regular expression applied line by line (re.M), so ^ and
+        $ anchor at line boundaries as in a Tk Text search.
+        '''
+        if isinstance(pattern, str):
+            pattern = pattern.encode('latin-1', 'replace')
+        if regexp:
+            regex = re.compile(pattern, re.M)
+            overlap = 0
+        else:
+            overlap = len(pattern)
+        hi = self.size
+        while hi > start:
+            lo = max(start, hi - self.blocksize)
+            data = self.read(lo, min(self.size, hi + overlap))
+            skip = 0
+            if regexp and lo > start:
+                # Start the block on a line boundary, and leave the
+                # partial line for the next (earlier) block.
+                skip = data.find(b'\n') + 1
+            if regexp:
+                matches = list(regex.finditer(data, skip))
+                if matches:
+                    return lo + matches[-1].start()
+            else:
+                ind = data.rfind(pattern)
+                if ind != -1:
+                    return lo + ind
+            if lo + skip < hi:
+                hi = lo + skip
+            else:
+                hi = lo
+        return -1
+
+    def line_start(self, offset, start=0):
+        lo = offset
+        while lo > start:
+            blo = max(start, lo - self.blocksize)
+            ind = self.read(blo, lo).rfind(b'\n')
+            if ind != -1:
+                return blo + ind + 1
+            lo = blo
+        return start
+
+    def line_end(self, offset):
+        hi = offset
+        while hi < self.size:
+            data = self.read(hi, hi + self.blocksize)
+            ind = data.find(b'\n')
+            if ind != -1:
+                return hi + ind
+            hi += len(data)
+        return self.size
+
+    def line_at(self, offset, start=0):
+        ''' Return the line containing *offset*, without its newline. '''
+        return self.read(self.line_start(offset, start), self.line_end(offset))
+
+    def lines_from(self, offset, start=0):
+        ''' Return everything from the start of the line containing
+        *offset* to the end of the transcript.
+        '''
+        return self.read(self.line_start(offset, start))
+
+
+class TranscriptView(object):
+    '''
+    The text-access part of tk_terminal.terminal_display, over
+    a Transcript: what has been shown since the last clear() can
+    be read back, searched backwards, and marked.  Used on its own
+    by the headless terminal engine.
+    '''
+    def __init__(self, transcript=None):
+        if not isinstance(transcript, Transcript):
+            transcript = Transcript(transcript)
+        self.transcript = transcript
+        self.start = 0      # transcript offset at the last clear()
+        self.marks = {}     # transcript offsets of named marks
+
+    def append(self, data):
+        self.transcript.write(data)
+
+    def get(self):
+        return self.transcript.read(self.start).decode('latin-1')
+
+    def mark(self, name = "BeforeCommand"):
+        self.marks[name] = self.transcript.size
+
+    def unmark(self, name = "BeforeCommand"):
+        self.marks.pop(name, None)
+
+    def get_after_mark(self, name = "BeforeCommand"):
+        return self.transcript.read(self.marks[name]).decode('latin-1')
+
+    def get_line_with(self, _str, regexp=False, **kwargs):
+        ind = self.transcript.rfind(_str, self.start, regexp=regexp)
+        if ind == -1:
+            return ''
+        return self.transcript.line_at(ind, self.start).decode('latin-1')
+
+    def get_lines_from(self, _str):
+        ind = self.transcript.rfind(_str, self.start)
+        if ind == -1:
+            return ''
+        return self.transcript.lines_from(ind, self.start).decode('latin-1')
+
+    def clear(self):
+        self.start = self.transcript.size
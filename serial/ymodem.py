@@ -0,0 +1,489 @@
+'''
+YMODEM batch (128- and 1K-block, CRC) receiver and sender.
+
+Runs on the file descriptor of an already-open serial port, so no
+external program (lrzsz "rb") is needed.  Input is taken in large
+reads into a buffer and parsed from there; each file is written
+straight to the name returned by the caller's *namer*, rather than
+to a temporary directory for renaming afterwards.  Progress,
+throughput, and retries (per block) are kept in a YmodemStats,
+which is passed to an optional *progress* callback.
+
+The port should be raw, with VMIN=0 and VTIME=0.
+
+YmodemSender is the instrument's side of the transfer; it is used
+by the RDI simulator (rdi_sim) to serve its synthetic recorder.
+'''
+
+import os, time, select
+import binascii
+
+import logging
+L = logging.getLogger()
+
+SOH = b'\x01'    # 128-byte block
+STX = b'\x02'    # 1024-byte block
+EOT = b'\x04'
+ACK = b'\x06'
+NAK = b'\x15'
+CAN = b'\x18'
+CRC = b'C'       # request CRC mode
+CPMEOF = 0x1a
+
+_blocksize = {SOH: 128, STX: 1024}
+
+
+def crc16(data, crc=0):
+    ''' CRC-16/XMODEM (polynomial 0x1021, initial value 0);
+    binascii.crc_hqx is exactly this CRC, table-driven in C.
+    '''
+    return binascii.crc_hqx(data, crc)
+
+
+class YmodemError(Exception):
+    pass
+
+
+class YmodemCanceled(YmodemError):
+    pass
+
+
+class _Timeout(Exception):
+    pass
+
+
+class _BadBlock(Exception):
+    pass
+
+
+class YmodemStats(object):
+    ''' Counters for a batch transfer. '''
+    def __init__(self):
+        self.t0 = time.time()
+        self.t_end = None        # set when the batch is finished
+        self.files = []          # (path, size from header or None)
+        self.filename = ''
+        self.size = None         # of the current file, if sent
+        self.file_bytes = 0      # received for the current file
+        self.nbytes = 0          # received for the batch
+        self.nblocks = 0
+        self.nduplicates = 0
+        self.retries = {}        # block number in batch: retry count
+        self.errors = {}         # reason: count
+
+    def start_file(self, path, size):
+        self.files.append((path, size))
+        self.filename = path
+        self.size = size
+        self.file_bytes = 0
+
+    def block(self, nbytes):
+        self.nblocks += 1
+        self.nbytes += nbytes
+        self.file_bytes += nbytes
+
+    def retry(self, reason):
+        nblock = self.nblocks + 1
+        self.retries[nblock] = self.retries.get(nblock, 0) + 1
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    def nretry(self):
+        return sum(self.retries.values())
+
+    def elapsed(self):
+        if self.t_end is not None:
+            return self.t_end - self.t0
+        return time.time() - self.t0
+
+    def rate(self):
+        ''' Bytes per second over the whole batch. '''
+        dt = self.elapsed()
+        if dt <= 0:
+            return 0.0
+        return self.nbytes / dt
+
+    def eta(self):
+        ''' Seconds left for the current file, or None if unknown. '''
+        if self.t_end is not None:
+            return 0.0
+        rate = self.rate()
+        if not self.size or rate <= 0:
+            return None
+        return max(0, self.size - self.file_bytes) / rate
+
+    def progress(self):
+        if self.size:
+            nbytes = min(self.file_bytes, self.size)   # last block padded
+            done = '%d of %d bytes (%.0f%%)' % (nbytes, self.size,
+                                                100.0 * nbytes / self.size)
+        else:
+            done = '%d bytes' % self.file_bytes
+        return '%s: %s, %.0f bytes/s, %d retries' % (
+                    os.path.basename(self.filename), done, self.rate(),
+                    self.nretry())
+
+    def summary(self):
+        lines = ['%d file(s), %d bytes in %d blocks, %.1f s, %.0f bytes/s'
+                 % (len(self.files), self.nbytes, self.nblocks,
+                    self.elapsed(), self.rate())]
+        if self.retries:
+            worst = max(self.retries, key=self.retries.get)
+            reasons = ', '.join('%s %d' % kv
+                                for kv in sorted(self.errors.items()))
+            lines.append('%d retries on %d blocks (most: %d at block %d); %s'
+                         % (self.nretry(), len(self.retries),
+                            self.retries[worst], worst, reasons))
+        else:
+            lines.append('no retries')
+        if self.nduplicates:
+            lines.append('%d duplicate blocks ignored' % self.nduplicates)
+        return '\n'.join(lines)
+
+
+class YmodemReceiver(object):
+    def __init__(self, fd, namer,
+                       progress=None,
+                       progress_interval=1.0,
+                       timeout=1.0,
+                       maxretry=10,
+                       bufsize=65536):
+        '''
+        *namer(name, ifile)* returns the path for the *ifile*th
+        file (0-based) of the batch, given the name sent by the
+        instrument.  *progress(stats)* is called at most every
+        *progress_interval* seconds and at the end of each file.
+        *timeout* is the time allowed for each part of a block.
+        '''
+        self.fd = fd
+        self.namer = namer
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.timeout = timeout
+        self.maxretry = maxretry
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.pending = bytearray()
+        self.poller = select.poll()
+        self.poller.register(fd, select.POLLIN)
+        self.stats = YmodemStats()
+        self.canceled = False
+        self.last_progress = 0
+
+    def cancel(self):
+        ''' Ask the receiver, running in another thread, to stop. '''
+        self.canceled = True
+
+    def _send(self, data):
+        os.write(self.fd, data)
+
+    def _fill(self, timeout):
+        ''' Add whatever has arrived to self.pending; wait up to
+        *timeout* seconds for it.  Return the number of bytes read.
+        '''
+        if not self.poller.poll(max(0, int(timeout * 1000))):
+            return 0
+        n = os.readv(self.fd, [self.buf])
+        self.pending += self.view[:n]
+        return n
+
+    def _read(self, n, timeout):
+        deadline = time.time() + timeout
+        while len(self.pending) < n:
+            remaining = deadline - time.time()
+            if remaining <= 0 or self.canceled:
+                raise _Timeout
+            self._fill(remaining)
+        data = bytes(self.pending[:n])
+        del self.pending[:n]
+        return data
+
+    def _purge(self, quiet=0.1):
+        ''' Discard input until the line has been quiet for *quiet* s. '''
+        self.pending = bytearray()
+        deadline = time.time() + 3
+        while self._fill(quiet) and time.time() < deadline:
+            self.pending = bytearray()
+        self.pending = bytearray()
+
+    def _abort(self):
+        self._send(CAN * 8 + b'\x08' * 8)
+
+    def _read_packet(self, timeout):
+        ''' Return EOT, CAN, or (seq, data); raise _BadBlock or _Timeout.
+        '''
+        start = self._read(1, timeout)
+        if start == EOT or start == CAN:
+            return start
+        if start not in _blocksize:
+            raise _BadBlock('header')
+        n = _blocksize[start]
+        block = self._read(n + 4, self.timeout)
+        seq, cseq = block[0], block[1]
+        if seq ^ cseq != 0xff:
+            raise _BadBlock('sequence')
+        data = block[2:n + 2]
+        if crc16(data) != (block[n + 2] << 8) | block[n + 3]:
+            raise _BadBlock('crc')
+        return seq, data
+
+    def _get_packet(self, first_byte_timeout, request):
+        '''
+        Read packets until a good one arrives, sending *request*
+        (CRC to start, NAK otherwise) after each failure.
+        '''
+        nretry = 0
+        while True:
+            if self.canceled:
+                self._abort()
+                raise YmodemCanceled('download canceled')
+            try:
+                return self._read_packet(first_byte_timeout)
+            except _Timeout:
+                reason = 'timeout'
+            except _BadBlock as exc:
+                reason = str(exc)
+                self._purge()
+            if self.canceled:
+                continue
+            nretry += 1
+            if reason != 'timeout' or request == NAK:
+                # Waiting for the sender to start is not a retry.
+                self.stats.retry(reason)
+            if nretry > self.maxretry:
+                self._abort()
+                raise YmodemError('too many retries (%s) at block %d'
+                                  % (reason, self.stats.nblocks + 1))
+            self._send(request)
+
+    def _check_sender_cancel(self):
+        if self._read(1, self.timeout) == CAN:
+            raise YmodemError('canceled by sender')
+
+    def _report(self, force=False):
+        now = time.time()
+        if self.progress and (force or
+                        now - self.last_progress >= self.progress_interval):
+            self.last_progress = now
+            self.progress(self.stats)
+
+    def receive(self):
+        ''' Receive a batch; return the list of paths written. '''
+        try:
+            return self._receive_batch()
+        finally:
+            self.stats.t_end = time.time()
+
+    def _receive_batch(self):
+        paths = []
+        while True:
+            self._send(CRC)
+            packet = self._get_packet(3 * self.timeout, CRC)
+            if packet == CAN:
+                self._check_sender_cancel()
+                continue
+            if packet == EOT:          # stray repeat of the last EOT
+                self._send(ACK)
+                continue
+            seq, data = packet
+            if seq != 0:
+                raise YmodemError('expected file header, got block %d' % seq)
+            name, size = self._parse_header(data)
+            self._send(ACK)
+            if not name:               # empty header ends the batch
+                break
+            path = self.namer(name, len(paths))
+            paths.append(path)
+            self.stats.start_file(path, size)
+            self._receive_file(path, size)
+            self._report(force=True)
+        return paths
+
+    @staticmethod
+    def _parse_header(data):
+        name, rest = (data.split(b'\0', 1) + [b''])[:2]
+        name = os.path.basename(name.decode('latin-1'))
+        size = None
+        fields = rest.split(b'\0', 1)[0].split()
+        if fields:
+            try:
+                size = int(fields[0])
+            except ValueError:
+                pass
+        return name, size
+
+    def _receive_file(self, path, size):
+        expected = 1
+        neot = 0
+        self._send(CRC)
+        request = CRC     # until the first data block arrives
+        f = open(path, 'w+b', buffering=256 * 1024)
+        try:
+            while True:
+                packet = self._get_packet(10 * self.timeout, request)
+                if packet == CAN:
+                    self._check_sender_cancel()
+                    continue
+                if packet == EOT:
+                    if neot == 0:      # ask for it again, to be sure
+                        neot = 1
+                        self._send(NAK)
+                        continue
+                    self._send(ACK)
+                    break
+                seq, data = packet
+                request = NAK
+                if seq == (expected - 1) & 0xff:   # our ACK was lost
+                    self.stats.nduplicates += 1
+                    self._send(ACK)
+                    continue
+                if seq != expected & 0xff:
+                    self._abort()
+                    raise YmodemError('block %d out of sequence; expected %d'
+                                      % (seq, expected & 0xff))
+                self._send(ACK)   # let the sender start the next block
+                f.write(data)
+                expected += 1
+                self.stats.block(len(data))
+                self._report()
+            if size is not None:
+                f.truncate(size)
+            else:
+                # No size in the header: strip the CP/M EOF padding.
+                f.flush()
+                self._strip_padding(f)
+        except BaseException:
+            f.close()
+            os.remove(path)
+            raise
+        f.close()
+
+    @staticmethod
+    def _strip_padding(f):
+        end = f.tell()
+        start = max(0, end - 1024)
+        f.seek(start)
+        tail = f.read(end - start)
+        n = len(tail) - len(tail.rstrip(bytes([CPMEOF])))
+        f.seek(end)
+        f.truncate(end - n)
+
+
+class YmodemSender(object):
+    def __init__(self, fd,
+                       timeout=10.0,
+                       maxretry=10,
+                       corrupt=None,
+                       write=None):
+        '''
+        *timeout* is the time to wait for each reply from the
+        receiver.  *corrupt(frame)*, if given, returns the frame
+        as it is to go out, e.g. with a byte damaged to simulate
+        line noise; *write(data)* replaces os.write on *fd*, e.g.
+        to pace the output at a baud rate.
+        '''
+        self.fd = fd
+        self.timeout = timeout
+        self.maxretry = maxretry
+        self.corrupt = corrupt
+        self.write = write
+        self.poller = select.poll()
+        self.poller.register(fd, select.POLLIN)
+        self.stats = YmodemStats()
+        self.canceled = False
+
+    def cancel(self):
+        self.canceled = True
+
+    def _send(self, data):
+        if self.write is not None:
+            self.write(data)
+        else:
+            os.write(self.fd, data)
+
+    def _getc(self, timeout):
+        if not self.poller.poll(max(0, int(timeout * 1000))):
+            return None
+        return os.read(self.fd, 1)
+
+    def _reply(self, wanted):
+        ''' Wait for one of the bytes in *wanted*, ignoring others;
+        return it, or None after self.timeout.
+        '''
+        deadline = time.time() + self.timeout
+        ncan = 0
+        while True:
+            if self.canceled:
+                self._send(CAN * 2)
+                raise YmodemCanceled('send canceled')
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            c = self._getc(min(remaining, 0.5))
+            if c is None:
+                continue
+            if c == CAN:
+                ncan += 1
+                if ncan >= 2:
+                    raise YmodemCanceled('canceled by receiver')
+                continue
+            ncan = 0
+            if c in wanted:
+                return c
+
+    @staticmethod
+    def frame(seq, data, n, pad=bytes([CPMEOF])):
+        data = data.ljust(n, pad)
+        crc = crc16(data)
+        return (STX if n == 1024 else SOH) + bytes([seq & 0xff,
+                                                   0xff - (seq & 0xff)]) \
+               + data + bytes([crc >> 8, crc & 0xff])
+
+    def _send_frame(self, frame, nbytes):
+        for i in range(self.maxretry + 1):
+            if self.corrupt is not None:
+                self._send(self.corrupt(frame))
+            else:
+                self._send(frame)
+            c = self._reply((ACK, NAK, CRC))
+            if c == ACK:
+                self.stats.block(nbytes)
+                return
+            self.stats.retry('timeout' if c is None else 'nak')
+        raise YmodemError('too many retries at block %d'
+                          % (self.stats.nblocks + 1))
+
+    def _wait_start(self):
+        for i in range(self.maxretry + 1):
+            if self._reply((CRC,)) == CRC:
+                return
+        raise YmodemError('receiver did not start')
+
+    def send(self, files):
+        '''
+        Send a batch; *files* is a sequence of (name, data, mtime)
+        with *data* as bytes.
+        '''
+        try:
+            for name, data, mtime in files:
+                self._wait_start()
+                header = (name.encode('latin-1') + b'\0'
+                          + ('%d %o' % (len(data), int(mtime))).encode())
+                self.stats.start_file(name, len(data))
+                self._send_frame(self.frame(0, header, 128, b'\0'), 0)
+                self._wait_start()
+                seq = 1
+                view = memoryview(data)
+                for i in range(0, len(data), 1024):
+                    self._send_frame(self.frame(seq, bytes(view[i:i + 1024]),
+                                                1024), 1024)
+                    seq += 1
+                for i in range(self.maxretry + 1):
+                    self._send(EOT)
+                    if self._reply((ACK, NAK)) == ACK:
+                        break
+                else:
+                    raise YmodemError('EOT not acknowledged')
+            self._wait_start()
+            self._send_frame(self.frame(0, b'', 128, b'\0'), 0)
+        finally:
+            self.stats.t_end = time.time()
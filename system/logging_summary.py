@@ -11,6 +11,8 @@ from pycurrents.data.navcalc import pretty_llstr
 from  pycurrents import codas
 from pycurrents.data.nmea import msg
 
+from uhdas.system.proc_table import get_table, ps_lines
+
 L = logging.getLogger()
 
 def showlast(filetype, numfiles):
@@ -47,20 +49,12 @@ def zmq_summary(zmqdir='/home/data/0mon', use_publishers=None):
     zmq_list.append('zmq is enabled, output goes to %s' % (zmqdir))
 
     # look for processes
-    cmd = 'ps -efw | grep zmq | grep asc'
     cmdissued = ''
-    output = subprocess.getoutput(cmd)
-    processes = output.split('\n')
-
     zmq_pub_running = False
-    for process in processes:
-        if 'grep' not in process:
-            if 'ser_asc_zmq' in process:
-                zmq_pub_running = True
-            parts = process.split()
-            pid = parts[1]
-            cmdcmd = 'ps -w -p %s -o cmd' % (pid)
-            cmdissued+= '\n' +  subprocess.getoutput(cmdcmd).split('\n')[1]
+    for process in get_table().find(contains=['zmq', 'asc']):
+        if 'ser_asc_zmq' in process.cmdline:
+            zmq_pub_running = True
+        cmdissued += '\n' + process.cmdline
 
     zmq_runstr = {True:'is', False:' **IS NOT** '}[zmq_pub_running]
     zmq_list.append('zmq publisher (ser_asc_zmq) %s running\n' % (zmq_runstr))
@@ -124,9 +118,11 @@ def autopilot_summary():
         autopilot_running = True
     #        
     autopilot_list=['========= autopilot summary ==========']
-    #   
-    for cmd in ['ps -ef | grep autopilot',
-                'ls -l /home/adcp/config/autopilot_cfg.py',
+    #
+    autopilot_list.append('\n---------- processes matching autopilot ----------\n')
+    autopilot_list.append('\n'.join(
+                    ps_lines(get_table().find(contains=['autopilot']))))
+    for cmd in ['ls -l /home/adcp/config/autopilot_cfg.py',
                 'ls -l /home/adcp/flags',
                 'tail -3 /home/adcp/log/DAS_autopilot.log']:
         output = subprocess.getoutput(cmd)
@@ -0,0 +1,251 @@
+'''
+The process table, read from /proc.
+
+A ProcessTable reads /proc/<pid>/stat, cmdline and statm for
+every process, and keeps the list for *ttl* seconds, so the
+status checks of the loggers, the zmq publisher and the daily
+report find processes without forking ps, pgrep or a shell
+pipeline each time:
+
+    table = get_table()
+    for p in table.find(name='ser_asc_zmq', contains=['/home/data']):
+        print(p.pid, p.cmdline)
+
+find() matches on the executable name (like "pgrep -x" or
+"ps -C"), on a regular expression searched in the command line,
+on strings that must all appear in it, and on the user.  A
+single pid is looked up directly, not from the cached list.
+
+    python -m uhdas.system.proc_table [pattern]
+
+lists the matching processes in the style of "ps -f".
+'''
+from __future__ import print_function
+from __future__ import division
+
+import os, re, time
+from threading import Lock
+
+try:
+    import pwd
+except ImportError:
+    pwd = None
+
+_clock_ticks = os.sysconf('SC_CLK_TCK')
+_page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+
+_users = {}
+
+
+def user_name(uid):
+    ''' The login name for *uid*, or the uid as a string. '''
+    if uid not in _users:
+        try:
+            _users[uid] = pwd.getpwuid(uid).pw_name
+        except (AttributeError, KeyError):
+            _users[uid] = str(uid)
+    return _users[uid]
+
+
+def _read(path, mode='r'):
+    with open(path, mode) as f:
+        return f.read()
+
+
+class ProcInfo(object):
+    __slots__ = ('pid', 'ppid', 'uid', 'comm', 'state', 'argv',
+                 'start', 'vsz_kb', 'rss_kb')
+
+    @property
+    def user(self):
+        return user_name(self.uid)
+
+    @property
+    def cmdline(self):
+        ''' The arguments joined by spaces, or [comm] for a kernel
+        thread or zombie, as ps shows them.
+        '''
+        if self.argv:
+            return ' '.join(self.argv)
+        return '[%s]' % self.comm
+
+    @property
+    def name(self):
+        ''' Base name of the executable, from the arguments if any. '''
+        if self.argv:
+            return os.path.basename(self.argv[0])
+        return self.comm
+
+    def matches_name(self, name):
+        # comm is truncated to 15 characters by the kernel.
+        return self.comm == name[:15] or self.name == name
+
+    def ps_line(self):
+        ''' One line in the style of "ps -f", with memory. '''
+        return '%-8s %6d %6d %8d %8d %s %s' % (
+                    self.user[:8], self.pid, self.ppid, self.vsz_kb,
+                    self.rss_kb, time.strftime('%m/%d %H:%M',
+                                               time.localtime(self.start)),
+                    self.cmdline)
+
+    def __repr__(self):
+        return 'ProcInfo(%d, %r)' % (self.pid, self.cmdline)
+
+
+ps_header = '%-8s %6s %6s %8s %8s %-11s %s' % ('USER', 'PID', 'PPID',
+                                               'VSZ', 'RSS', 'STARTED', 'CMD')
+
+
+class ProcessTable(object):
+    def __init__(self, proc_dir='/proc', ttl=2.0):
+        '''
+        The processes in *proc_dir*; the list is read again when
+        it is more than *ttl* seconds old.
+        '''
+        self.proc_dir = proc_dir
+        self.ttl = ttl
+        self.lock = Lock()
+        self._procs = []
+        self.t_read = None
+        self.nreads = 0
+        self.boot_time = self._boot_time()
+
+    def _boot_time(self):
+        try:
+            for line in _read(os.path.join(self.proc_dir, 'stat')).splitlines():
+                if line.startswith('btime'):
+                    return int(line.split()[1])
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+        return 0
+
+    def read_pid(self, pid):
+        ''' ProcInfo for *pid*, or None if there is no such process. '''
+        base = os.path.join(self.proc_dir, str(pid))
+        try:
+            uid = os.stat(base).st_uid
+            stat = _read(os.path.join(base, 'stat'))
+            argv = _read(os.path.join(base, 'cmdline'), 'rb')
+            statm = _read(os.path.join(base, 'statm'))
+        except (IOError, OSError):
+            return None
+        # The name is in parentheses, and may contain anything.
+        try:
+            i0 = stat.index('(')
+            i1 = stat.rindex(')')
+            fields = stat[i1 + 2:].split()
+            p = ProcInfo()
+            p.pid = int(pid)
+            p.uid = uid
+            p.comm = stat[i0 + 1:i1]
+            p.state = fields[0]
+            p.ppid = int(fields[1])
+            p.start = self.boot_time + int(fields[19]) / _clock_ticks
+            p.vsz_kb = int(fields[20]) // 1024
+            p.rss_kb = int(statm.split()[1]) * _page_kb
+        except (ValueError, IndexError):
+            return None
+        p.argv = [a.decode('utf-8', 'replace')
+                  for a in argv.rstrip(b'\0').split(b'\0') if a]
+        return p
+
+    def _refresh(self):
+        try:
+            names = os.listdir(self.proc_dir)
+        except OSError:
+            names = []
+        procs = []
+        for name in names:
+            if name.isdigit():
+                p = self.read_pid(name)
+                if p is not None:     # it may have ended meanwhile
+                    procs.append(p)
+        procs.sort(key=lambda p: p.pid)
+        self._procs = procs
+        self.t_read = time.time()
+        self.nreads += 1
+
+    def processes(self):
+        ''' All processes, from a list at most ttl seconds old. '''
+        with self.lock:
+            if self.t_read is None or time.time() - self.t_read > self.ttl:
+                self._refresh()
+            return list(self._procs)
+
+    def get(self, pid):
+        ''' ProcInfo for *pid*, read now; None if it is not running. '''
+        p = self.read_pid(pid)
+        if p is None or p.state == 'Z':
+            return None
+        return p
+
+    def find(self, name=None, pattern=None, contains=(), user=None,
+             exclude_self=True):
+        '''
+        Processes whose executable is *name*, whose command line
+        matches the regular expression *pattern* and contains all
+        the strings in *contains*, and that belong to *user* (a
+        name or uid).  The calling process is left out unless
+        *exclude_self* is False.
+        '''
+        if pattern is not None and not hasattr(pattern, 'search'):
+            pattern = re.compile(pattern)
+        me = os.getpid()
+        found = []
+        for p in self.processes():
+            if exclude_self and p.pid == me:
+                continue
+            if name is not None and not p.matches_name(name):
+                continue
+            if user is not None and user not in (p.uid, p.user):
+                continue
+            cmdline = p.cmdline
+            if pattern is not None and not pattern.search(cmdline):
+                continue
+            if not all(s in cmdline for s in contains):
+                continue
+            found.append(p)
+        return found
+
+    def pids(self, **kwargs):
+        ''' The pids of the processes found by find(**kwargs). '''
+        return [p.pid for p in self.find(**kwargs)]
+
+
+_tables = {}
+_tables_lock = Lock()
+
+
+def get_table(proc_dir='/proc'):
+    ''' The ProcessTable for *proc_dir*, shared. '''
+    with _tables_lock:
+        if proc_dir not in _tables:
+            _tables[proc_dir] = ProcessTable(proc_dir)
+        return _tables[proc_dir]
+
+
+def ps_lines(procs):
+    ''' The header and a "ps -f" line for each of *procs*. '''
+    return [ps_header] + [p.ps_line() for p in procs]
+
+
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [options] [pattern]')
+    op.add_option('-x', '--name', dest='name',
+                  help='executable name, as for pgrep -x')
+    op.add_option('-u', '--user', dest='user',
+                  help='only processes of this user')
+    o, a = op.parse_args()
+    pattern = a[0] if a else None
+    t0 = time.time()
+    table = get_table()
+    procs = table.find(name=o.name, pattern=pattern, user=o.user)
+    print('\n'.join(ps_lines(procs)))
+    print('(%d of %d processes, %.3f s)' % (len(procs),
+                                            len(table.processes()),
+                                            time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
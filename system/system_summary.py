@@ -23,6 +23,8 @@ from importlib import import_module
 import numpy as np
 from pycurrents.file.binfile_n import BinfileSet
 
+from uhdas.system.proc_table import get_table, ps_lines
+
 system_log = "syslog"  # formerly "messages"
 
 class CommandError(Exception):
@@ -304,20 +306,23 @@ def list_file_ages(glob_pattern, reverse = True, maxfiles = 50):
     return ''.join(slist)
 
 
-def list_processes(pattern, switches='-f'):
-    cmd = "/bin/ps %s -U adcp | /bin/grep %s" % (switches, pattern,)
-    output = subprocess.getoutput(cmd)
-    lines = output.splitlines()
-    lines = [l for l in lines if not "/bin/grep" in l]
-    slist = ['--------%s--------' % cmd,
-             ('\n').join(lines),
+def list_processes(pattern, user='adcp'):
+    '''
+    List the processes of *user* (all users if None) with *pattern*
+    in the command line.
+    '''
+    procs = get_table().find(contains=[pattern], user=user)
+    title = 'processes matching %s' % pattern
+    if user is not None:
+        title += ', user %s' % user
+    slist = ['--------%s--------' % title,
+             ('\n').join(ps_lines(procs)),
              '------------------------------------------------\n']
     return '\n'.join(slist)
 
 def check_ntpq():
-    cmd = 'ps -ef | grep ntpd | grep -v grep'
-    s1 = subprocess.getoutput(cmd)
-    if len(s1) == 0:
+    cmd = 'ntpd'
+    if not get_table().find(name='ntpd'):
         s1 = "ntp is not running"
     else:
         cmd = 'ntpq -p'
@@ -387,7 +392,7 @@ def varfilelist(filebase):
 
 def serial_memory():
     flist = glob.glob('/var/lock/LCK..*')
-    strlist = ['#                    lockfile   pid        name    RSS   SZ','\n']
+    strlist = ['#                    lockfile   pid        name    RSS    VSZ','\n']
     for f in flist:
         x = open(f, 'r').readlines()
         lockfile = os.path.basename(f)
@@ -399,9 +404,14 @@ def serial_memory():
                 strlist.append(lockfile + ' incorrect contents')
             else:
                 pid, shortcmd = parts[0], parts[1]
-                cmd = 'ps -p %s -o rss,sz' % (pid)
-                status, meminfo = subprocess.getstatusoutput(cmd)
-                mhead, memstr = meminfo.split('\n')
+                try:
+                    p = get_table().get(int(pid))
+                except ValueError:
+                    p = None
+                if p is None:
+                    memstr = 'not running'
+                else:
+                    memstr = '%5d %6d' % (p.rss_kb, p.vsz_kb)
                 s = '%30s %5s %12s %s' % (lockfile, pid, shortcmd, memstr)
                 strlist.append(s)
     strlist.append('\n')
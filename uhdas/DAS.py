@@ -82,6 +82,7 @@ from pycurrents.system.startstop import StartStopControl, ChangedMind
 from pycurrents.system.tee import tee
 
 from uhdas.serial.logsubs import Loggers, LoggersStatusFrame
+from uhdas.serial import logger_metrics
 from uhdas.uhdas.cruisesetup import CruiseSetup
 from uhdas.uhdas.procsetup import procsetup
 from uhdas.uhdas.plotview import ImageMonitor
@@ -287,6 +288,7 @@ Continue logging other data streams?
 class DasAppShell(NBAppShell):
 
     n_min_tab = 3                 ### This is probably a temporary location.
+    metrics_pub = None            # zmq PUB address for logger metrics
 
     def appInit(self):
         self.cmd_queue = queue.Queue()
@@ -466,7 +468,9 @@ class DasAppShell(NBAppShell):
         page = self.noteBook.page('Monitor')
         yearbase = self.cruise.yearbase
         logs = Loggers(yearbase = yearbase, master = page,
-                 bindir = '/usr/local/bin') # Create the Loggers object.
+                 bindir = '/usr/local/bin', # Create the Loggers object.
+                 metrics_file = logger_metrics.default_filename(),
+                 metrics_pub = self.metrics_pub)
         self.logs = logs
         logs.pack()      # here, so a single call to this function does it all
 
@@ -947,8 +951,10 @@ class DasAppShell(NBAppShell):
                 inst = term.instrument
                 if not self.logs.getEnabled(inst):
                     continue
-                dt = now - self.logs.LogWinDict[inst].stats.LastGoodTime
+                metrics = self.logs.LogWinDict[inst].stats.metrics
+                dt = metrics.since_good(now)
                 if dt > self.timeout:
+                    L.info("%s timed out: %s", inst, metrics.summary(now))
                     self.restart_logging(dt)
         if self.timeout_id is None:
             check_interval = (5 + self.timeout) * 1000
@@ -971,9 +977,15 @@ class DasAppShell(NBAppShell):
                   timeout=None,
                   quit=False,
                   endcruise=False,
+                  metrics_pub=None,
                   **kw):
         self.pack()
 
+        if metrics_pub:
+            self.metrics_pub = metrics_pub
+            if hasattr(self, 'logs'):
+                self.logs.publisher.connect(metrics_pub)
+
         if quit:
             self.shutdown()
             L.info("Quit via command-line option.")
@@ -1094,6 +1106,9 @@ def main():
                         dest="timeout",
                         type="float",
                         help="timeout in seconds for restarting logging")
+    parser.add_option("", "--metrics_pub",
+                      dest="metrics_pub",
+                      help="zmq PUB address for logger metrics, e.g. tcp://*:38011",)
     parser.add_option("", "--quit",
                         dest="quit",
                         action="store_true",
@@ -1118,6 +1133,8 @@ def main():
     if options.timeout:
         DASkw['action'] = 'replace'
         runkw['timeout'] = options.timeout
+    if options.metrics_pub:
+        runkw['metrics_pub'] = options.metrics_pub
     if options.quit:
         DASkw['action'] = 'replace'
         runkw['quit'] = options.quit